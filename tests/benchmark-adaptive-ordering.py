@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# Compare static and adaptive ordering of conditions in local rule evaluation.
+# Copyright 2020 Thomas Patzke
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import functools
+import io
+import pathlib
+import random
+import sys
+import time
+
+basedir = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(basedir / "tools"))
+from sigma.configuration import SigmaConfiguration, SigmaConfigurationChain
+from sigma.engine.evaluator import SigmaRulesetEvaluator
+from sigma.engine.adaptive import SigmaAdaptiveConditionCompiler, loadOrderings, saveOrderings
+
+commandlines = [ "cmd.exe /c whoami", "svchost.exe -k netsvcs", "app.exe --update", "powershell.exe -enc SQBFAFgA", "cmd.exe /c vssadmin delete shadows" ]
+images = [ "C:\\Windows\\System32\\cmd.exe", "C:\\Windows\\System32\\svchost.exe", "C:\\Program Files\\App\\app.exe", "C:\\Windows\\System32\\WindowsPowerShell\\v1.0\\powershell.exe" ]
+event_ids = [ 1, 3, 3, 3, 5, 7, 7, 10, 11, 13 ]
+
+def events(count, seed):
+    """Generate winlogbeat Sysmon events with a mix of event identifiers."""
+    rnd = random.Random(seed)
+    for i in range(count):
+        yield {
+            "winlog": {
+                "channel": "Microsoft-Windows-Sysmon/Operational",
+                "event_id": rnd.choice(event_ids),
+                "event_data": {
+                    "CommandLine": rnd.choice(commandlines),
+                    "Image": rnd.choice(images),
+                    "ParentImage": "C:\\Windows\\explorer.exe",
+                    "User": "DOMAIN\\user%d" % (i % 100),
+                    },
+                },
+            }
+
+def load_ruleset(compiler):
+    config = SigmaConfigurationChain()
+    for name in ("generic/sysmon.yml", "winlogbeat.yml"):
+        with open(str(basedir / "tools" / "config" / name)) as f:
+            config.append(SigmaConfiguration(f))
+    ruleset = SigmaRulesetEvaluator(config, compiler=compiler)
+    for path in sorted((basedir / "rules" / "windows" / "process_creation").glob("*.yml")):
+        with path.open(encoding="utf-8") as f:
+            try:
+                ruleset.load(f)
+            except (NotImplementedError, TypeError):     # skip rules not supported by local evaluation
+                pass
+    return ruleset
+
+def run(ruleset, data, repeat):
+    """Evaluate events repeatedly and return number of matches of the first run and fastest run time."""
+    durations = list()
+    for i in range(repeat):
+        start = time.perf_counter()
+        matches = sum([ len(ruleset.match(event)) for event in data ])
+        durations.append(time.perf_counter() - start)
+        if i == 0:
+            first = matches
+    return first, min(durations)
+
+argparser = argparse.ArgumentParser(description="Compare static and adaptive ordering of conditions")
+argparser.add_argument("--events", "-n", type=int, default=20000, help="Number of generated events")
+argparser.add_argument("--repeat", "-r", type=int, default=3, help="Number of runs, the fastest is reported")
+argparser.add_argument("--seed", type=int, default=1, help="Random seed")
+args = argparser.parse_args()
+data = list(events(args.events, args.seed))
+
+orderings = dict()
+persisted = io.StringIO()
+print("{:24} {:>10} {:>8}".format("Ordering", "Time", "Matches"))
+for name in ("static", "adaptive", "adaptive (persisted)"):
+    if name == "static":
+        compiler = None
+    elif name == "adaptive":
+        compiler = functools.partial(SigmaAdaptiveConditionCompiler, orderings)
+    else:       # orderings learned in previous run
+        saveOrderings(orderings, persisted)
+        persisted.seek(0)
+        compiler = functools.partial(SigmaAdaptiveConditionCompiler, loadOrderings(persisted))
+    ruleset = load_ruleset(compiler)
+    matches, duration = run(ruleset, data, args.repeat)
+    print("{:24} {:>9.2f}s {:>8}".format(name, duration, matches))
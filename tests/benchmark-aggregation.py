@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+# Compare exact and approximate aggregation states of local rule evaluation on synthetic data.
+# Copyright 2020 Thomas Patzke
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import functools
+import pathlib
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent.parent / "tools"))
+from sigma.parser.collection import SigmaCollectionParser
+from sigma.engine.evaluator import SigmaRuleEvaluator
+from sigma.engine.aggregation import ExactAggregation, ApproximateAggregation
+
+rule_template = """
+title: Password spraying
+logsource:
+    product: windows
+    service: security
+detection:
+    selection:
+        EventID: 4625
+    condition: selection | %s
+"""
+
+def events(count, groups, sprayers, seed):
+    """
+    Generate failed logon events: background addresses with 1-3 user names and sprayer addresses
+    with 20-200 user names.
+    """
+    rnd = random.Random(seed)
+    sprayer_users = { "10.0.%d.%d" % (i // 256, i % 256): rnd.randint(20, 200) for i in range(sprayers) }
+    sprayer_ips = list(sprayer_users.keys())
+    for i in range(count):
+        if rnd.random() < 0.05:
+            ip = rnd.choice(sprayer_ips)
+            user = "user%d" % rnd.randrange(sprayer_users[ip])
+        else:
+            n = rnd.randrange(groups)
+            ip = "%d.%d.%d.%d" % (1 + n // 16777216 % 223, n // 65536 % 256, n // 256 % 256, n % 256)
+            user = "user%d" % rnd.randrange(1 + n % 3)
+        yield { "EventID": 4625, "IpAddress": ip, "TargetUserName": user }
+
+def run(condition, aggregation, args):
+    parser = next(iter(SigmaCollectionParser(rule_template % condition).parsers))
+    tracemalloc.start()
+    start = time.perf_counter()
+    evaluator = SigmaRuleEvaluator(parser, aggregation)
+    for event in events(args.events, args.groups, args.sprayers, args.seed):
+        evaluator.match(event)
+    duration = time.perf_counter() - start
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return dict(evaluator.aggregate()), memory, duration
+
+argparser = argparse.ArgumentParser(description="Compare exact and approximate aggregation on synthetic data")
+argparser.add_argument("--events", "-n", type=int, default=2000000, help="Number of generated events")
+argparser.add_argument("--groups", "-g", type=int, default=1000000, help="Number of background source addresses")
+argparser.add_argument("--sprayers", "-s", type=int, default=50, help="Number of spraying source addresses")
+argparser.add_argument("--seed", type=int, default=1, help="Random seed")
+argparser.add_argument("--memory-limit", "-m", type=int, default=64 * 1024 * 1024, help="Memory limit of approximate aggregation")
+args = argparser.parse_args()
+
+approximate = functools.partial(ApproximateAggregation, memory_limit=args.memory_limit)
+print("{:34} {:>10} {:>8} {:>10} {:>10} {:>14}".format("Aggregation", "Memory", "Time", "Detected", "False pos.", "Max. rel. error"))
+for condition in ("count(TargetUserName) by IpAddress > 10", "count() by IpAddress > 100"):
+    exact, memory, duration = run(condition, ExactAggregation, args)
+    print("{:34} {:>8.1f}MB {:>7.1f}s {:>10} {:>10} {:>14}".format(condition.split(" ")[0] + " exact", memory / 2**20, duration, len(exact), 0, 0))
+    approx, memory, duration = run(condition, approximate, args)
+    detected = len(set(exact) & set(approx))
+    false_positives = len(set(approx) - set(exact))
+    error = max([ abs(approx[group] - value) / value for group, value in exact.items() if group in approx ] or [ 0 ])
+    print("{:34} {:>8.1f}MB {:>7.1f}s {:>7}/{:<2} {:>10} {:>13.1f}%".format(condition.split(" ")[0] + " approximate", memory / 2**20, duration, detected, len(exact), false_positives, error * 100))
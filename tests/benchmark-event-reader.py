@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# Compare complete and projected JSON events for local rule evaluation. With pysimdjson installed, projected reading
+# skips the keys that aren't required by the rules instead of decoding records completely with json.loads(), else
+# projection only reduces the memory of decoded events that are kept, e.g. in batches or aggregation windows.
+# Copyright 2020 Thomas Patzke
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import io
+import json
+import pathlib
+import random
+import sys
+import time
+import tracemalloc
+
+basedir = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(basedir / "tools"))
+from sigma.configuration import SigmaConfiguration, SigmaConfigurationChain
+from sigma.engine.evaluator import SigmaRulesetEvaluator
+from sigma.engine import events as sigma_events
+from sigma.engine.events import JSONEventReader
+from sigma.engine.exceptions import NotSupportedError
+
+images = [ "C:\\Windows\\System32\\cmd.exe", "C:\\Windows\\System32\\svchost.exe", "C:\\Program Files\\App\\app.exe", "C:\\Windows\\System32\\WindowsPowerShell\\v1.0\\powershell.exe" ]
+commandlines = [ "cmd.exe /c whoami", "svchost.exe -k netsvcs", "app.exe --update", "powershell.exe -enc SQBFAFgA", "cmd.exe /c vssadmin delete shadows" ]
+
+def sysmon_event(rnd, i):
+    """Generate event data of Sysmon process creation event"""
+    return {
+        "CommandLine": rnd.choice(commandlines),
+        "Company": "Microsoft Corporation",
+        "CurrentDirectory": "C:\\Users\\user%d\\" % (i % 100),
+        "Description": "Windows Command Processor",
+        "FileVersion": "10.0.18362.449 (WinBuild.160101.0800)",
+        "Hashes": "SHA1=%040x,MD5=%032x,SHA256=%064x,IMPHASH=%032x" % (i, i, i, i),
+        "Image": rnd.choice(images),
+        "IntegrityLevel": "Medium",
+        "LogonGuid": "{%036x}" % i,
+        "LogonId": "0x%x" % i,
+        "OriginalFileName": "Cmd.Exe",
+        "ParentCommandLine": "C:\\Windows\\Explorer.EXE",
+        "ParentImage": "C:\\Windows\\explorer.exe",
+        "ParentProcessGuid": "{%036x}" % (i + 1),
+        "ParentProcessId": str(i % 65536),
+        "ProcessGuid": "{%036x}" % (i + 2),
+        "ProcessId": str((i + 1) % 65536),
+        "Product": "Microsoft Windows Operating System",
+        "RuleName": "",
+        "TerminalSessionId": "1",
+        "User": "DOMAIN\\user%d" % (i % 100),
+        "UtcTime": "2020-01-01 00:00:00.000",
+        }
+
+def winlogbeat_event(rnd, i):
+    event_data = sysmon_event(rnd, i)
+    return {
+        "@timestamp": "2020-01-01T00:00:00.000Z",
+        "agent": { "ephemeral_id": "%036x" % i, "hostname": "WIN10", "id": "%036x" % i, "type": "winlogbeat", "version": "7.5.0" },
+        "ecs": { "version": "1.1.0" },
+        "event": { "action": "Process Create (rule: ProcessCreate)", "code": 1, "created": "2020-01-01T00:00:00.000Z", "kind": "event", "module": "sysmon" },
+        "host": { "architecture": "x86_64", "hostname": "WIN10", "id": "%036x" % i, "name": "WIN10", "os": { "build": "18362.535", "family": "windows", "kernel": "10.0.18362.535", "name": "Windows 10 Pro", "platform": "windows", "version": "10.0" } },
+        "log": { "level": "information" },
+        "message": "Process Create:\n" + "\n".join([ "%s: %s" % item for item in event_data.items() ]),
+        "winlog": {
+            "api": "wineventlog",
+            "channel": "Microsoft-Windows-Sysmon/Operational",
+            "computer_name": "WIN10",
+            "event_data": event_data,
+            "event_id": 1,
+            "opcode": "Info",
+            "process": { "pid": 2000, "thread": { "id": 3000 } },
+            "provider_guid": "{5770385f-c22a-43e0-bf4c-06f5698ffbd9}",
+            "provider_name": "Microsoft-Windows-Sysmon",
+            "record_id": i,
+            "task": "Process Create (rule: ProcessCreate)",
+            "user": { "domain": "NT AUTHORITY", "identifier": "S-1-5-18", "name": "SYSTEM", "type": "User" },
+            "version": 5,
+            },
+        }
+
+def flat_event(rnd, i):
+    event = winlogbeat_event(rnd, i)
+    del event["winlog"]
+    event.update(sysmon_event(rnd, i))
+    event["EventID"] = 1
+    event["Channel"] = "Microsoft-Windows-Sysmon/Operational"
+    return event
+
+def load_ruleset(config):
+    ruleset = SigmaRulesetEvaluator(config)
+    for path in sorted((basedir / "rules" / "windows" / "process_creation").glob("*.yml")):
+        with path.open(encoding="utf-8") as f:
+            try:
+                ruleset.load(f)
+            except NotSupportedError:       # skip rules not supported by local evaluation
+                pass
+    ruleset.rules = [ rule for rule in ruleset.rules if rule.fields is not None ]     # rules with unbound values require all fields
+    return ruleset
+
+def decode(data, fields):
+    """Decode events, return them with decoding time and memory allocated for them"""
+    start = time.perf_counter()
+    list(JSONEventReader(io.StringIO(data), fields))
+    duration = time.perf_counter() - start      # measured without tracing, it slows down allocations
+    tracemalloc.start()
+    events = list(JSONEventReader(io.StringIO(data), fields))
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return events, duration, size
+
+def evaluate(events, ruleset):
+    start = time.perf_counter()
+    matches = sum([ len(ruleset.match(event)) for event in events ])
+    return matches, time.perf_counter() - start
+
+argparser = argparse.ArgumentParser(description="Compare complete and projected JSON events")
+argparser.add_argument("--events", "-n", type=int, default=20000, help="Number of generated events")
+argparser.add_argument("--seed", type=int, default=1, help="Random seed")
+args = argparser.parse_args()
+
+print("Projection parser:", "json" if sigma_events.simdjson is None else "simdjson")
+
+winlogbeat_config = SigmaConfigurationChain()
+with open(str(basedir / "tools" / "config" / "winlogbeat.yml")) as f:
+    winlogbeat_config.append(SigmaConfiguration(f))
+
+print("{:12} {:>6} {:>7} {:>10} {:>10} {:>10} {:>10} {:>10} {:>8}".format("Format", "Rules", "Fields", "Decode", "Decode/pr.", "Memory", "Memory/pr.", "Evaluate", "Matches"))
+for name, generate, config in (("winlogbeat", winlogbeat_event, winlogbeat_config), ("flat", flat_event, None)):
+    rnd = random.Random(args.seed)
+    data = "\n".join([ json.dumps(generate(rnd, i)) for i in range(args.events) ])
+    ruleset = load_ruleset(config)
+    fields = ruleset.fields
+    events, decode_complete, size_complete = decode(data, None)
+    matches_complete, evaluate_complete = evaluate(events, ruleset)
+    del events
+    events, decode_projected, size_projected = decode(data, fields)
+    matches_projected, _ = evaluate(events, ruleset)
+    assert matches_complete == matches_projected
+    print("{:12} {:>6} {:>7} {:>9.2f}s {:>9.2f}s {:>8.1f}MB {:>8.1f}MB {:>9.2f}s {:>8}".format(name, len(ruleset.rules), len(fields), decode_complete, decode_projected, size_complete / 2**20, size_projected / 2**20, evaluate_complete, matches_projected))
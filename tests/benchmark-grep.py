@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# Compare grep backend outputs (pcre, fast and script) on a large synthetic log file.
+# Copyright 2020 Thomas Patzke
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import os
+import pathlib
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+basedir = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(basedir / "tools"))
+from sigma.backends.base import BackendOptions
+from sigma.backends.misc import GrepBackend
+from sigma.configuration import SigmaConfiguration
+from sigma.parser.collection import SigmaCollectionParser
+
+words = [ "svchost.exe", "C:\\Windows\\System32\\", "explorer.exe", "User=DOMAIN\\user", "ProcessId=", "ParentProcessId=", "-k netsvcs", "Medium", "High",
+        "C:\\Program Files\\App\\app.exe", "--update", "EventID=1", "EventID=3", "EventID=4624", "LogonType=3", "rundll32.exe", "cmd.exe /c", "0x1f3fff" ]
+suspicious = [ "whoami /all", "vssadmin delete shadows /all", "\\mimikatz.exe", "powershell -enc SQBFAFgA", "net user admin /add", "certutil -urlcache -split -f" ]
+
+def write_events(path, count, length, seed):
+    """Write log lines with random benign words and some suspicious command lines"""
+    rnd = random.Random(seed)
+    with open(path, "w") as f:
+        for i in range(count):
+            line = list()
+            while sum([ len(word) + 1 for word in line ]) < length:
+                line.append(rnd.choice(words) if rnd.random() < 0.8 else "%08x" % rnd.getrandbits(32))
+            if rnd.random() < 0.01:
+                line.insert(rnd.randrange(len(line)), rnd.choice(suspicious))
+            f.write(" ".join(line) + "\n")
+
+def convert(output):
+    """Convert rules and return list of (rule file, command) or the script for output=script"""
+    config = SigmaConfiguration()
+    backend = GrepBackend(config, BackendOptions([ "output=" + output ], None))
+    commands = list()
+    for path in sorted((basedir / "rules" / "windows" / "process_creation").glob("*.yml")):
+        try:
+            for command in SigmaCollectionParser(path.read_text(encoding="utf-8"), config).generate(backend):
+                commands.append((path.name, command))
+        except Exception:
+            continue
+    return commands, backend.finalize()
+
+def run(commands, events, timeout):
+    """Run commands on event file, returns number of matched lines, duration, number of timed out and failed commands"""
+    matches = timeouts = errors = 0
+    start = time.perf_counter()
+    for name, command in commands:
+        process = subprocess.Popen("(%s) < '%s' | wc -l" % (command, events), shell=True, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+            matches += int(stdout)
+            if stderr:              # invalid patterns or exceeded backtracking limit
+                errors += 1
+        except subprocess.TimeoutExpired:
+            os.killpg(process.pid, signal.SIGKILL)      # kill all commands of the pipeline
+            process.communicate()
+            timeouts += 1
+    return matches, time.perf_counter() - start, timeouts, errors
+
+argparser = argparse.ArgumentParser(description="Compare grep backend outputs on a large synthetic log file")
+argparser.add_argument("--lines", "-n", type=int, default=200000, help="Number of generated log lines")
+argparser.add_argument("--length", type=int, default=500, help="Minimum length of log lines")
+argparser.add_argument("--timeout", type=float, default=30, help="Timeout of a single grep command in seconds")
+argparser.add_argument("--seed", type=int, default=1, help="Random seed")
+argparser.add_argument("--outputs", default="pcre,fast,script", help="Compared outputs, comma separated")
+args = argparser.parse_args()
+
+with tempfile.TemporaryDirectory() as tmpdir:
+    events = os.path.join(tmpdir, "events.log")
+    write_events(events, args.lines, args.length, args.seed)
+    print("{} lines, {:.1f} MB".format(args.lines, os.path.getsize(events) / 1000000))
+
+    pcre, _ = convert("pcre")
+    fast, _ = convert("fast")
+    _, script = convert("script")
+    scriptfile = os.path.join(tmpdir, "rules.sh")
+    with open(scriptfile, "w") as f:
+        f.write(script)
+
+    print("{:8} {:>6} {:>10} {:>8} {:>9} {:>7}".format("Output", "Rules", "Time", "Matches", "Timeouts", "Errors"))
+    for output, commands in (("pcre", pcre), ("fast", fast), ("script", [ ("all", "sh '%s' '%s'" % (scriptfile, events)) ])):
+        if output not in args.outputs.split(","):
+            continue
+        matches, duration, timeouts, errors = run(commands, events, args.timeout if output != "script" else None)
+        print("{:8} {:>6} {:>9.2f}s {:>8} {:>9} {:>7}".format(output, len(fast) if output == "script" else len(commands), duration, matches, timeouts, errors))
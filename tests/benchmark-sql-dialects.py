@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Compare LIKE-based SQL queries with FTS5 trigram index queries on SQLite.
+# Copyright 2020 Thomas Patzke
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import pathlib
+import random
+import re
+import sqlite3
+import sys
+import time
+
+basedir = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(basedir / "tools"))
+from sigma.backends.base import BackendOptions
+from sigma.backends.sql import SQLBackend
+from sigma.configuration import SigmaConfiguration
+from sigma.parser.collection import SigmaCollectionParser
+
+columns = [ "EventID", "Image", "OriginalFileName", "CommandLine", "ParentImage", "ParentCommandLine", "User", "CurrentDirectory", "IntegrityLevel" ]
+images = [ "C:\\Windows\\System32\\cmd.exe", "C:\\Windows\\System32\\svchost.exe", "C:\\Program Files\\App\\app.exe", "C:\\Windows\\System32\\WindowsPowerShell\\v1.0\\powershell.exe",
+        "C:\\Windows\\System32\\whoami.exe", "C:\\Windows\\System32\\net.exe", "C:\\Windows\\System32\\rundll32.exe", "C:\\Users\\Public\\update.exe" ]
+arguments = [ "/c whoami", "-k netsvcs", "--update", "-enc SQBFAFgA", "/c vssadmin delete shadows", "user admin /add", "shell32.dll,Control_RunDLL", "-nop -w hidden", "localgroup administrators" ]
+
+def events(count, seed):
+    """Generate process creation events with mostly benign and some suspicious command lines."""
+    rnd = random.Random(seed)
+    for i in range(count):
+        image = rnd.choice(images)
+        parent = rnd.choice(images)
+        yield (
+                "1",            # Sysmon event identifier as string like in the generated conditions
+                image,
+                image.rsplit("\\", 1)[1],
+                "%s %s %08x" % (image, rnd.choice(arguments), rnd.getrandbits(32)),
+                parent,
+                "%s %08x" % (parent, rnd.getrandbits(32)),
+                "DOMAIN\\user%d" % rnd.randrange(1000),
+                "C:\\Users\\user%d\\" % rnd.randrange(1000),
+                rnd.choice(("Medium", "High", "System")),
+                )
+
+def create_database(path, count, seed):
+    db = sqlite3.connect(path)
+    db.create_function("regexp", 2, lambda pattern, value: value is not None and re.search(pattern, value) is not None)
+    db.execute("CREATE TABLE events (event_id INTEGER PRIMARY KEY, %s)" % ", ".join(columns))
+    db.executemany("INSERT INTO events (%s) VALUES (%s)" % (", ".join(columns), ", ".join([ "?" ] * len(columns))), events(count, seed))
+    start = time.perf_counter()
+    db.execute("CREATE VIRTUAL TABLE events_fts USING fts5(%s, content='events', content_rowid='event_id', tokenize='trigram')" % ", ".join(columns))
+    db.execute("INSERT INTO events_fts(events_fts) VALUES ('rebuild')")
+    db.commit()
+    return db, time.perf_counter() - start
+
+def generate_queries(dialect):
+    """Generate queries of process creation rules, rules that can't be converted are returned as None."""
+    with open(str(basedir / "tools" / "config" / "generic" / "sysmon.yml")) as f:
+        config = SigmaConfiguration(f)
+    backend = SQLBackend(config, BackendOptions([ "dialect=" + dialect, "output=query", "table=events" ], None))
+    queries = dict()
+    for path in sorted((basedir / "rules" / "windows" / "process_creation").glob("*.yml")):
+        try:
+            queries[path.name] = "\n".join(SigmaCollectionParser(path.read_text(encoding="utf-8"), config).generate(backend))
+        except Exception:
+            queries[path.name] = None
+    return queries
+
+def run(db, queries):
+    """Run queries and return dict of rule file -> matched event ids and the duration."""
+    results = dict()
+    start = time.perf_counter()
+    for name, query in queries.items():
+        results[name] = sorted([ row[0] for statement in query.split("\n") for row in db.execute(statement) ])
+    return results, time.perf_counter() - start
+
+argparser = argparse.ArgumentParser(description="Compare LIKE-based SQL queries with FTS5 trigram index queries on SQLite")
+argparser.add_argument("--events", "-n", type=int, default=1000000, help="Number of generated events")
+argparser.add_argument("--database", default=":memory:", help="SQLite database file, default is an in-memory database")
+argparser.add_argument("--seed", type=int, default=1, help="Random seed")
+args = argparser.parse_args()
+
+db, indexing = create_database(args.database, args.events, args.seed)
+print("FTS5 trigram index of {} events built in {:.2f}s".format(args.events, indexing))
+
+like_queries = generate_queries("sqlite")
+fts_queries = generate_queries("sqlite-fts5")
+supported = dict()
+for name in like_queries:
+    if like_queries[name] is None or fts_queries[name] is None:
+        continue
+    try:        # skip rules that refer to columns not contained in the table
+        for statement in like_queries[name].split("\n") + fts_queries[name].split("\n"):
+            db.execute("EXPLAIN " + statement)
+    except sqlite3.Error:
+        continue
+    supported[name] = (like_queries[name], fts_queries[name])
+
+like_results, like_duration = run(db, { name: queries[0] for name, queries in supported.items() })
+fts_results, fts_duration = run(db, { name: queries[1] for name, queries in supported.items() })
+differences = [ name for name in supported if like_results[name] != fts_results[name] ]
+
+print("{:12} {:>10} {:>8}".format("Dialect", "Time", "Matches"))
+print("{:12} {:>9.2f}s {:>8}".format("sqlite", like_duration, sum([ len(ids) for ids in like_results.values() ])))
+print("{:12} {:>9.2f}s {:>8}".format("sqlite-fts5", fts_duration, sum([ len(ids) for ids in fts_results.values() ])))
+print("{} rules, {} with different results{}".format(len(supported), len(differences), ": " + ", ".join(differences) if differences else ""))
@@ -38,6 +38,7 @@ setup(
         'sigma',
         'sigma.backends',
         'sigma.config',
+        'sigma.engine',
         'sigma.parser',
         'sigma.parser.modifiers',
         ],
@@ -72,6 +73,7 @@ setup(
         ('etc/sigma/generic', [
             'config/generic/sysmon.yml',
             'config/generic/windows-audit.yml',
+            'config/generic/windows-keywordfields.yml',
         ])],
     scripts=[
         'sigmac',
@@ -79,5 +81,7 @@ setup(
         'sigma2misp',
         'sigma-similarity',
         'sigma-uuid',
+        'sigma-bundle',
+        'sigma-fieldstats',
         ]
 )
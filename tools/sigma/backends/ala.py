@@ -17,17 +17,19 @@
 import re
 import xml.etree.ElementTree as xml
 from .base import SingleTextQueryBackend
+from .mixins import KustoTermMixin
 from .data import sysmon_schema
 from .exceptions import NotSupportedError
 
-class AzureLogAnalyticsBackend(SingleTextQueryBackend):
+class AzureLogAnalyticsBackend(KustoTermMixin, SingleTextQueryBackend):
     """Converts Sigma rule into Azure Log Analytics Queries."""
     identifier = "ala"
     active = True
-    options = SingleTextQueryBackend.options + (
+    options = SingleTextQueryBackend.options + KustoTermMixin.options + (
             ("sysmon", False, "Generate Sysmon event queries for generic rules", None),
             )
     config_required = False
+    queryLengthLimit = 10000    # maximum query length of analytics rules
 
     reEscape = re.compile('("|(?<!\\\\)\\\\(?![*?\\\\]))')
     reClear = None
@@ -93,7 +95,7 @@ class AzureLogAnalyticsBackend(SingleTextQueryBackend):
 
         return "%s \"%s\"" % (op, val)
 
-    def generate(self, sigmaparser):
+    def initializeRule(self, sigmaparser):
         self.table = None
         try:
             self.category = sigmaparser.parsedyaml['logsource'].setdefault('category', None)
@@ -112,6 +114,8 @@ class AzureLogAnalyticsBackend(SingleTextQueryBackend):
                 self.table = "SecurityEvent"
                 self.eventid = "4688"
 
+    def generate(self, sigmaparser):
+        self.initializeRule(sigmaparser)
         return super().generate(sigmaparser)
 
     def generateBefore(self, parsed):
@@ -135,7 +139,9 @@ class AzureLogAnalyticsBackend(SingleTextQueryBackend):
         and creates an appropriate table reference.
         """
         key, value = node
-        if type(value) == list:         # handle map items with values list like multiple OR-chained conditions
+        if type(value) == list and value and all([ type(v) == str for v in value ]):
+            return self.generateKQLListCondition(key, value)
+        elif type(value) == list:         # handle map items with values list like multiple OR-chained conditions
             return "(" + self.generateORNode(
                     [(key, v) for v in value]
                     ) + ")"
@@ -147,7 +153,9 @@ class AzureLogAnalyticsBackend(SingleTextQueryBackend):
                 self.table = "SecurityEvent"
             elif self.service == "system":
                 self.table = "Event"
-        elif type(value) in (str, int):     # default value processing
+        elif type(value) == str:
+            return self.generateKQLValueCondition(key, value)
+        elif type(value) == int:     # default value processing
             mapping = (key, self.default_value_mapping)
             if len(mapping) == 1:
                 mapping = mapping[0]
@@ -177,7 +185,7 @@ class AzureAPIBackend(AzureLogAnalyticsBackend):
     """Converts Sigma rule into Azure Log Analytics Rule."""
     identifier = "ala-rule"
     active = True
-    options = SingleTextQueryBackend.options + (
+    options = SingleTextQueryBackend.options + KustoTermMixin.options + (
             ("sysmon", False, "Generate Sysmon event queries for generic rules", None),
             )
 
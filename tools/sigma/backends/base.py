@@ -14,13 +14,19 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import copy
+import math
+import re
 import sys
 
 import sigma
 import yaml
 
+from .exceptions import QueryBudgetError
 from .mixins import RulenameCommentMixin, QuoteCharMixin
+from sigma.selectivity import SigmaFieldStatistics
 from sigma.parser.modifiers.base import SigmaTypeModifier
+from sigma.parser.modifiers.type import SigmaRegularExpressionModifier, SigmaValueListModifier
 
 class BackendOptions(dict):
     """
@@ -87,9 +93,35 @@ class BaseBackend:
     active = False
     index_field = None    # field name that is used to address indices
     file_list = None
-    options = tuple()     # a list of tuples with following elements: option name, default value, help text, target attribute name (option name if None)
+    options = (           # a list of tuples with following elements: option name, default value, help text, target attribute name (option name if None)
+            ("max_clauses", None, "Maximum number of clauses per query, larger rules are split into several queries (0: unlimited, default: limit of backend)", None),
+            ("max_query_length", None, "Maximum query length in characters, larger rules are split into several queries (0: unlimited, default: limit of backend)", None),
+            ("negations", None, "Negation form: keep = as in rule, atoms = negations pushed down to field conditions, null conditions (exists) and value lists (NOT IN), grouped = like atoms with negations of a conjunction grouped into one block after the positive conditions (default: keep)", None),
+            ("order_conditions", None, "Order conditions by estimated selectivity and evaluation cost, changes the order of conditions in the output (default: enabled by field_stats)", None),
+            ("field_stats", None, "Field statistics file (JSON or YAML, see sigma-fieldstats) for ordering of conditions", None),
+            ("indexed_fields", None, "Comma-separated list of indexed fields that are checked first by ordering of conditions", None),
+            )
     config_required = True
     default_config = None
+    reValueListEscape = re.compile(r"(\\*)([*?])")     # wildcards and backslashes in front of them
+    clauseLimit = None    # maximum number of clauses of a query in target system, overridden by max_clauses option
+    queryLengthLimit = None     # same for query length in characters, overridden by max_query_length option
+    negationForm = "keep"      # preferred negation form of backend, overridden by negations option
+    costWeights = {             # weights of cost factors in cost reports, backends adjust them to the cost of their query language
+            "leading_wildcards": 10,    # values that begin with a wildcard
+            "regexes": 20,              # regular expressions
+            "clauses": 1,               # elementary conditions, each value of a list is one clause
+            "unbound_keywords": 20,     # values that are not bound to a field and searched in all fields
+            "aggregation_risk": 25,     # number of aggregated groups and missing timeframe
+            "query_length": 0.01,       # estimated query length in characters
+            }
+    defaultCardinality = 1000   # assumed number of distinct values of group-by fields without statistics
+    max_clauses = None
+    max_query_length = None
+    negations = None
+    order_conditions = None
+    field_stats = None
+    indexed_fields = None
 
     def __init__(self, sigmaconfig, backend_options=dict()):
         """
@@ -109,6 +141,18 @@ class BaseBackend:
                 target = option
             setattr(self, target, self.backend_options.setdefault(option, default_value))
 
+        if self.order_conditions is None:
+            ordering = self.field_stats is not None
+        else:
+            ordering = str(self.order_conditions).lower() not in ("false", "0", "no")
+        self.fieldStatistics = None
+        if ordering:
+            indexed = [ field.strip() for field in (self.indexed_fields or "").split(",") if field.strip() ]
+            if self.field_stats is not None:
+                self.fieldStatistics = SigmaFieldStatistics.load(self.field_stats, indexed)
+            else:
+                self.fieldStatistics = SigmaFieldStatistics(indexed=indexed)
+
     def generate(self, sigmaparser):
         """Method is called for each sigma rule and receives the parsed rule (SigmaParser)"""
         for parsed in sigmaparser.condparsed:
@@ -126,6 +170,225 @@ class BaseBackend:
 
             return result
 
+    def generateBudgeted(self, sigmaparser):
+        """
+        Generate list of results of generate() for a rule with conditions rewritten into the negation form of the
+        backend that stay within the clause and query length budget of the backend. Conditions of rules that exceed
+        the budget are split into parts that match together the same events as the condition by separation of OR
+        branches and value lists. Each part is passed as own rule with the part number in the part attribute to
+        generate().
+        """
+        conditions = list()
+        if self.queryBudget() != (None, None):
+            self.initializeRule(sigmaparser)    # query length is measured with the per-rule state of the backend
+        for parsed in sigmaparser.condparsed:
+            search = self.rewriteSearch(parsed.parsedSearch)
+            if self.queryBudget() == (None, None):
+                conditions.append((parsed, [ search ]))
+            else:
+                conditions.append((parsed, self.splitSearch(sigmaparser, parsed, search)))
+
+        if all([ len(nodes) == 1 and nodes[0] is parsed.parsedSearch for parsed, nodes in conditions ]):
+            return [ self.generate(sigmaparser) ]
+        elif all([ len(nodes) == 1 for parsed, nodes in conditions ]):
+            return [ self.generate(self.rewrittenParser(sigmaparser, [ (parsed, nodes[0]) for parsed, nodes in conditions ])) ]
+
+        results = list()
+        for parsed, nodes in conditions:
+            for node in nodes:
+                results.append(self.generate(self.rewrittenParser(sigmaparser, [ (parsed, node) ], len(results) + 1)))
+        return results
+
+    def initializeRule(self, sigmaparser):
+        """
+        Set up per-rule state of the backend that is used while generating search nodes, e.g. a table selected from
+        the log source. Backends with such state call this from generate() and it's called before query lengths are
+        measured against the budget.
+        """
+        pass
+
+    def rewrittenParser(self, sigmaparser, conditions, part=None):
+        """Copy of rule with conditions given as list of (parsed condition, search node) tuples and part number"""
+        rewritten = copy.copy(sigmaparser)
+        rewritten.part = part
+        rewritten.condparsed = list()
+        for parsed, node in conditions:
+            parsed = copy.copy(parsed)
+            parsed.parsedSearch = node
+            parsed.sigmaParser = rewritten
+            rewritten.condparsed.append(parsed)
+        return rewritten
+
+    def rewriteSearch(self, node):
+        """
+        Rewrite search node into the negation form selected by the negations option or preferred by the backend and
+        order conditions by estimated selectivity and cost if enabled.
+        """
+        form = self.negations or self.negationForm
+        if form in ("atoms", "grouped"):
+            notnull = type(self).generateNotNULLValueNode is not BaseBackend.generateNotNULLValueNode and getattr(self, "notNullExpression", True) is not None
+            node = sigma.parser.condition.SigmaConditionOptimizer().pushDownNegations(node, form == "grouped", notnull)
+        elif form != "keep":
+            raise NotImplementedError("Negation form '%s' is not supported" % form)
+        if self.fieldStatistics is not None:
+            node = self.fieldStatistics.order(node)
+        return node
+
+    def queryBudget(self):
+        """Maximum number of clauses and query length as tuple, None if not limited"""
+        clauses = self.clauseLimit if self.max_clauses is None else int(self.max_clauses) or None
+        length = self.queryLengthLimit if self.max_query_length is None else int(self.max_query_length) or None
+        return clauses, length
+
+    def budgetViolation(self, node):
+        """
+        Return description of the violated budget if the query generated from the search node exceeds the budget of
+        the backend or None. Backends with further limits, e.g. a cost function, can extend this method.
+        """
+        max_clauses, max_length = self.queryBudget()
+        if max_clauses is not None:
+            clauses = self.countClauses(node)
+            if clauses > max_clauses:
+                return "%d clauses exceed limit of %d" % (clauses, max_clauses)
+        if max_length is not None:
+            length = len(str(self.generateNode(node)))
+            if length > max_length:
+                return "query length of %d characters exceeds limit of %d" % (length, max_length)
+        return None
+
+    def splitSearch(self, sigmaparser, parsed, node):
+        """Split search node into list of nodes that are each within the budget"""
+        violation = self.budgetViolation(node)
+        if violation is None:
+            return [ node ]
+        if parsed.parsedAgg:
+            raise QueryBudgetError("Rule '%s' can't be split into queries within budget of backend because it contains an aggregation: %s" % (sigmaparser.parsedyaml.get("title"), violation))
+        split = self.splitNode(node)
+        if split is None:
+            raise QueryBudgetError("Rule '%s' can't be split further into queries within budget of backend: %s" % (sigmaparser.parsedyaml.get("title"), violation))
+        return [ part for half in split for part in self.splitSearch(sigmaparser, parsed, half) ]
+
+    def splitNode(self, node):
+        """
+        Split search node into two nodes that match together the same events or return None if node can't be split.
+        OR conditions and lists are split in halves, AND conditions are split by splitting their largest splittable
+        item. Negated conditions aren't split because the parts of a negation don't match the same events.
+        """
+        if type(node) == sigma.parser.condition.NodeSubexpression:
+            split = self.splitNode(node.items)
+            return split and tuple([ sigma.parser.condition.NodeSubexpression(half) for half in split ])
+        elif type(node) == sigma.parser.condition.ConditionOR:
+            if len(node.items) == 1:
+                return self.splitNode(node.items[0])
+            elif len(node.items) > 1:
+                half = len(node.items) // 2
+                return self.conditionNode(sigma.parser.condition.ConditionOR, node.items[:half]), self.conditionNode(sigma.parser.condition.ConditionOR, node.items[half:])
+        elif type(node) == sigma.parser.condition.ConditionAND:
+            items = list(node.items)
+            for i in sorted(range(len(items)), key=lambda i: -self.countClauses(items[i])):
+                split = self.splitNode(items[i])
+                if split is not None:
+                    return tuple([ self.conditionNode(sigma.parser.condition.ConditionAND, items[:i] + [ half ] + items[i + 1:]) for half in split ])
+        elif type(node) == tuple and type(node[1]) == list and len(node[1]) > 1:
+            key, value = node
+            half = len(value) // 2
+            return (key, value[:half]), (key, value[half:])
+        elif type(node) == list and len(node) > 1:
+            half = len(node) // 2
+            return node[:half], node[half:]
+        return None
+
+    def conditionNode(self, cls, items):
+        """Condition of class cls with items, single items are returned directly"""
+        if len(items) == 1:
+            return items[0]
+        node = cls()
+        node.items = list(items)
+        return node
+
+    def countClauses(self, node):
+        """Number of elementary conditions in search node, each value of a list is one clause"""
+        if type(node) in (sigma.parser.condition.ConditionAND, sigma.parser.condition.ConditionOR):
+            return sum([ self.countClauses(item) for item in node.items ])
+        elif type(node) == sigma.parser.condition.ConditionNOT:
+            return self.countClauses(node.item)
+        elif type(node) == sigma.parser.condition.NodeSubexpression:
+            return self.countClauses(node.items)
+        elif type(node) == tuple and isinstance(node[1], SigmaValueListModifier):
+            return self.countValueListClauses(node[1].valuelist)
+        elif type(node) == tuple:
+            return self.countClauses(node[1]) if type(node[1]) == list else 1
+        elif type(node) == list:
+            return len(node)
+        else:
+            return 1
+
+    def countValueListClauses(self, valuelist):
+        """Number of clauses of a value list condition, all values are inlined by default"""
+        return len(valuelist)
+
+    def costReport(self, sigmaparser):
+        """
+        Cost factors of the conditions of a rule after rewriting by the backend and score weighted with costWeights as
+        tuple (score, factors). Factors of several conditions are added up.
+        """
+        factors = dict()
+        for parsed in sigmaparser.condparsed:
+            for factor, value in self.costFactors(sigmaparser, parsed, self.rewriteSearch(parsed.parsedSearch)).items():
+                factors[factor] = factors.get(factor, 0) + value
+        score = sum([ self.costWeights.get(factor, 0) * value for factor, value in factors.items() ])
+        return score, factors
+
+    def costFactors(self, sigmaparser, parsed, node):
+        """Dict of cost factor names and values of a condition, backends may add factors with own weights"""
+        values = list(self.searchValues(node))
+        return {
+                "leading_wildcards": len([ value for _, value in values if type(value) == str and value[:1] in ("*", "?") and len(value) > 1 ]),
+                "regexes": len([ value for _, value in values if isinstance(value, SigmaRegularExpressionModifier) ]),
+                "clauses": self.countClauses(node),
+                "unbound_keywords": len([ value for field, value in values if field is None ]),
+                "aggregation_risk": self.aggregationRisk(sigmaparser, parsed.parsedAgg),
+                "query_length": self.estimateQueryLength(node),
+                }
+
+    def searchValues(self, node):
+        """Iterate over (field, value) pairs of all values of a search, field is None for keywords"""
+        if type(node) in (sigma.parser.condition.ConditionAND, sigma.parser.condition.ConditionOR, list):
+            for item in node:
+                yield from self.searchValues(item)
+        elif type(node) == sigma.parser.condition.ConditionNOT:
+            yield from self.searchValues(node.item)
+        elif type(node) == sigma.parser.condition.NodeSubexpression:
+            yield from self.searchValues(node.items)
+        elif type(node) == tuple:
+            for value in node[1] if type(node[1]) == list else [ node[1] ]:
+                if value is not None:
+                    yield node[0], value
+        elif type(node) in (str, int) or isinstance(node, SigmaTypeModifier):
+            yield None, node
+
+    def aggregationRisk(self, sigmaparser, agg):
+        """
+        Cardinality risk of an aggregation: log10 of the estimated number of groups (cardinalities of the group and
+        aggregated field from the field statistics or defaultCardinality) plus one, doubled if the rule has no timeframe.
+        """
+        if agg is None:
+            return 0
+        risk = 1.0
+        for field in (agg.groupfield, agg.aggfield):
+            if field is not None:
+                cardinality = self.defaultCardinality
+                if self.fieldStatistics is not None:
+                    cardinality = self.fieldStatistics.fields.get(field, dict()).get("cardinality", cardinality)
+                risk += math.log10(max(cardinality, 1))
+        if "timeframe" not in sigmaparser.parsedyaml.get("detection", dict()):
+            risk *= 2
+        return risk
+
+    def estimateQueryLength(self, node):
+        """Estimated length of generated query of search node: field names and values with operators"""
+        return sum([ len(str(field or "")) + len(str(value)) + 5 for field, value in self.searchValues(node) ])
+
     def generateQuery(self, parsed):
         result = self.generateNode(parsed.parsedSearch)
         if parsed.parsedAgg:
@@ -145,6 +408,8 @@ class BaseBackend:
             return self.generateNotNULLValueNode(node)
         elif type(node) == sigma.parser.condition.NodeSubexpression:
             return self.generateSubexpressionNode(node)
+        elif type(node) == tuple and isinstance(node[1], SigmaValueListModifier):
+            return self.generateValueListNode(node)
         elif type(node) == tuple:
             return self.generateMapItemNode(node)
         elif type(node) in (str, int):
@@ -180,6 +445,15 @@ class BaseBackend:
     def generateTypedValueNode(self, node):
         raise NotImplementedError("Node type not implemented for this backend")
 
+    def generateValueListNode(self, node):
+        """Field compared with external value list. Backends without lookup constructs search for all values of the list."""
+        key, value = node
+        return self.generateMapItemNode((key, self.valueListValues(value.valuelist)))
+
+    def valueListValues(self, valuelist):
+        """Values of value list as Sigma values, list values are literal and wildcards are escaped"""
+        return [ self.reValueListEscape.sub(lambda m: m.group(1) * 2 + "\\" + m.group(2), value) for value in valuelist ]
+
     def generateNULLValueNode(self, node):
         raise NotImplementedError("Node type not implemented for this backend")
 
@@ -206,6 +480,7 @@ class SingleTextQueryBackend(RulenameCommentMixin, BaseBackend, QuoteCharMixin):
     """Base class for backends that generate one text-based expression from a Sigma rule"""
     identifier = "base-textquery"
     active = False
+    options = RulenameCommentMixin.options + BaseBackend.options
 
     # the following class variables define the generation and behavior of queries from a parse tree some are prefilled with default values that are quite usual
     andToken = None                     # Token used for linking expressions with logical AND
@@ -224,6 +499,13 @@ class SingleTextQueryBackend(RulenameCommentMixin, BaseBackend, QuoteCharMixin):
 
     sort_condition_lists = False        # Sort condition items for AND and OR conditions
 
+    def estimateQueryLength(self, node):
+        """Length of the generated search expression"""
+        try:
+            return len(self.generateNode(node) or "")
+        except (NotImplementedError, TypeError):
+            return super().estimateQueryLength(node)
+
     def generateANDNode(self, node):
         generated = [ self.generateNode(val) for val in node ]
         filtered = [ g for g in generated if g is not None ]
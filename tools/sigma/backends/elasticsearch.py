@@ -18,25 +18,49 @@ import json
 import re
 from fnmatch import fnmatch
 import sys
+import logging
 
 import sigma
-import yaml
 from sigma.parser.modifiers.type import SigmaRegularExpressionModifier
 from sigma.parser.condition import ConditionOR, ConditionAND, NodeSubexpression
 from .base import BaseBackend, SingleTextQueryBackend
-from .mixins import RulenameCommentMixin, MultiRuleOutputMixin
+from .mixins import RulenameCommentMixin, MultiRuleOutputMixin, ValueListMixin, StructuredOutputMixin
+from sigma.output import StructuredResult
 from .exceptions import NotSupportedError
 
+logger = logging.getLogger(__name__)
+
 class ElasticsearchWildcardHandlingMixin(object):
     """
     Determine field mapping to keyword subfields depending on existence of wildcards in search values. Further,
     provide configurability with backend parameters.
+
+    If an index mapping is given (the output of the _mapping API saved as JSON file), the field types from the
+    mapping are used instead of guessing: keyword fields are searched directly, text fields with phrases and
+    their keyword sub-fields with wildcards. Fields that are not contained in the mapping are handled as
+    without mapping.
+
+    Searches for values that are not bound to a field are restricted to the fields given by unbound_fields,
+    otherwise they search all fields. Queries with leading wildcards and searches in all fields are
+    expensive, warnings with a cost classification are emitted for them if an index mapping is used or
+    cost_warnings is set.
     """
     options = SingleTextQueryBackend.options + (
             ("keyword_field", "keyword", "Keyword sub-field name", None),
-            ("keyword_blacklist", None, "Fields that don't have a keyword subfield (wildcards * and ? allowed)", None)
+            ("keyword_blacklist", None, "Fields that don't have a keyword subfield (wildcards * and ? allowed)", None),
+            ("index_mapping", None, "JSON file with index mapping as returned by the _mapping API", None),
+            ("unbound_fields", None, "Fields that are searched for values not bound to a field, comma separated (default: all fields)", None),
+            ("cost_warnings", False, "Emit warnings for expensive queries (enabled by index_mapping)", None),
             )
     reContainsWildcard = re.compile("(?:(?<!\\\\)|\\\\\\\\)[*?]").search
+    reLeadingWildcard = re.compile("^[*?](?!$)").search
+    keywordTypes = { "keyword", "constant_keyword", "wildcard" }
+    costWeights = dict(BaseBackend.costWeights,
+            leading_wildcards=50,       # leading wildcards iterate over all terms of the field
+            keyword_wildcards=5,        # wildcard queries on keyword fields
+            text_wildcards=30,          # wildcard queries on analyzed text fields match single terms
+            all_field_searches=100,     # unbound values without unbound_fields search all fields
+            )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -45,6 +69,64 @@ class ElasticsearchWildcardHandlingMixin(object):
             self.blacklist = self.keyword_blacklist.split(",")
         except AttributeError:
             self.blacklist = list()
+        try:
+            self.unboundFields = self.unbound_fields.split(",")
+        except AttributeError:
+            self.unboundFields = None
+        self.fieldTypes = None
+        if self.index_mapping is not None:
+            self.fieldTypes = self.loadIndexMapping(self.index_mapping)
+            self.cost_warnings = True
+
+    @classmethod
+    def loadIndexMapping(cls, path):
+        """Load index mapping from JSON file into dict of field names (with sub-fields) to types."""
+        try:
+            with open(path, "r") as f:
+                mapping = json.load(f)
+        except (OSError, ValueError) as e:
+            print("Failed to load index mapping '%s': %s" % (path, str(e)), file=sys.stderr)
+            exit(1)
+
+        fieldTypes = dict()
+        if "mappings" in mapping or "properties" in mapping:     # mapping of single index instead of _mapping output
+            mapping = { "": mapping }
+        for index in mapping.values():
+            mappings = index.get("mappings", index)
+            if "properties" not in mappings:                     # Elasticsearch 6 mapping with type
+                mappings = next(iter(mappings.values()), {})
+            cls.collectFieldTypes(mappings.get("properties", {}), "", fieldTypes)
+        return fieldTypes
+
+    @classmethod
+    def collectFieldTypes(cls, properties, prefix, fieldTypes):
+        for name, field in properties.items():
+            path = prefix + name
+            if "properties" in field:
+                cls.collectFieldTypes(field["properties"], path + ".", fieldTypes)
+            else:
+                fieldTypes[path] = field.get("type", "object")
+                for subname, subfield in field.get("fields", {}).items():
+                    fieldTypes[path + "." + subname] = subfield.get("type", "object")
+
+    def warnCost(self, cost, description):
+        if self.cost_warnings:
+            logger.warning("%s cost: %s", cost, description)
+
+    def costFactors(self, sigmaparser, parsed, node):
+        factors = super().costFactors(sigmaparser, parsed, node)
+        factors["keyword_wildcards"] = factors["text_wildcards"] = 0
+        for field, value in self.searchValues(node):
+            if field is not None and self.containsWildcard(value):
+                factors["text_wildcards" if self.isTextField(field) else "keyword_wildcards"] += 1
+        factors["all_field_searches"] = factors["unbound_keywords"] if self.unboundFields is None else 0
+        return factors
+
+    def isTextField(self, fieldname):
+        """Wildcard searches of field are matched against analyzed terms because it has no keyword (sub-)field"""
+        if self.fieldTypes is not None and fieldname in self.fieldTypes:
+            return self.fieldTypes[fieldname] == "text" and not any([ field.startswith(fieldname + ".") and subtype in self.keywordTypes for field, subtype in self.fieldTypes.items() ])
+        return self.keyword_field != '' and any([ fnmatch(fieldname, pattern) for pattern in self.blacklist ])
 
     def containsWildcard(self, value):
         """Determine if value contains wildcard."""
@@ -54,29 +136,71 @@ class ElasticsearchWildcardHandlingMixin(object):
         else:
             return False
 
+    def containsLeadingWildcard(self, value):
+        if type(value) == list:
+            return any(map(self.containsLeadingWildcard, value))
+        elif type(value) == str:
+            return self.reLeadingWildcard(value)
+        else:
+            return False
+
     def fieldNameMapping(self, fieldname, value):
         """
         Determine if values contain wildcards. If yes, match on keyword field else on analyzed one.
         Decide if field value should be quoted based on the field name decision and store it in object property.
         """
-        if self.keyword_field == '':
+        if self.fieldTypes is not None and fieldname in self.fieldTypes:
+            fieldname = self.indexFieldNameMapping(fieldname, value)
+        elif self.keyword_field == '':
             self.matchKeyword = True
-            return fieldname
-
-        if not any([ fnmatch(fieldname, pattern) for pattern in self.blacklist ]) and (
+        elif not any([ fnmatch(fieldname, pattern) for pattern in self.blacklist ]) and (
                 type(value) == list and any(map(self.containsWildcard, value)) \
                 or self.containsWildcard(value)
                 ):
             self.matchKeyword = True
-            return fieldname + "." + self.keyword_field
+            fieldname = fieldname + "." + self.keyword_field
         else:
             self.matchKeyword = False
+
+        if self.matchKeyword and self.containsLeadingWildcard(value):
+            self.warnCost("high", "leading wildcard in search of field %s for %s" % (fieldname, value))
+        return fieldname
+
+    def indexFieldNameMapping(self, fieldname, value):
+        """Field name mapping by the type of the field in the index mapping."""
+        fieldtype = self.fieldTypes[fieldname]
+        wildcard = type(value) == list and any(map(self.containsWildcard, value)) or self.containsWildcard(value)
+        if fieldtype in self.keywordTypes:
+            self.matchKeyword = True
+            return fieldname
+        elif fieldtype == "text":
+            if wildcard:
+                self.matchKeyword = True
+                subfields = [ field for field, subtype in self.fieldTypes.items() if field.startswith(fieldname + ".") and subtype in self.keywordTypes and "." not in field[len(fieldname) + 1:] ]
+                if fieldname + "." + self.keyword_field in subfields:
+                    return fieldname + "." + self.keyword_field
+                elif subfields:
+                    return sorted(subfields)[0]
+                else:       # wildcard search in analyzed terms
+                    return fieldname
+            else:
+                self.matchKeyword = False
+                return fieldname
+        else:               # numeric, ip, date and other types are searched with the value
+            self.matchKeyword = wildcard
             return fieldname
 
+    def unboundFieldNames(self, value):
+        """Field names for search of value that is not bound to a field or None if all fields are searched."""
+        if self.unboundFields is None:
+            self.warnCost("very high", "search of %s in all fields" % (value,))
+        return self.unboundFields
+
 class ElasticsearchQuerystringBackend(ElasticsearchWildcardHandlingMixin, SingleTextQueryBackend):
     """Converts Sigma rule into Elasticsearch query string. Only searches, no aggregations."""
     identifier = "es-qs"
     active = True
+    clauseLimit = 1024          # default of indices.query.bool.max_clause_count
 
     reEscape = re.compile("([\s+\\-=!(){}\\[\\]^\"~:/]|(?<!\\\\)\\\\(?![*?\\\\])|\\\\u|&&|\\|\\|)")
     reClear = re.compile("[<>]")
@@ -94,6 +218,7 @@ class ElasticsearchQuerystringBackend(ElasticsearchWildcardHandlingMixin, Single
     notNullExpression = "_exists_:%s"
     mapExpression = "%s:%s"
     mapListsSpecialHandling = False
+    valueContext = False        # values are generated in context of a field or unbound field list
 
     def generateValueNode(self, node):
         result = super().generateValueNode(node)
@@ -110,6 +235,23 @@ class ElasticsearchQuerystringBackend(ElasticsearchWildcardHandlingMixin, Single
         if expression:
             return "(%s%s)" % (self.notToken, expression)
 
+    def generateNode(self, node):
+        """Search values that are not contained in a map item in the restricted unbound fields."""
+        if type(node) in (str, int) and not self.valueContext:
+            if self.unboundFields is not None:
+                unbound = ConditionOR()
+                unbound.add(node)
+                return self.generateSubexpressionNode(NodeSubexpression(unbound))
+            self.unboundFieldNames(node)
+        return super().generateNode(node)
+
+    def generateMapItemNode(self, node):
+        self.valueContext = True
+        try:
+            return super().generateMapItemNode(node)
+        finally:
+            self.valueContext = False
+
     def generateSubexpressionNode(self, node):
         """Check for search not bound to a field and restrict search to keyword fields"""
         nodetype = type(node.items)
@@ -126,31 +268,81 @@ class ElasticsearchQuerystringBackend(ElasticsearchWildcardHandlingMixin, Single
                 else:
                     newitems.append(item)
             newnode = NodeSubexpression(nodetype(None, None, *newitems))
-            self.matchKeyword = True
-            result = "\\*.keyword:" + super().generateSubexpressionNode(newnode)
+            fields = self.unboundFieldNames(newitems)
+            self.valueContext = True
+            if fields is None:
+                self.matchKeyword = True
+                result = "\\*.keyword:" + super().generateSubexpressionNode(newnode)
+            else:
+                results = list()
+                for field in fields:
+                    field = self.fieldNameMapping(field, newitems)
+                    results.append(self.mapExpression % (field, super().generateSubexpressionNode(newnode)))
+                result = self.subExpression % self.orToken.join(results)
+            self.valueContext = False
             self.matchKeyword = False       # one of the reasons why the converter needs some major overhaul
             return result
         else:
             return super().generateSubexpressionNode(node)
 
-class ElasticsearchDSLBackend(RulenameCommentMixin, ElasticsearchWildcardHandlingMixin, BaseBackend):
-    """ElasticSearch DSL backend"""
+class ElasticsearchDSLBackend(StructuredOutputMixin, RulenameCommentMixin, ElasticsearchWildcardHandlingMixin, ValueListMixin, MultiRuleOutputMixin, BaseBackend):
+    """
+    ElasticSearch DSL backend
+
+    Values are converted into the cheapest query type that matches the same documents as the
+    wildcard or match_phrase query of the value (query_types=optimized):
+
+    * Values without wildcards on keyword fields: term, grouped into one terms query per field.
+    * Values with only a trailing * on keyword fields: prefix. A single * is converted into exists.
+    * Numeric values on analyzed fields: term (a number is one token), grouped like above.
+    * match_phrase for other values on analyzed fields and wildcard for other values on keyword fields.
+
+    The option query_types=legacy generates one wildcard or match_phrase query per value.
+
+    The output format percolator generates a bulk request (NDJSON) with one percolator document per
+    rule condition that contains the query and the rule metadata in the object sigma. Events that
+    are percolated against the field sigma.query are matched by all rules with one request. The
+    output format percolator-mapping generates the index definition for these documents with
+    mappings of all fields used by the queries.
+
+    Large value lists are searched with a terms lookup of the values field of the document with the
+    list name as id in the list_index index.
+    """
     identifier = 'es-dsl'
     active = True
-    options = RulenameCommentMixin.options + ElasticsearchWildcardHandlingMixin.options + (
+    options = RulenameCommentMixin.options + BaseBackend.options + ElasticsearchWildcardHandlingMixin.options + ValueListMixin.options + (
         ("es", "http://localhost:9200", "Host and port of Elasticsearch instance", None),
-        ("output", "import", "Output format: import = JSON search request, curl = Shell script that do the search queries via curl", "output_type"),
+        ("output", "import", "Output format: import = JSON search request, curl = Shell script that do the search queries via curl, percolator = bulk request with percolator documents, percolator-mapping = percolator index definition", "output_type"),
+        ("percolator_index", "sigma-rules", "Index of percolator documents", None),
+        ("query_types", "optimized", "Query type selection: optimized = terms, prefix and exists queries where equivalent, legacy = wildcard and match_phrase queries only", None),
+        ("filter_context", False, "Use filter instead of must clauses in conjunctions", None),
+        ("list_index", "sigma-lists", "Index with value list documents for terms lookups", None),
     )
+    clauseLimit = 1024          # default of indices.query.bool.max_clause_count
+    outputTypeFormats = { "percolator": "ndjson" }
+    outputArray = "multiple"
     interval = None
     title = None
+    query_types = "optimized"
+    filter_context = False
+    reNumeric = re.compile("[0-9]+")
+    reWildcardToken = re.compile("\\\\.|[*?]|[^\\\\*?]+|\\\\", re.DOTALL)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.queries = []
+        self.percolatorFields = set()
+        self.percolatorIds = set()
+
+    @property
+    def percolator(self):
+        return self.output_type in ("percolator", "percolator-mapping")
 
-    def generate(self, sigmaparser):
+    def generateDocuments(self, sigmaparser):
         """Method is called for each sigma rule and receives the parsed rule (SigmaParser)"""
         self.title = sigmaparser.parsedyaml.setdefault("title", "")
+        if self.percolator:
+            return self.emitDocuments(self.generatePercolator(sigmaparser))
         logsource = sigmaparser.get_logsource()
         if logsource is None:
             self.indices = None
@@ -164,20 +356,129 @@ class ElasticsearchDSLBackend(RulenameCommentMixin, ElasticsearchWildcardHandlin
         except:
             pass
 
+        rulename = self.getRuleName(sigmaparser)
+        if self.streamResults:      # queries of previous rules were streamed or are incomplete after errors
+            self.queries = list()
+        first = len(self.queries)
         for parsed in sigmaparser.condparsed:
             self.generateBefore(parsed)
             self.generateQuery(parsed)
             self.generateAfter(parsed)
+        return self.emitDocuments([ self.queryDocument(query, rulename) for query in self.queries[first:] ])
+
+    def queryDocument(self, query, rulename):
+        """Search request of the query or the curl command line that executes it for the curl output type"""
+        if self.output_type == 'curl':
+            index = ''
+            if self.indices is not None and len(self.indices) == 1:
+                index = '%s/'%self.indices[0]
+            return StructuredResult("\\curl -XGET '%s/%s_search?pretty' -H 'Content-Type: application/json' -d'%s'" % (self.es, index, json.dumps(query, indent=2)), name=rulename, extension="sh")
+        return StructuredResult(query, name=rulename)
+
+    def generatePercolator(self, sigmaparser):
+        """
+        Generate bulk request actions with percolator documents that contain query and rule metadata for each
+        condition of the rule. The fields of the queries are collected for the percolator mapping.
+        """
+        rule = {
+                key: sigmaparser.parsedyaml[key]
+                for key in ("id", "title", "level", "tags")
+                if key in sigmaparser.parsedyaml
+                }
+        ruleid = rule.get("id", rule["title"])
+        documents = list()
+        for i, parsed in enumerate(sigmaparser.condparsed):
+            if parsed.parsedAgg:
+                raise NotSupportedError("Aggregations can't be evaluated by percolator queries")
+            docid = ruleid
+            if len(sigmaparser.condparsed) > 1:
+                docid = "%s-%d" % (ruleid, i + 1)
+            n = 1
+            while docid in self.percolatorIds:      # rule collections share the id of the rule
+                n += 1
+                docid = "%s-%d" % (ruleid, n)
+            self.percolatorIds.add(docid)
+            query = {"constant_score": {"filter": self.generateNode(parsed.parsedSearch)}}
+            self.collectQueryFields(query, self.percolatorFields)
+            if self.output_type == "percolator":
+                documents.append(StructuredResult({"index": {"_index": self.percolator_index, "_id": docid}}, name=ruleid))
+                documents.append({"sigma": {
+                    "query": query,
+                    "rule": rule,
+                    }})
+        return documents
+
+    def percolatorMapping(self):
+        """
+        Index definition for the percolator documents. The percolator query and the rule metadata are
+        contained in the object sigma, events are percolated against the field sigma.query. All fields
+        that are used in queries are mapped like strings by the dynamic mapping of Elasticsearch (text
+        with keyword sub-field), keyword sub-fields are mapped as keyword.
+        """
+        properties = {
+                "sigma": {"properties": {
+                    "query": {"type": "percolator"},
+                    "rule": {"properties": {
+                        "id": {"type": "keyword"},
+                        "title": {"type": "text"},
+                        "level": {"type": "keyword"},
+                        "tags": {"type": "keyword"},
+                        }},
+                    }},
+                }
+        for field in sorted(self.percolatorFields):
+            if self.keyword_field and field.endswith("." + self.keyword_field):
+                field = field[:-len(self.keyword_field) - 1]
+            path = field.split(".")
+            target = properties
+            for name in path[:-1]:
+                target = target.setdefault(name, {"properties": {}})
+                if "properties" not in target:
+                    raise NotSupportedError("Field '%s' can't be mapped because '%s' is also used as value field" % (field, name))
+                target = target["properties"]
+            if "properties" in target.get(path[-1], {}):
+                raise NotSupportedError("Field '%s' can't be mapped because it is also used as object field" % field)
+            target.setdefault(path[-1], {
+                "type": "text",
+                "fields": {self.keyword_field or "keyword": {"type": "keyword"}},
+                })
+        return {"mappings": {"properties": properties}}
+
+    @classmethod
+    def collectQueryFields(cls, query, fields):
+        """Collect names of all fields that are used in query into set fields."""
+        if type(query) == list:
+            for item in query:
+                cls.collectQueryFields(item, fields)
+        elif type(query) == dict:
+            for querytype, value in query.items():
+                if querytype in ("bool", "constant_score"):
+                    for item in value.values():
+                        cls.collectQueryFields(item, fields)
+                elif querytype == "exists":
+                    fields.add(value["field"])
+                elif querytype == "multi_match":
+                    fields.update(value["fields"])
+                else:       # term level and full text queries have the field name as key
+                    fields.update(value.keys())
 
     def generateQuery(self, parsed):
         self.queries[-1]['query']['constant_score']['filter'] = self.generateNode(parsed.parsedSearch)
         if parsed.parsedAgg:
             self.generateAggregation(parsed.parsedAgg)
 
+    @property
+    def conjunctionClause(self):
+        if self.filter_context:
+            return 'filter'
+        else:
+            return 'must'
+
     def generateANDNode(self, node):
-        andNode = {'bool': {'must': []}}
+        clause = self.conjunctionClause
+        andNode = {'bool': {clause: []}}
         for val in node:
-            andNode['bool']['must'].append(self.generateNode(val))
+            andNode['bool'][clause].append(self.generateNode(val))
         return andNode
 
     def generateORNode(self, node):
@@ -210,38 +511,84 @@ class ElasticsearchDSLBackend(RulenameCommentMixin, ElasticsearchWildcardHandlin
     def generateMapItemNode(self, node):
         key, value = node
         if type(value) is list:
-            res = {'bool': {'should': []}}
-            for v in value:
-                key_mapped = self.fieldNameMapping(key, v)
-                if self.matchKeyword:   # searches against keyowrd fields are wildcard searches, phrases otherwise
-                    queryType = 'wildcard'
-                    value_cleaned = self.escapeSlashes(self.cleanValue(str(v)))
-                else:
-                    queryType = 'match_phrase'
-                    value_cleaned = self.cleanValue(str(v))
-
-                res['bool']['should'].append({queryType: {key_mapped: value_cleaned}})
-            return res
+            queries = [ self.generateValueQuery(key, v) for v in value ]
+            if self.query_types == "legacy":
+                return {'bool': {'should': queries}}
+            queries = self.groupTermQueries(queries)
+            if len(queries) == 1:
+                return queries[0]
+            return {'bool': {'should': queries}}
         elif value is None:
             key_mapped = self.fieldNameMapping(key, value)
             return { "bool": { "must_not": { "exists": { "field": key_mapped } } } }
         elif type(value) in (str, int):
-            key_mapped = self.fieldNameMapping(key, value)
-            if self.matchKeyword:   # searches against keyowrd fields are wildcard searches, phrases otherwise
-                queryType = 'wildcard'
-                value_cleaned = self.escapeSlashes(self.cleanValue(str(value)))
-            else:
-                queryType = 'match_phrase'
-                value_cleaned = self.cleanValue(str(value))
-            return {queryType: {key_mapped: value_cleaned}}
+            return self.generateValueQuery(key, value)
         elif isinstance(value, SigmaRegularExpressionModifier):
             key_mapped = self.fieldNameMapping(key, value)
             return { 'regexp': { key_mapped: str(value) } }
         else:
             raise TypeError("Map values must be strings, numbers, lists, null or regular expression, not " + str(type(value)))
 
+    def generateValueListLookup(self, key, valuelist):
+        """Terms lookup of list values, which are exact values like values without wildcards that are searched in keyword fields"""
+        key_mapped = self.fieldNameMapping(key, "*")
+        return {'terms': {key_mapped: {'index': self.list_index, 'id': valuelist.name, 'path': 'values'}}}
+
+    def generateValueQuery(self, key, value):
+        """Generate query for one value: searches against keyword fields are wildcard searches, phrases otherwise."""
+        key_mapped = self.fieldNameMapping(key, value)
+        if self.matchKeyword:
+            value_cleaned = self.escapeSlashes(self.cleanValue(str(value)))
+            if self.query_types == "legacy":
+                return {'wildcard': {key_mapped: value_cleaned}}
+            return self.generateKeywordQuery(key_mapped, value_cleaned)
+        else:
+            value_cleaned = self.cleanValue(str(value))
+            if self.query_types != "legacy" and self.reNumeric.fullmatch(value_cleaned):
+                return {'term': {key_mapped: value_cleaned}}
+            return {'match_phrase': {key_mapped: value_cleaned}}
+
+    def generateKeywordQuery(self, field, wildcard):
+        """
+        Return cheapest query that is equivalent to a wildcard query with the given pattern (in
+        Elasticsearch wildcard syntax, backslash escapes the next character) on a keyword field.
+        """
+        tokens = self.reWildcardToken.findall(wildcard)
+        wildcards = [ i for i, token in enumerate(tokens) if token in ("*", "?") ]
+        literal = "".join([ token[1:] if token.startswith("\\") and len(token) == 2 else token for token in tokens if token not in ("*", "?") ])
+        if len(wildcards) == 0:
+            return {'term': {field: literal}}
+        elif wildcards == [ len(tokens) - 1 ] and tokens[-1] == "*":
+            if literal == "":
+                return {'exists': {'field': field}}
+            return {'prefix': {field: literal}}
+        else:
+            return {'wildcard': {field: wildcard}}
+
+    def groupTermQueries(self, queries):
+        """Merge term queries on the same field into one terms query at the position of the first one."""
+        terms = dict()
+        for query in queries:
+            if 'term' in query:
+                (field, value), = query['term'].items()
+                terms.setdefault(field, []).append(value)
+        result = list()
+        for query in queries:
+            if 'term' in query:
+                (field, value), = query['term'].items()
+                values = terms.pop(field, None)
+                if values is None:          # already merged into previous terms query
+                    continue
+                elif len(values) == 1:
+                    result.append(query)
+                else:
+                    result.append({'terms': {field: values}})
+            else:
+                result.append(query)
+        return result
+
     def generateValueNode(self, node):
-        return {'multi_match': {'query': node, 'fields': [], 'type': 'phrase'}}
+        return {'multi_match': {'query': node, 'fields': self.unboundFieldNames(node) or [], 'type': 'phrase'}}
 
     def generateNULLValueNode(self, node):
         return {'bool': {'must_not': {'exists': {'field': node.item}}}}
@@ -334,35 +681,24 @@ class ElasticsearchDSLBackend(RulenameCommentMixin, ElasticsearchWildcardHandlin
         if self.sigmaconfig.config and 'dateField' in self.sigmaconfig.config:
             dateField = self.sigmaconfig.config['dateField']
         if self.interval:
+            clause = self.conjunctionClause
             if 'bool' not in self.queries[-1]['query']['constant_score']['filter']:
                 saved_simple_query = self.queries[-1]['query']['constant_score']['filter']
-                self.queries[-1]['query']['constant_score']['filter'] = {'bool': {'must': []}}
+                self.queries[-1]['query']['constant_score']['filter'] = {'bool': {clause: []}}
                 if len(saved_simple_query.keys()) > 0:
-                    self.queries[-1]['query']['constant_score']['filter']['bool']['must'].append(saved_simple_query)
-            if 'must' not in self.queries[-1]['query']['constant_score']['filter']['bool']:
-                self.queries[-1]['query']['constant_score']['filter']['bool']['must'] = []
+                    self.queries[-1]['query']['constant_score']['filter']['bool'][clause].append(saved_simple_query)
+            if clause not in self.queries[-1]['query']['constant_score']['filter']['bool']:
+                self.queries[-1]['query']['constant_score']['filter']['bool'][clause] = []
 
-            self.queries[-1]['query']['constant_score']['filter']['bool']['must'].append({'range': {dateField: {'gte': 'now-%s'%self.interval}}})
+            self.queries[-1]['query']['constant_score']['filter']['bool'][clause].append({'range': {dateField: {'gte': 'now-%s'%self.interval}}})
 
-    def finalize(self):
-        """
-        Is called after the last file was processed with generate(). The right place if this backend is not intended to
-        look isolated at each rule, but generates an output which incorporates multiple rules, e.g. dashboards.
-        """
-        index = ''
-        if self.indices is not None and len(self.indices) == 1:
-            index = '%s/'%self.indices[0]
+    def finalizeDocuments(self):
+        """Percolator index definition, search requests and percolator documents are emitted by generate()."""
+        if self.output_type == 'percolator-mapping':
+            return [ StructuredResult(self.percolatorMapping(), name="percolator-mapping") ]
+        return list()
 
-        if self.output_type == 'curl':
-            for query in self.queries:
-                return "\curl -XGET '%s/%s_search?pretty' -H 'Content-Type: application/json' -d'%s'" % (self.es, index, json.dumps(query, indent=2))
-        else:
-            if len(self.queries) == 1:
-                return json.dumps(self.queries[0], indent=2)
-            else:
-                return json.dumps(self.queries, indent=2)
-
-class KibanaBackend(ElasticsearchQuerystringBackend, MultiRuleOutputMixin):
+class KibanaBackend(StructuredOutputMixin, ElasticsearchQuerystringBackend, MultiRuleOutputMixin):
     """Converts Sigma rule into Kibana JSON Configuration files (searches only)."""
     identifier = "kibana"
     active = True
@@ -373,12 +709,9 @@ class KibanaBackend(ElasticsearchQuerystringBackend, MultiRuleOutputMixin):
             ("prefix", "Sigma: ", "Title prefix of Sigma queries", None),
             )
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.kibanaconf = list()
-        self.indexsearch = set()
+    outputArray = True
 
-    def generate(self, sigmaparser):
+    def generateDocuments(self, sigmaparser):
         description = sigmaparser.parsedyaml.setdefault("description", "")
 
         columns = list()
@@ -398,6 +731,7 @@ class KibanaBackend(ElasticsearchQuerystringBackend, MultiRuleOutputMixin):
         if len(indices) == 0:   # fallback if no index is given
             indices = ["*"]
 
+        documents = list()
         for parsed in sigmaparser.condparsed:
             result = self.generateNode(parsed.parsedSearch)
 
@@ -408,15 +742,7 @@ class KibanaBackend(ElasticsearchQuerystringBackend, MultiRuleOutputMixin):
                 else:
                     title = self.prefix + sigmaparser.parsedyaml["title"]
 
-                self.indexsearch.add(
-                        "export {indexvar}=$(curl -s '{es}/{index}/_search?q=index-pattern.title:{indexpattern}' | jq -r '.hits.hits[0]._id | ltrimstr(\"index-pattern:\")')".format(
-                            es=self.es,
-                            index=self.index,
-                            indexpattern=index.replace("*", "\\*"),
-                            indexvar=self.index_variable_name(index)
-                            )
-                        )
-                self.kibanaconf.append({
+                documents.append(self.kibanaDocument({
                         "_id": rulename,
                         "_type": "search",
                         "_source": {
@@ -446,40 +772,46 @@ class KibanaBackend(ElasticsearchQuerystringBackend, MultiRuleOutputMixin):
                                     }
                             }
                         }
-                    })
+                    }, rulename))
+        return self.emitDocuments(documents)
 
-    def finalize(self):
+    def kibanaDocument(self, item, rulename):
+        """Saved search for the import output type or shell script that looks up the index pattern and imports it"""
+        searchSource = item['_source']['kibanaSavedObjectMeta']['searchSourceJSON']
         if self.output_type == "import":        # output format that can be imported via Kibana UI
-            for item in self.kibanaconf:    # JSONize kibanaSavedObjectMeta.searchSourceJSON
-                item['_source']['kibanaSavedObjectMeta']['searchSourceJSON'] = json.dumps(item['_source']['kibanaSavedObjectMeta']['searchSourceJSON'])
-            return json.dumps(self.kibanaconf, indent=2)
-        elif self.output_type == "curl":
-            for item in self.indexsearch:
-                return item
-            for item in self.kibanaconf:
-                item['_source']['kibanaSavedObjectMeta']['searchSourceJSON']['index'] = "$" + self.index_variable_name(item['_source']['kibanaSavedObjectMeta']['searchSourceJSON']['index'])   # replace index pattern with reference to variable that will contain Kibana index UUID at script runtime
-                item['_source']['kibanaSavedObjectMeta']['searchSourceJSON'] = json.dumps(item['_source']['kibanaSavedObjectMeta']['searchSourceJSON'])     # Convert it to JSON string as expected by Kibana
-                item['_source']['kibanaSavedObjectMeta']['searchSourceJSON'] = item['_source']['kibanaSavedObjectMeta']['searchSourceJSON'].replace("\\", "\\\\")      # Add further escaping for escaped quotes for shell
-                return "curl -s -XPUT -H 'Content-Type: application/json' --data-binary @- '{es}/{index}/doc/{doc_id}' <<EOF\n{doc}\nEOF".format(
-                        es=self.es,
-                        index=self.index,
-                        doc_id="search:" + item['_id'],
-                        doc=json.dumps({
-                            "type": "search",
-                            "search": item['_source']
-                            }, indent=2)
-                        )
+            item['_source']['kibanaSavedObjectMeta']['searchSourceJSON'] = json.dumps(searchSource)     # Kibana expects searchSourceJSON as string
+            return StructuredResult(item, name=rulename)
+        elif self.output_type == "curl":        # each script looks up the index pattern, so it can be deployed alone
+            index = searchSource['index']
+            searchSource['index'] = "$" + self.index_variable_name(index)   # replace index pattern with reference to variable that will contain Kibana index UUID at script runtime
+            item['_source']['kibanaSavedObjectMeta']['searchSourceJSON'] = json.dumps(searchSource).replace("\\", "\\\\")      # Convert it to JSON string as expected by Kibana and add further escaping for escaped quotes for shell
+            indexsearch = "export {indexvar}=$(curl -s '{es}/{index}/_search?q=index-pattern.title:{indexpattern}' | jq -r '.hits.hits[0]._id | ltrimstr(\"index-pattern:\")')".format(
+                    es=self.es,
+                    index=self.index,
+                    indexpattern=index.replace("*", "\\*"),
+                    indexvar=self.index_variable_name(index)
+                    )
+            return StructuredResult(indexsearch + "\n" + "curl -s -XPUT -H 'Content-Type: application/json' --data-binary @- '{es}/{index}/doc/{doc_id}' <<EOF\n{doc}\nEOF".format(
+                    es=self.es,
+                    index=self.index,
+                    doc_id="search:" + item['_id'],
+                    doc=json.dumps({
+                        "type": "search",
+                        "search": item['_source']
+                        }, indent=2)
+                    ), name=rulename, extension="sh")
         else:
             raise NotImplementedError("Output type '%s' not supported" % self.output_type)
 
     def index_variable_name(self, index):
         return "index_" + index.replace("-", "__").replace("*", "X")
 
-class XPackWatcherBackend(ElasticsearchQuerystringBackend, MultiRuleOutputMixin):
+class XPackWatcherBackend(StructuredOutputMixin, ElasticsearchQuerystringBackend, MultiRuleOutputMixin):
     """Converts Sigma Rule into X-Pack Watcher JSON for alerting"""
     identifier = "xpack-watcher"
     active = True
     supported_alert_methods = {'email', 'webhook','index'}
+    outputTypeFormats = { "json": "ndjson" }
     options = ElasticsearchQuerystringBackend.options + (
             ("output", "curl", "Output format: curl = Shell script that imports queries in Watcher index with curl", "output_type"),
             ("es", "localhost:9200", "Host and port of Elasticsearch instance", None),
@@ -503,8 +835,11 @@ class XPackWatcherBackend(ElasticsearchQuerystringBackend, MultiRuleOutputMixin)
         ("http_pport", None, "Webhook Proxy port", None),
             # Options for Index Action
             ("index", "<log2alert-{now/d}>","Index name used to add the alerts", None), #by default it creates a new index every day
-            ("type", "_doc","Index Type used to add the alerts", None)
-        
+            ("type", "_doc","Index Type used to add the alerts", None),
+
+            # Options for fused watchers
+            ("fuse", False, "Fuse rules with same indices, interval and aggregation into one watcher with a filters aggregation", None),
+            ("fuse_max_rules", 50, "Maximum number of rules per fused watcher", None),
             )
     watcher_urls = {
             "watcher": "_watcher",
@@ -513,10 +848,10 @@ class XPackWatcherBackend(ElasticsearchQuerystringBackend, MultiRuleOutputMixin)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.watcher_alert = dict()
         self.url_prefix = self.watcher_urls[self.watcher_url]
+        self.fusedRules = dict()
 
-    def generate(self, sigmaparser):
+    def generateDocuments(self, sigmaparser):
         # get the details if this alert occurs
         title = sigmaparser.parsedyaml.setdefault("title", "")
         description = sigmaparser.parsedyaml.setdefault("description", "")
@@ -529,75 +864,28 @@ class XPackWatcherBackend(ElasticsearchQuerystringBackend, MultiRuleOutputMixin)
         
         # creating condition
         indices = sigmaparser.get_logsource().index
-        # How many results to be returned. Usually 0 but for index action we need it.
-        size = 0
+        if self.fuse and 'index' in self.alert_methods.split(','):
+            raise NotSupportedError("Index action is not supported by fused watchers")
 
+        documents = list()
         for condition in sigmaparser.condparsed:
             rulename = self.getRuleName(sigmaparser)
             result = self.generateNode(condition.parsedSearch)
-            agg = {}
-            alert_value_location = ""
-            try:
-                condition_value = int(condition.parsedAgg.condition)
-                min_doc_count = {}
-                if condition.parsedAgg.cond_op == ">":
-                    alert_condition = { "gt": condition_value }
-                    min_doc_count = { "min_doc_count": condition_value + 1 }
-                    order = "desc"
-                elif condition.parsedAgg.cond_op == ">=":
-                    alert_condition = { "gte": condition_value }
-                    min_doc_count = { "min_doc_count": condition_value }
-                    order = "desc"
-                elif condition.parsedAgg.cond_op == "<":
-                    alert_condition = { "lt": condition_value }
-                    order = "asc"
-                elif condition.parsedAgg.cond_op == "<=":
-                    alert_condition = { "lte": condition_value }
-                    order = "asc"
-                else:
-                    alert_condition = {"not_eq": 0}
-
-                agg_iter = list()
-                if condition.parsedAgg.aggfield is not None:    # e.g. ... count(aggfield) ...
-                    agg = {
-                            "aggs": {
-                                "agg": {
-                                    "terms": {
-                                        "field": condition.parsedAgg.aggfield + ".keyword",
-                                        "size": 10,
-                                        "order": {
-                                            "_count": order
-                                            },
-                                        **min_doc_count
-                                        },
-                                    **agg
-                                    }
-                                }
-                            }
-                    alert_value_location = "agg.buckets.0."
-                    agg_iter.append("agg.buckets")
-                if condition.parsedAgg.groupfield is not None:    # e.g. ... by groupfield ...
-                    agg = {
-                            "aggs": {
-                                "by": {
-                                    "terms": {
-                                        "field": condition.parsedAgg.groupfield + ".keyword",
-                                        "size": 10,
-                                        "order": {
-                                            "_count": order
-                                            },
-                                        **min_doc_count
-                                        },
-                                    **agg
-                                    }
-                                }
-                            }
-                    alert_value_location = "by.buckets.0." + alert_value_location
-                    agg_iter.append("by.buckets")
-            except KeyError:
-                alert_condition = {"not_eq": 0}
-            except AttributeError:
-                alert_condition = {"not_eq": 0}
+            agg, alert_value_location, alert_condition, agg_iter = self.generateWatcherAggregation(condition.parsedAgg)
+
+            if self.fuse:       # collect rule for fused watcher that is generated in finalize()
+                key = (tuple(indices), interval, json.dumps(agg, sort_keys=True))
+                self.fusedRules.setdefault(key, []).append({
+                    "rulename": rulename,
+                    "title": title,
+                    "description": description,
+                    "tags": tags,
+                    "query": result,
+                    "alert_value_location": alert_value_location,
+                    "alert_condition": alert_condition,
+                    "agg_iter": agg_iter,
+                    })
+                continue
 
             if agg != {}:
                 alert_value_location = "ctx.payload.aggregations." + alert_value_location + "doc_count"
@@ -624,102 +912,9 @@ class XPackWatcherBackend(ElasticsearchQuerystringBackend, MultiRuleOutputMixin)
                 action_body += "{{/ctx.payload.hits.hits}}"
 
             # Building the action
-            action_subject = "Sigma Rule '%s'" % title
-            try:
-                eaction={} #email action
-                waction={} #webhook action
-                iaction={} #index action
-                action={} 
-                alert_methods = self.alert_methods.split(',')
-                if 'email' in alert_methods:
-                    # mail notification if mail address is given
-                    email = self.mail
-                    eaction = {
-                        "send_email": {
-                                "email": {
-                                "to": email,
-                                "subject": action_subject,
-                                    "body": action_body,
-                                "attachments": {
-                                    "data.json": {
-                                            "data": {
-                                            "format": "json"
-                                                }
-                                        }
-                                    }
-                                    }
-                            }
-                            }
-                if 'webhook' in alert_methods: # WebHook Action. Sending metadata to a webservice. Added timestamp to metadata
-                    http_scheme = self.http_scheme
-                    http_host = self.http_host
-                    http_port = self.http_port
-                    http_uri_path = self.http_uri_path
-                    http_method = self.http_method
-                    http_phost = self.http_phost
-                    http_pport = self.http_pport
-                    http_user = self.http_user
-                    http_pass = self.http_pass
-                    waction = {
-            "httppost":{
-                            "transform":{
-                                "script": "ctx.metadata.timestamp=ctx.trigger.scheduled_time;" 
-                                },
-                            "webhook":{
-                            "scheme"  : http_scheme,
-                            "host"    : http_host,
-                            "port"    : int(http_port),
-                            "method"  : http_method,
-                                "path"    : http_uri_path,
-                            "params"  : {},
-                            "headers" : {"Content-Type"                      : "application/json"},
-                            "body"    : "{{#toJson}}ctx.metadata{{/toJson}}"
-                            }
-            }
-            }
-                    if (http_user) and (http_pass):
-                        auth={
-                            "basic":{
-                                "username":http_user,
-                                "password":http_pass
-                            }
-                        }
-                        waction['httppost']['webhook']['auth']={}
-                        waction['httppost']['webhook']['auth']=auth
-
-                    if (http_phost) and (http_pport): #As defined in documentation
-                        waction['httppost']['webhook']['proxy']={}
-                        waction['httppost']['webhook']['proxy']['host']=http_phost
-                        waction['httppost']['webhook']['proxy']['port']=http_pport
-
-                if 'index' in alert_methods: #Index Action. Adding metadata to actual events and send them in another index
-                    index = self.index
-                    dtype = self.type
-                    size=1000 #I presume it will not be more than 1000 events detected
-                    iaction = {
-                            "elastic":{
-                                "transform":{ #adding title, description, tags on the event 
-                                    "script": "ctx.payload.transform = [];for (int j=0;j<ctx.payload.hits.total;j++){ctx.payload.hits.hits[j]._source.alerttimestamp=ctx.trigger.scheduled_time;ctx.payload.hits.hits[j]._source.alerttitle=ctx.metadata.title;ctx.payload.hits.hits[j]._source.alertquery=ctx.metadata.query;ctx.payload.hits.hits[j]._source.alertdescription=ctx.metadata.description;ctx.payload.hits.hits[j]._source.tags=ctx.metadata.tags;ctx.payload.transform.add(ctx.payload.hits.hits[j]._source)} return ['_doc': ctx.payload.transform];"
-                                },
-                                "index":{
-                                    "index": index,
-                                    "doc_type":dtype 
-                                }
-                            }
-                    }
+            action, size = self.generateWatcherActions(title, action_body)
 
-                action = {**eaction,**waction, **iaction}
-
-            except KeyError as k:    # no mail address given, generate log action
-                action = {
-                        "logging-action": {
-                            "logging": {
-                                "text": action_subject + ": " + action_body
-                                }
-                            }
-                        }
-
-            self.watcher_alert[rulename] = {
+            watcher = {
                               "metadata": {
                                   "title": title,
                                   "description": description,
@@ -767,23 +962,305 @@ class XPackWatcherBackend(ElasticsearchQuerystringBackend, MultiRuleOutputMixin)
                               },
                               "actions": { **action }
                             }
+            documents.append(self.watcherDocument(rulename, watcher))
+        return self.emitDocuments(documents)
 
-    def finalize(self):
-        result = ""
-        for rulename, rule in self.watcher_alert.items():
-            if self.output_type == "plain":     # output request line + body
-                result += "PUT %s/watch/%s\n%s\n" % (self.url_prefix, rulename, json.dumps(rule, indent=2))
-            elif self.output_type == "curl":      # output curl command line
-                result += "curl -s -XPUT -H 'Content-Type: application/json' --data-binary @- %s/%s/watch/%s <<EOF\n%s\nEOF\n" % (self.es, self.url_prefix, rulename, json.dumps(rule, indent=2))
-            elif self.output_type == "json":    # output compressed watcher json, one per line
-                result += json.dumps(rule) + "\n"
+    def generateWatcherAggregation(self, parsedAgg):
+        """
+        Generate aggregations for the aggregation of a rule condition. Returns the aggregation part of the search
+        request body, the location of the alert value relative to the aggregations, the watcher compare condition
+        and the list of relative bucket paths for iteration in the action body.
+        """
+        agg = {}
+        alert_value_location = ""
+        agg_iter = list()
+        try:
+            condition_value = int(parsedAgg.condition)
+            min_doc_count = {}
+            if parsedAgg.cond_op == ">":
+                alert_condition = { "gt": condition_value }
+                min_doc_count = { "min_doc_count": condition_value + 1 }
+                order = "desc"
+            elif parsedAgg.cond_op == ">=":
+                alert_condition = { "gte": condition_value }
+                min_doc_count = { "min_doc_count": condition_value }
+                order = "desc"
+            elif parsedAgg.cond_op == "<":
+                alert_condition = { "lt": condition_value }
+                order = "asc"
+            elif parsedAgg.cond_op == "<=":
+                alert_condition = { "lte": condition_value }
+                order = "asc"
             else:
-                raise NotImplementedError("Output type '%s' not supported" % self.output_type)
-        return result
+                alert_condition = {"not_eq": 0}
+
+            if parsedAgg.aggfield is not None:    # e.g. ... count(aggfield) ...
+                agg = {
+                        "aggs": {
+                            "agg": {
+                                "terms": {
+                                    "field": parsedAgg.aggfield + ".keyword",
+                                    "size": 10,
+                                    "order": {
+                                        "_count": order
+                                        },
+                                    **min_doc_count
+                                    },
+                                **agg
+                                }
+                            }
+                        }
+                alert_value_location = "agg.buckets.0."
+                agg_iter.append("agg.buckets")
+            if parsedAgg.groupfield is not None:    # e.g. ... by groupfield ...
+                agg = {
+                        "aggs": {
+                            "by": {
+                                "terms": {
+                                    "field": parsedAgg.groupfield + ".keyword",
+                                    "size": 10,
+                                    "order": {
+                                        "_count": order
+                                        },
+                                    **min_doc_count
+                                    },
+                                **agg
+                                }
+                            }
+                        }
+                alert_value_location = "by.buckets.0." + alert_value_location
+                agg_iter.append("by.buckets")
+        except KeyError:
+            alert_condition = {"not_eq": 0}
+        except AttributeError:
+            alert_condition = {"not_eq": 0}
+
+        return agg, alert_value_location, alert_condition, agg_iter
+
+    def generateWatcherActions(self, title, action_body):
+        """Generate watcher actions for the configured alert methods. Returns actions and size of search request."""
+        # How many results to be returned. Usually 0 but for index action we need it.
+        size = 0
+        action_subject = "Sigma Rule '%s'" % title
+        try:
+            eaction={} #email action
+            waction={} #webhook action
+            iaction={} #index action
+            action={} 
+            alert_methods = self.alert_methods.split(',')
+            if 'email' in alert_methods:
+                # mail notification if mail address is given
+                email = self.mail
+                eaction = {
+                    "send_email": {
+                            "email": {
+                            "to": email,
+                            "subject": action_subject,
+                                "body": action_body,
+                            "attachments": {
+                                "data.json": {
+                                        "data": {
+                                        "format": "json"
+                                            }
+                                    }
+                                }
+                                }
+                        }
+                        }
+            if 'webhook' in alert_methods: # WebHook Action. Sending metadata to a webservice. Added timestamp to metadata
+                http_scheme = self.http_scheme
+                http_host = self.http_host
+                http_port = self.http_port
+                http_uri_path = self.http_uri_path
+                http_method = self.http_method
+                http_phost = self.http_phost
+                http_pport = self.http_pport
+                http_user = self.http_user
+                http_pass = self.http_pass
+                waction = {
+        "httppost":{
+                        "transform":{
+                            "script": "ctx.metadata.timestamp=ctx.trigger.scheduled_time;" 
+                            },
+                        "webhook":{
+                        "scheme"  : http_scheme,
+                        "host"    : http_host,
+                        "port"    : int(http_port),
+                        "method"  : http_method,
+                            "path"    : http_uri_path,
+                        "params"  : {},
+                        "headers" : {"Content-Type"                      : "application/json"},
+                        "body"    : "{{#toJson}}ctx.metadata{{/toJson}}"
+                        }
+        }
+        }
+                if (http_user) and (http_pass):
+                    auth={
+                        "basic":{
+                            "username":http_user,
+                            "password":http_pass
+                        }
+                    }
+                    waction['httppost']['webhook']['auth']={}
+                    waction['httppost']['webhook']['auth']=auth
+
+                if (http_phost) and (http_pport): #As defined in documentation
+                    waction['httppost']['webhook']['proxy']={}
+                    waction['httppost']['webhook']['proxy']['host']=http_phost
+                    waction['httppost']['webhook']['proxy']['port']=http_pport
+
+            if 'index' in alert_methods: #Index Action. Adding metadata to actual events and send them in another index
+                index = self.index
+                dtype = self.type
+                size=1000 #I presume it will not be more than 1000 events detected
+                iaction = {
+                        "elastic":{
+                            "transform":{ #adding title, description, tags on the event 
+                                "script": "ctx.payload.transform = [];for (int j=0;j<ctx.payload.hits.total;j++){ctx.payload.hits.hits[j]._source.alerttimestamp=ctx.trigger.scheduled_time;ctx.payload.hits.hits[j]._source.alerttitle=ctx.metadata.title;ctx.payload.hits.hits[j]._source.alertquery=ctx.metadata.query;ctx.payload.hits.hits[j]._source.alertdescription=ctx.metadata.description;ctx.payload.hits.hits[j]._source.tags=ctx.metadata.tags;ctx.payload.transform.add(ctx.payload.hits.hits[j]._source)} return ['_doc': ctx.payload.transform];"
+                            },
+                            "index":{
+                                "index": index,
+                                "doc_type":dtype 
+                            }
+                        }
+                }
+
+            action = {**eaction,**waction, **iaction}
+
+        except KeyError as k:    # no mail address given, generate log action
+            action = {
+                    "logging-action": {
+                        "logging": {
+                            "text": action_subject + ": " + action_body
+                            }
+                        }
+                    }
+
+        return action, size
+
+    def generateFusedWatchers(self):
+        """
+        Generate one watcher per group of rules with same indices, interval and aggregation. The watcher searches
+        once with a filters aggregation that contains one bucket per rule, the actions of each rule are executed if
+        the condition of the rule matches the bucket of the rule.
+        """
+        dateField = self.sigmaconfig.config.get("dateField", "timestamp")
+        max_rules = int(self.fuse_max_rules)
+        watchers = dict()
+        for (indices, interval, agg), rules in self.fusedRules.items():
+            agg = json.loads(agg)
+            for n, first in enumerate(range(0, len(rules), max_rules)):
+                watchername = re.sub("[^a-zA-Z0-9_-]+", "_", "sigma-fused-%s-%s" % ("-".join(indices) or "all", interval))
+                while "%s-%d" % (watchername, n + 1) in watchers:     # indices that only differ by special characters
+                    watchername += "_"
+                watchername = "%s-%d" % (watchername, n + 1)
+                filters = dict()
+                metadata = dict()
+                actions = dict()
+                for rule in rules[first:first + max_rules]:
+                    bucket = rule["rulename"].replace(".", "_")     # dots would be interpreted as path separators
+                    bucket_location = "ctx.payload.aggregations.rules.buckets.%s." % bucket
+                    filters[bucket] = {
+                            "query_string": {
+                                "query": rule["query"],
+                                "analyze_wildcard": True
+                                }
+                            }
+                    metadata[bucket] = {
+                            "title": rule["title"],
+                            "description": rule["description"],
+                            "tags": rule["tags"],
+                            "query": rule["query"],
+                            }
+                    if rule["agg_iter"]:
+                        action_body = "Hits:\n"
+                        action_body += "\n".join([
+                            ("{{#%s%s}}\n" + (2 * i * "-") + " {{key}} {{doc_count}}\n") % (bucket_location, agg_item) for i, agg_item in enumerate(rule["agg_iter"])
+                            ])
+                        action_body += "\n".join([
+                            "{{/%s%s}}\n" % (bucket_location, agg_item) for agg_item in reversed(rule["agg_iter"])
+                            ])
+                    else:
+                        action_body = "Hits: {{%sdoc_count}}\n" % bucket_location
+                    action, size = self.generateWatcherActions(rule["title"], action_body)
+                    if "httppost" in action:    # only send metadata of the matching rule
+                        action["httppost"]["webhook"]["body"] = "{{#toJson}}ctx.metadata.rules.%s{{/toJson}}" % bucket
+                    for name, rule_action in action.items():
+                        actions["%s-%s" % (bucket, name)] = {
+                                "condition": {
+                                    "compare": {
+                                        bucket_location + rule["alert_value_location"] + "doc_count": rule["alert_condition"]
+                                        }
+                                    },
+                                **rule_action
+                                }
 
-class ElastalertBackend(MultiRuleOutputMixin):
+                watchers[watchername] = {
+                        "metadata": {
+                            "rules": metadata
+                            },
+                        "trigger": {
+                            "schedule": {
+                                "interval": interval
+                                }
+                            },
+                        "input": {
+                            "search": {
+                                "request": {
+                                    "body": {
+                                        "size": 0,
+                                        "query": {
+                                            "bool": {
+                                                "filter": {
+                                                    "range": {
+                                                        dateField: {
+                                                            "gte": "now-%s/m" % self.filter_range
+                                                            }
+                                                        }
+                                                    }
+                                                }
+                                            },
+                                        "aggs": {
+                                            "rules": {
+                                                "filters": {
+                                                    "filters": filters
+                                                    },
+                                                **agg
+                                                }
+                                            }
+                                        },
+                                    "indices": list(indices)
+                                    }
+                                }
+                            },
+                        "condition": {
+                            "always": {}    # conditions are evaluated per rule by the actions
+                            },
+                        "actions": actions
+                        }
+        self.fusedRules = dict()
+        return watchers
+
+    def watcherDocument(self, rulename, rule):
+        if self.output_type == "plain":     # output request line + body
+            return StructuredResult("PUT %s/watch/%s\n%s" % (self.url_prefix, rulename, json.dumps(rule, indent=2)), name=rulename, extension="txt")
+        elif self.output_type == "curl":      # output curl command line
+            return StructuredResult("curl -s -XPUT -H 'Content-Type: application/json' --data-binary @- %s/%s/watch/%s <<EOF\n%s\nEOF" % (self.es, self.url_prefix, rulename, json.dumps(rule, indent=2)), name=rulename, extension="sh")
+        elif self.output_type == "json":    # output compressed watcher json, one per line
+            return StructuredResult(rule, name=rulename)
+        else:
+            raise NotImplementedError("Output type '%s' not supported" % self.output_type)
+
+    def finalizeDocuments(self):
+        """Fused watchers, watchers of single rules are emitted by generate()"""
+        return [ self.watcherDocument(watchername, watcher) for watchername, watcher in self.generateFusedWatchers().items() ]
+
+class ElastalertBackend(StructuredOutputMixin, MultiRuleOutputMixin):
     """Elastalert backend"""
     active = True
+    outputFormat = "yaml"
+    outputTypeFormats = dict()
+    outputArray = False
     supported_alert_methods = {'email', 'http_post'}
 
     options = ElasticsearchQuerystringBackend.options + (
@@ -808,10 +1285,9 @@ class ElastalertBackend(MultiRuleOutputMixin):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.elastalert_alerts = dict()
         self.fields = []
 
-    def generate(self, sigmaparser):
+    def generateDocuments(self, sigmaparser):
         rulename = self.getRuleName(sigmaparser)
         title = sigmaparser.parsedyaml.setdefault("title", "")
         description = sigmaparser.parsedyaml.setdefault("description", "")
@@ -828,6 +1304,7 @@ class ElastalertBackend(MultiRuleOutputMixin):
             index = index[0]
         #Init a rule number cpt in case there are several elastalert rules generated fron one Sigma rule
         rule_number = 0
+        documents = list()
         for parsed in sigmaparser.condparsed:
             #Static data
             rule_object = {
@@ -912,9 +1389,13 @@ class ElastalertBackend(MultiRuleOutputMixin):
 
             #Increment rule number
             rule_number += 1
-            self.elastalert_alerts[rule_object['name']] = rule_object
+            documents.append(StructuredResult(rule_object, name=rule_object['name']))
             #Clear fields
             self.fields = []
+        return self.emitDocuments(documents)
+
+    def finalizeDocuments(self):
+        return list()       # rules are emitted by generate()
 
     def generateNode(self, node):
         #Save fields for adding them in query_key
@@ -962,16 +1443,12 @@ class ElastalertBackend(MultiRuleOutputMixin):
             'low': 4
         }.get(level, 2)
 
-    def finalize(self):
-        result = ""
-        for rulename, rule in self.elastalert_alerts.items():
-            result += yaml.dump(rule, default_flow_style=False, width=10000)
-            result += '\n'
-        return result
-
 class ElastalertBackendDsl(ElastalertBackend, ElasticsearchDSLBackend):
     """Elastalert backend"""
     identifier = 'elastalert-dsl'
+    options = ElastalertBackend.options + ValueListMixin.options + (
+        ("list_index", "sigma-lists", "Index with value list documents for terms lookups", None),
+    )
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
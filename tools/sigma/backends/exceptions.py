@@ -23,6 +23,10 @@ class NotSupportedError(BackendError):
     """Exception is raised if some output is required that is not supported by the target language."""
     pass
 
+class QueryBudgetError(BackendError):
+    """Exception is raised if a rule exceeds the query budget of the target system and can't be split into smaller queries."""
+    pass
+
 # Exceptions (backend specific Qualys) - TODO: no backend specific exceptions
 class PartialMatchError(Exception):
     pass
@@ -15,9 +15,10 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
-import yaml
 from collections import namedtuple
 from .base import BaseBackend
+from .mixins import StructuredOutputMixin
+from sigma.output import StructuredResult
 from sigma.parser.modifiers.base import SigmaTypeModifier
 from sigma.parser.modifiers.type import SigmaRegularExpressionModifier
 
@@ -193,14 +194,15 @@ _allFieldMappings = {
     ),
 }
 
-class LimaCharlieBackend(BaseBackend):
+class LimaCharlieBackend(StructuredOutputMixin, BaseBackend):
     """Converts Sigma rule into LimaCharlie D&R rules. Contributed by LimaCharlie. https://limacharlie.io"""
     identifier = "limacharlie"
     active = True
     config_required = False
     default_config = ["limacharlie"]
+    outputFormat = "yaml"
 
-    def generate(self, sigmaparser):
+    def generateDocuments(self, sigmaparser):
         # Take the log source information and figure out which set of mappings to use.
         ruleConfig = sigmaparser.parsedyaml
         ls_rule = ruleConfig['logsource']
@@ -244,20 +246,12 @@ class LimaCharlieBackend(BaseBackend):
         # Call to fixup all operations after the fact.
         self._postOpMapper = postOpMapper
 
-        # Call the original generation code.
-        detectComponent = super().generate(sigmaparser)
-
-        # We expect a string (yaml) as output, so if
-        # we get anything else we assume it's a core
-        # library value and just return it as-is.
-        if not isinstance( detectComponent, str):
-            return detectComponent
-
-        # This redundant to deserialize it right after
-        # generating the yaml, but we try to use the parent
-        # official class code as much as possible for future
-        # compatibility.
-        detectComponent = yaml.safe_load(detectComponent)
+        # Generate the detection of the first condition like
+        # the original generation code. The D&R rule is kept as
+        # structure and serialized once by the output.
+        if not sigmaparser.condparsed:
+            return list()
+        detectComponent = self.generateQuery(sigmaparser.condparsed[0])
 
         # Check that we got a proper node and not just a string
         # which we don't really know what to do with.
@@ -293,16 +287,16 @@ class LimaCharlieBackend(BaseBackend):
             respondComponents[0].setdefault("metadata", {})["falsepositives"] = ruleConfig["falsepositives"]
 
         # Assemble it all as a single, complete D&R rule.
-        return yaml.safe_dump({
+        return [StructuredResult({
             "detect": detectComponent,
             "respond": respondComponents,
-        }, default_flow_style = False)
+        }, name=ruleConfig.get("id", ruleConfig["title"]))]
 
     def generateQuery(self, parsed):
         # We override the generateQuery function because
         # we generate proper JSON structures internally
-        # and only convert to string (yaml) once the
-        # whole thing is assembled.
+        # that are serialized once the whole thing is
+        # assembled.
         result = self.generateNode(parsed.parsedSearch)
 
         if self._preCondition is not None:
@@ -315,7 +309,7 @@ class LimaCharlieBackend(BaseBackend):
             }
             if self._postOpMapper is not None:
                 result = self._postOpMapper(result)
-        return yaml.safe_dump(result)
+        return result
 
     def generateANDNode(self, node):
         generated = [ self.generateNode(val) for val in node ]
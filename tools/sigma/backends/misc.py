@@ -15,20 +15,209 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import re
+import sigma
 from .base import BaseBackend
-from .mixins import QuoteCharMixin
-
-class GrepBackend(BaseBackend, QuoteCharMixin):
-    """Generates Perl compatible regular expressions and puts 'grep -P' around it"""
+from .mixins import QuoteCharMixin, MultiRuleOutputMixin
+
+class GrepBackend(BaseBackend, QuoteCharMixin, MultiRuleOutputMixin):
+    """
+    Generates Perl compatible regular expressions and puts 'grep -P' around it
+
+    The output option selects between:
+
+    * pcre: one grep -P command with a lookahead chain per rule (default).
+    * fast: case-insensitive pipeline per rule. A grep -F prefilter searches lines that contain at least one literal
+      that is required by the rule, i.e. each matching line contains one of them. The following grep -P checks the
+      complete condition with a pattern that doesn't nest .* prefixes: values are searched directly, AND and NOT
+      become lookaheads anchored at the beginning of the line.
+    * script: shell script that checks all rules on the files given as arguments. One grep -F pass with the required
+      literals of all rules selects candidate lines, the prefilter and precise pattern of each rule are checked on the
+      candidates.
+      Matching lines are prefixed with the rule identifier. Rules without required literals are checked on the input.
+    """
     identifier = "grep"
     active = True
     config_required = False
+    options = BaseBackend.options + (
+            ("output", "pcre", "Output format: pcre = grep -P command, fast = grep -F prefilter followed by grep -P, script = shell script with common prefilter for all rules", "output_type"),
+            )
 
     reEscape = re.compile("([\\|()\[\]{}.^$+])")
+    reSigmaToken = re.compile(r"\\\\(?=[*?])|\\[*?]|[*?]|[^\\*?]+|\\")     # Escaped backslash in front of wildcard, escaped wildcards, wildcards, literal text and other backslashes
+    minLiteralLength = 3        # shorter literals are not used as prefilter because they match most lines
+    scriptHeader = """#!/bin/sh
+# Checks Sigma rules on the files given as arguments, matching lines are prefixed with the rule identifier.
+candidates=$(mktemp) || exit 1
+trap 'rm -f "$candidates"' EXIT
+"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.output_type not in ("pcre", "fast", "script"):
+            raise NotImplementedError("Output format '%s' not supported by grep backend" % self.output_type)
+        self.rules = list()     # (rule name, pattern, required literals) for script output
+
+    def generate(self, sigmaparser):
+        if self.output_type == "pcre":
+            return super().generate(sigmaparser)
+        for parsed in sigmaparser.condparsed:
+            pattern = self.generateFastPattern(parsed.parsedSearch)
+            literals = self.requiredLiterals(parsed.parsedSearch)
+            if self.output_type == "script":
+                self.rules.append((self.getRuleName(sigmaparser), pattern, literals))
+                return None
+            grep = "grep -P -i %s" % self.shellQuote(pattern)
+            if literals:
+                return "%s | %s" % (self.generatePrefilter(literals), grep)
+            return grep
+
+    def finalize(self):
+        if self.output_type != "script" or not self.rules:
+            return None
+        literals = sorted({ literal for _, _, ruleLiterals in self.rules for literal in ruleLiterals or [] })
+        script = self.scriptHeader
+        if literals:
+            script += "grep -h -F -i -f - \"$@\" > \"$candidates\" <<'SIGMA_LITERALS'\n%s\nSIGMA_LITERALS\n" % "\n".join(literals)
+        for rulename, pattern, ruleLiterals in self.rules:
+            if ruleLiterals:
+                script += "%s \"$candidates\" | " % self.generatePrefilter(ruleLiterals)
+                source = ""
+            else:
+                source = " \"$@\""
+            script += "grep -h -P -i %s%s | sed %s\n" % (self.shellQuote(pattern), source, self.shellQuote("s/^/%s: /" % rulename.replace("\\", "\\\\").replace("/", "\\/").replace("&", "\\&")))
+        return script
+
+    def generatePrefilter(self, literals):
+        return "grep -F -i %s" % " ".join([ "-e %s" % self.shellQuote(literal) for literal in literals ])
 
     def generateQuery(self, parsed):
         return "grep -P '^%s'" % self.generateNode(parsed.parsedSearch)
 
+    def shellQuote(self, value):
+        return "'%s'" % value.replace("'", "'\"'\"'")
+
+    def sigmaValueTokens(self, value):
+        """Split Sigma value into list of (wildcard, text) tuples of unescaped literal text and * or ? wildcards"""
+        tokens = list()
+        for token in self.reSigmaToken.findall(str(value)):
+            if token in ("*", "?"):
+                tokens.append((True, token))
+            elif len(token) == 2 and token[0] == "\\":
+                tokens.append((False, token[1]))
+            else:
+                tokens.append((False, token))
+        return tokens
+
+    def literalFragments(self, value):
+        """Literal parts of a Sigma value between wildcards"""
+        fragments = [ "" ]
+        for wildcard, text in self.sigmaValueTokens(value):
+            if wildcard:
+                fragments.append("")
+            else:
+                fragments[-1] += text
+        return [ fragment for fragment in fragments if fragment ]
+
+    def requiredLiterals(self, node):
+        """
+        Set of literals of which at least one is contained in every line that matches the condition or None if there
+        is no such set. Literals that contain another literal of the set are redundant and removed.
+        """
+        if type(node) == sigma.parser.condition.ConditionAND:
+            candidates = [ literals for literals in [ self.requiredLiterals(item) for item in node ] if literals ]
+            if not candidates:
+                return None
+            return min(candidates, key=lambda literals: (len(literals), -min([ len(literal) for literal in literals ])))
+        elif type(node) in (sigma.parser.condition.ConditionOR, list):
+            literals = set()
+            for item in node:
+                itemLiterals = self.requiredLiterals(item)
+                if not itemLiterals:
+                    return None
+                literals.update(itemLiterals)
+            return self.minimizeLiterals(literals)
+        elif type(node) == sigma.parser.condition.NodeSubexpression:
+            return self.requiredLiterals(node.items)
+        elif type(node) == tuple:
+            return self.requiredLiterals(node[1])
+        elif type(node) in (str, int):
+            fragments = self.literalFragments(node)
+            if not fragments:
+                return None
+            fragment = max(fragments, key=len)
+            if len(fragment) < self.minLiteralLength:
+                return None
+            return [ fragment ]
+        else:                   # NOT, null values and type modifiers don't require any literal
+            return None
+
+    def minimizeLiterals(self, literals):
+        result = list()
+        for literal in sorted(literals, key=lambda literal: (len(literal), literal)):
+            if not any([ other.lower() in literal.lower() for other in result ]):
+                result.append(literal)
+        return sorted(result)
+
+    def generateFastPattern(self, node):
+        """Pattern that matches lines that fulfill the condition"""
+        pattern, search = self.generateFastNode(node)
+        if search:
+            return pattern
+        return "^" + pattern
+
+    def generateFastNode(self, node):
+        """
+        Returns tuple (pattern, search). Search patterns match the searched text anywhere in the line, other patterns
+        are zero-width assertions at the beginning of the line.
+        """
+        if type(node) == sigma.parser.condition.ConditionAND and len(node.items) == 1:
+            return self.generateFastNode(node.items[0])
+        elif type(node) == sigma.parser.condition.ConditionAND:
+            return "".join([ self.fastAssertion(item) for item in node ]), False
+        elif type(node) in (sigma.parser.condition.ConditionOR, list):
+            generated = [ self.generateFastNode(item) for item in node ]
+            if all([ search for _, search in generated ]):
+                return "(?:%s)" % "|".join([ pattern for pattern, _ in generated ]), True
+            return "(?:%s)" % "|".join([ pattern if not search else "(?=.*?%s)" % pattern for pattern, search in generated ]), False
+        elif type(node) == sigma.parser.condition.ConditionNOT:
+            pattern, search = self.generateFastNode(node.item)
+            if search:
+                return "(?!.*?%s)" % pattern, False
+            return "(?!%s)" % pattern, False
+        elif type(node) == sigma.parser.condition.NodeSubexpression:
+            return self.generateFastNode(node.items)
+        elif type(node) == sigma.parser.condition.ConditionNULLValue:
+            return "(?!.*?%s)" % re.escape(node.item), False
+        elif type(node) == sigma.parser.condition.ConditionNotNULLValue:
+            return re.escape(node.item), True
+        elif type(node) == tuple:
+            key, value = node
+            if value is None:
+                return "(?!.*?%s)" % re.escape(key), False
+            return self.generateFastNode(value)
+        elif type(node) in (str, int):
+            return self.fastValuePattern(node), True
+        elif isinstance(node, sigma.parser.modifiers.base.SigmaTypeModifier):
+            raise NotImplementedError("Type modifier '{}' is not supported by backend".format(node.identifier))
+        else:
+            raise TypeError("Node type %s was not expected in Sigma parse tree" % (str(type(node))))
+
+    def fastAssertion(self, node):
+        pattern, search = self.generateFastNode(node)
+        if search:
+            return "(?=.*?%s)" % pattern
+        return pattern
+
+    def fastValuePattern(self, value):
+        """Search pattern of value, wildcards at the beginning and end are not required because the pattern is searched"""
+        tokens = self.sigmaValueTokens(value)
+        while tokens and tokens[0] == (True, "*"):
+            tokens = tokens[1:]
+        while tokens and tokens[-1] == (True, "*"):
+            tokens = tokens[:-1]
+        pattern = "".join([ (".*?" if text == "*" else ".") if wildcard else re.escape(text) for wildcard, text in tokens ])
+        return pattern or "(?:)"
+
     def cleanValue(self, val):
         val = super().cleanValue(val)
         val = val.replace("'","'\"'\"'")
@@ -14,7 +14,9 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import re
 import sigma
+from sigma.output import serializeDocuments
 
 ### Mixins
 class QuoteCharMixin:
@@ -43,7 +45,10 @@ class RulenameCommentMixin:
     def generateBefore(self, parsed):
         if self.rulecomment:
             try:
-                return "%s%s\n" % (self.prefix, parsed.sigmaParser.parsedyaml['title'])
+                title = parsed.sigmaParser.parsedyaml['title']
+                if parsed.sigmaParser.part is not None:
+                    title += " (part %d)" % parsed.sigmaParser.part
+                return "%s%s\n" % (self.prefix, title)
             except KeyError:
                 return ""
 
@@ -71,6 +76,8 @@ class MultiRuleOutputMixin:
             rulename = sigmaparser.parsedyaml["id"]
         except KeyError:
             rulename = sigmaparser.parsedyaml["title"].replace(" ", "-").replace("(", "").replace(")", "")
+        if sigmaparser.part is not None:    # rule was split into several queries
+            rulename = "%s-part%d" % (rulename, sigmaparser.part)
         if rulename in self.rulenames:   # add counter if name collides
             cnt = 2
             while "%s-%d" % (rulename, cnt) in self.rulenames:
@@ -79,3 +86,234 @@ class MultiRuleOutputMixin:
         self.rulenames.add(rulename)
 
         return rulename
+
+class StructuredOutputMixin:
+    """
+    Mixin for backends that generate structured documents (dicts and lists) instead of text. Backends implement
+    generateDocuments() and finalizeDocuments() that return lists of documents. generate() and finalize() return the
+    documents serialized in the output format of the backend or the documents itself if structuredResults is set by an
+    output sink that serializes them once in the requested format (see sigma.output).
+
+    Documents of a rule are passed to emitDocuments(). They are collected and returned by finalize() or returned
+    immediately by generate() if streamResults is set, the backend then doesn't keep them in memory.
+    """
+    outputFormat = "json"               # Format of serialized documents: json, ndjson or yaml
+    outputTypeFormats = dict()          # Output format depending on output type of backend, e.g. { "percolator": "ndjson" }
+    outputArray = False                 # JSON documents are elements of one array, "multiple": only if there's more than one
+    structuredResults = False           # generate() and finalize() return lists of documents instead of strings
+    streamResults = False               # generate() returns documents of rules instead of collecting them for finalize()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.collectedDocuments = list()
+
+    def getOutputFormat(self):
+        return self.outputTypeFormats.get(getattr(self, "output_type", None), self.outputFormat)
+
+    def generate(self, sigmaparser):
+        documents = self.generateDocuments(sigmaparser)
+        if documents:
+            return self.outputDocuments(documents)
+
+    def finalize(self):
+        documents = self.collectedDocuments + self.finalizeDocuments()
+        self.collectedDocuments = list()
+        return self.outputDocuments(documents)
+
+    def generateDocuments(self, sigmaparser):
+        return list()
+
+    def finalizeDocuments(self):
+        return list()
+
+    def emitDocuments(self, documents):
+        if self.streamResults:
+            return documents
+        self.collectedDocuments.extend(documents)
+        return list()
+
+    def outputDocuments(self, documents):
+        if self.structuredResults:
+            return documents
+        return serializeDocuments(documents or [], self.getOutputFormat(), array=self.outputArray)
+
+class ValueListMixin:
+    """
+    Mixin for backends with lookup constructs for external value lists. Lists with less values than list_threshold are
+    inlined into the query, larger lists are referenced by the lookup construct of the backend that is generated by
+    generateValueListLookup(fieldname, valuelist). The list content must be provided in the target system under the
+    name of the list.
+    """
+    options = (
+            ("list_threshold", 1000, "Value lists with less values are inlined into queries", None),
+            )
+
+    def generateValueListNode(self, node):
+        key, value = node
+        if len(value.valuelist) < int(self.list_threshold):
+            return super().generateValueListNode(node)
+        return self.generateValueListLookup(key, value.valuelist)
+
+    def countValueListClauses(self, valuelist):
+        if len(valuelist) < int(self.list_threshold):
+            return super().countValueListClauses(valuelist)
+        return 1
+
+    def generateValueListLookup(self, fieldname, valuelist):
+        raise NotImplementedError("Value list lookups are not supported by backend")
+
+class KustoTermMixin:
+    """
+    Generates KQL conditions for Sigma values that are served by the term index of Kusto (Azure Log Analytics,
+    Defender ATP). A term is a sequence of alphanumeric characters, has/has_any match whole terms and are answered by
+    the index, contains, startswith, endswith and regular expressions scan the values.
+
+    * Exact values are matched with =~ and lists of exact values are collapsed into in~.
+    * Values with wildcards only at the beginning or end are matched with contains, startswith or endswith, inner
+      wildcards require a regular expression.
+    * strict matching: a has condition is added in front of the condition as index-served prefilter if the longest
+      literal part of the value must appear as whole term in every matching value. This is the case if both ends of the
+      literal part are adjacent to the beginning/end of the value or a non-alphanumeric character, e.g. *\\cmd.exe.
+      Lists of values that all have a prefilter term are prefiltered with has_any.
+    * fast matching: substring searches (*value*) are converted into term searches with has and has_any, which don't
+      match occurrences inside of longer terms.
+
+    The case-sensitive has_cs is not used because Sigma values match case-insensitive.
+    """
+    options = (
+            ("matching", "strict", "Value matching: strict = Sigma semantics with has/has_any prefilters, fast = substring searches are term searches with has/has_any", None),
+            )
+    reKQLToken = re.compile(r"\\[*?\\]|[*?]|[^\\*?]+|\\")     # Escaped characters, wildcards, literal text and single backslashes
+    reTermChar = re.compile(r"\w")
+    reIndexedTerm = re.compile(r"\w{3}")   # Kusto indexes terms with at least three characters
+    reTermStrip = re.compile(r"^\W+|\W+$")
+    reRegexSpecial = re.compile(r"([\\.^$|?*+()\[\]{}])")
+
+    def kqlTokens(self, value):
+        """Split Sigma value into list of (wildcard, text) tuples of unescaped literal text and * or ? wildcards"""
+        tokens = list()
+        for token in self.reKQLToken.findall(value):
+            if token in ("*", "?"):
+                tokens.append((True, token))
+            elif len(token) == 2 and token[0] == "\\":
+                tokens.append((False, token[1]))
+            else:
+                tokens.append((False, token))
+        return tokens
+
+    def kqlString(self, value):
+        return "\"%s\"" % value.replace("\\", "\\\\").replace("\"", "\\\"")
+
+    def kqlRegex(self, tokens):
+        """Case-insensitive regular expression that matches the whole value as verbatim string"""
+        regex = "".join([
+            (".*" if text == "*" else ".") if wildcard else self.reRegexSpecial.sub("\\\\\\1", text)
+            for wildcard, text in tokens
+            ])
+        return "@\"(?i)^%s$\"" % regex.replace("\"", "\"\"")
+
+    def kqlTerm(self, tokens):
+        """Longest literal part of value that must be contained as whole term in all matching values or None"""
+        term = None
+        parts = [ [ True, "", False ] ]         # list of [ anchored at beginning, literal text, anchored at end ]
+        for wildcard, text in tokens:
+            if wildcard:
+                parts.append([ False, "", False ])
+            else:
+                parts[-1][1] += text
+        parts[-1][2] = True
+        for start, text, end in parts:
+            if text == "":
+                continue
+            core = self.reTermStrip.sub("", text)
+            if (start or not self.reTermChar.match(text[0])) \
+                    and (end or not self.reTermChar.match(text[-1])) \
+                    and self.reIndexedTerm.search(core) \
+                    and (term is None or len(core) > len(term)):
+                term = core
+        return term
+
+    def kqlSubstring(self, tokens):
+        """Returns literal text if value is a substring search (*text*) otherwise None"""
+        if len(tokens) >= 3 and tokens[0] == tokens[-1] == (True, "*") and not any([ wildcard for wildcard, _ in tokens[1:-1] ]):
+            return "".join([ text for _, text in tokens[1:-1] ])
+        return None
+
+    def kqlFastTerm(self, tokens):
+        """Term that is searched with has instead of substring search in fast matching mode or None"""
+        if self.matching != "fast":
+            return None
+        substring = self.kqlSubstring(tokens)
+        if substring is None:
+            return None
+        core = self.reTermStrip.sub("", substring)
+        if self.reIndexedTerm.search(core):
+            return core
+        return None
+
+    def generateKQLScanCondition(self, fieldname, tokens):
+        """Returns tuple of prefilter term (or None) and the condition that matches the value"""
+        wildcards = [ i for i, (wildcard, _) in enumerate(tokens) if wildcard ]
+        literal = "".join([ text for wildcard, text in tokens if not wildcard ])
+        if not wildcards:
+            return None, "%s =~ %s" % (fieldname, self.kqlString(literal))
+        if any([ tokens[i][1] == "?" or 0 < i < len(tokens) - 1 for i in wildcards ]):
+            condition = "%s matches regex %s" % (fieldname, self.kqlRegex(tokens))
+        elif len(wildcards) == 2 or len(tokens) == 1:
+            condition = "%s contains %s" % (fieldname, self.kqlString(literal))
+        elif wildcards == [ 0 ]:
+            condition = "%s endswith %s" % (fieldname, self.kqlString(literal))
+        else:
+            condition = "%s startswith %s" % (fieldname, self.kqlString(literal))
+        return self.kqlTerm(tokens), condition
+
+    def generateKQLPrefilter(self, fieldname, term, condition):
+        if term is None:
+            return condition
+        return self.subExpression % ("%s has %s%s%s" % (fieldname, self.kqlString(term), self.andToken, condition))
+
+    def generateKQLValueCondition(self, fieldname, value):
+        """Condition for single string value"""
+        tokens = self.kqlTokens(value)
+        term = self.kqlFastTerm(tokens)
+        if term is not None:
+            return "%s has %s" % (fieldname, self.kqlString(term))
+        return self.generateKQLPrefilter(fieldname, *self.generateKQLScanCondition(fieldname, tokens))
+
+    def generateKQLListCondition(self, fieldname, values):
+        """Condition for list of string values with exact values collapsed into in~ and terms into has_any"""
+        exact = list()
+        terms = list()
+        conditions = list()
+        for value in values:
+            tokens = self.kqlTokens(value)
+            term = self.kqlFastTerm(tokens)
+            if term is not None:
+                terms.append(term)
+            elif any([ wildcard for wildcard, _ in tokens ]):
+                conditions.append(self.generateKQLScanCondition(fieldname, tokens))
+            else:
+                exact.append("".join([ text for _, text in tokens ]))
+
+        generated = list()
+        if len(exact) == 1:
+            generated.append("%s =~ %s" % (fieldname, self.kqlString(exact[0])))
+        elif exact:
+            generated.append("%s in~ (%s)" % (fieldname, ", ".join([ self.kqlString(value) for value in exact ])))
+        if len(terms) == 1:
+            generated.append("%s has %s" % (fieldname, self.kqlString(terms[0])))
+        elif terms:
+            generated.append("%s has_any (%s)" % (fieldname, ", ".join([ self.kqlString(term) for term in terms ])))
+        if len(conditions) > 1 and all([ term is not None for term, _ in conditions ]):
+            generated.append(self.subExpression % "%s has_any (%s)%s%s" % (
+                fieldname,
+                ", ".join([ self.kqlString(term) for term, _ in conditions ]),
+                self.andToken,
+                self.subExpression % self.orToken.join([ condition for _, condition in conditions ]),
+                ))
+        else:
+            generated.extend([ self.generateKQLPrefilter(fieldname, term, condition) for term, condition in conditions ])
+
+        if len(generated) == 1:
+            return generated[0]
+        return self.subExpression % self.orToken.join(generated)
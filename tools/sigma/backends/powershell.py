@@ -16,17 +16,33 @@
 
 import re
 import sigma
-from .base import SingleTextQueryBackend
+from sigma.parser.modifiers.type import SigmaValueListModifier
+from .base import BaseBackend, SingleTextQueryBackend
 from .mixins import MultiRuleOutputMixin
 
 class PowerShellBackend(SingleTextQueryBackend):
-    """Converts Sigma rule into PowerShell event log cmdlets."""
+    """
+    Converts Sigma rule into PowerShell event log cmdlets.
+
+    By default, all events are retrieved and matched against the rendered message text in PowerShell. The
+    server_filter option moves filtering into the event log service:
+
+    * hashtable: LogName, ProviderName, event identifiers and exact values of EventData fields contained in the top-level
+      AND condition of a rule are passed to Get-WinEvent -FilterHashtable.
+    * xpath: top-level AND conditions that consist of event identifiers, providers and exact EventData values combined
+      with and/or are passed as XPath query to Get-WinEvent -FilterXPath.
+
+    Remaining conditions are checked by Where-Object on the EventData properties of the event XML, with -like for
+    wildcards and -match for regular expressions. Keywords are still searched in the message text. Please note that the
+    event log service compares EventData values case-sensitive.
+    """
     identifier = "powershell"
     active = True
     config_required = False
     default_config = ["sysmon", "powershell"]
-    options = (
+    options = BaseBackend.options + (
         ("csv", False, "Return the results in CSV format instead of Powershell objects", None),
+        ("server_filter", "none", "Filtering in event log service: none, hashtable = Get-WinEvent -FilterHashtable or xpath = Get-WinEvent -FilterXPath", None),
     )
 
     reEscape = re.compile('("|(?<!\\\\)\\\\(?![*?\\\\])|\+)')
@@ -44,9 +60,20 @@ class PowerShellBackend(SingleTextQueryBackend):
     mapListsSpecialHandling = True
 
     logname = None
+    lognameFields = ("LogName", "source")
+    eventidFields = ("EventID", "ID")
+    providerFields = ("Provider_Name", "ProviderName")
+    select = " | select TimeCreated,Id,RecordId,ProcessId,MachineName,Message"
+    eventDataExpression = "$d = @{}; ([xml]$_.ToXml()).Event.EventData.Data | foreach { $d[$_.Name] = $_.'#text' }; "    # Parses EventData of event into hashtable $d
+    reSigmaToken = re.compile(r"\\[*?\\]|[*?]|[^\\*?]+|\\")     # Escaped characters, wildcards, literal text and single backslashes
+    reLikeSpecial = re.compile(r"([\[\]*?`])")
+    reNamedData = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
 
     def generate(self, sigmaparser):
         """Method is called for each sigma rule and receives the parsed rule (SigmaParser)"""
+        if self.server_filter != "none":
+            for parsed in sigmaparser.condparsed:
+                return self.generateServerFilteredQuery(parsed)
         for parsed in sigmaparser.condparsed:
             query = self.generateQuery(parsed, sigmaparser)
             before = self.generateBefore(parsed)
@@ -86,6 +113,8 @@ class PowerShellBackend(SingleTextQueryBackend):
             return self.generateNotNULLValueNode(node)
         elif type(node) == sigma.parser.condition.NodeSubexpression:
             return self.generateSubexpressionNode(node)
+        elif type(node) == tuple and isinstance(node[1], SigmaValueListModifier):
+            return self.generateValueListNode(node)
         elif type(node) == tuple:
             return self.generateMapItemNode(node)
         elif type(node) in (str, int):
@@ -95,6 +124,15 @@ class PowerShellBackend(SingleTextQueryBackend):
         else:
             raise TypeError("Node type %s was not expected in Sigma parse tree" % (str(type(node))))
 
+    def generateNOTNode(self, node):
+        """-not binds stronger than -match, negated conditions are enclosed in parentheses"""
+        generated = self.generateNode(node.item)
+        if generated is None:
+            return None
+        if type(node.item) != sigma.parser.condition.NodeSubexpression:
+            generated = self.subExpression % generated
+        return self.notToken + generated
+
     def generateQuery(self, parsed, sigmaparser):
         result = self.generateNode(parsed.parsedSearch)
         self.parsedlogsource = sigmaparser.get_logsource().service
@@ -186,3 +224,206 @@ class PowerShellBackend(SingleTextQueryBackend):
                 return " | group-object %s | where { $_.count %s %s } | select name,count | sort -desc" % (agg.groupfield or "", powershell_cond_op, agg.condition)
             else:
                 return " | select %s, %s | group %s | foreach { [PSCustomObject]@{'%s'=$_.name;'Count'=($_.group.%s | sort -u).count} }  | sort count -desc | where { $_.count %s %s }" % (agg.groupfield, agg.aggfield, agg.groupfield, agg.groupfield, agg.aggfield, powershell_cond_op, agg.condition)
+
+    def generateServerFilteredQuery(self, parsed):
+        if self.server_filter == "hashtable":
+            server, post = self.generateFilterHashtable(self.conjunction(parsed.parsedSearch))
+        elif self.server_filter == "xpath":
+            server, post = self.generateFilterXPath(self.conjunction(parsed.parsedSearch))
+        else:
+            raise NotImplementedError("Server filter '%s' not supported" % self.server_filter)
+
+        result = "Get-WinEvent %s" % server
+        condition = self.generatePostFilterNode(sigma.parser.condition.ConditionAND(None, None, *post)) if post else None
+        if parsed.parsedAgg:        # aggregations group objects with EventData properties
+            if condition is None:
+                result += " | foreach { %s[PSCustomObject]$d }" % self.eventDataExpression
+            else:
+                result += " | foreach { %sif (%s) { [PSCustomObject]$d } }" % (self.eventDataExpression, condition)
+            result += self.generateAggregation(parsed.parsedAgg)
+        else:
+            if condition is not None:
+                result += " | where { %s%s }" % (self.eventDataExpression if "$d[" in condition else "", condition)
+            result += self.select
+        return result + self.generateAfter(parsed)
+
+    def conjunction(self, node):
+        """List of conditions of the top-level AND condition"""
+        if type(node) == sigma.parser.condition.NodeSubexpression:
+            return self.conjunction(node.items)
+        elif type(node) == sigma.parser.condition.ConditionAND:
+            return [ item for child in node for item in self.conjunction(child) ]
+        else:
+            return [ node ]
+
+    def exactValues(self, value):
+        """List of values without wildcards as strings or None if value contains wildcards or isn't a string, number or list of them"""
+        values = value if type(value) == list else [ value ]
+        result = list()
+        for item in values:
+            if type(item) not in (str, int):
+                return None
+            tokens = self.sigmaValueTokens(str(item))
+            if any([ wildcard for wildcard, _ in tokens ]):
+                return None
+            result.append("".join([ text for _, text in tokens ]))
+        return result if result else None
+
+    def eventIDs(self, values):
+        if values is not None and all([ value.isdigit() for value in values ]):
+            return [ int(value) for value in values ]
+        return None
+
+    def psString(self, value):
+        return "'%s'" % value.replace("'", "''")
+
+    def generateFilterHashtable(self, conditions):
+        """Returns FilterHashtable parameter and list of conditions that are not contained in the hash table"""
+        hashtable = list()          # list of (key, value expression)
+        keys = set()
+        post = list()
+        for node in conditions:
+            if type(node) == tuple:
+                key, value = node
+                values = self.exactValues(value)
+                if key in self.lognameFields:
+                    key = "LogName"
+                elif key in self.providerFields:
+                    key = "ProviderName"
+                elif key in self.eventidFields:
+                    key = "Id"
+                    values = self.eventIDs(values)
+                elif not self.reNamedData.match(key) or key in ("Path", "Keywords", "Level", "StartTime", "EndTime", "UserID", "Data", "SuppressHashFilter"):
+                    values = None
+                if values is not None and key.lower() not in keys:
+                    keys.add(key.lower())
+                    hashtable.append((key, ",".join([ str(value) if key == "Id" else self.psString(value) for value in values ])))
+                    continue
+            post.append(node)
+        if "logname" not in keys and "providername" not in keys:
+            hashtable.insert(0, ("LogName", "'*'"))
+        return "-FilterHashtable @{%s}" % "; ".join([ "%s=%s" % item for item in hashtable ]), post
+
+    def generateFilterXPath(self, conditions):
+        """Returns LogName and FilterXPath parameters and list of conditions that are not contained in the XPath query"""
+        lognames = None
+        xpath = list()
+        post = list()
+        for node in conditions:
+            if type(node) == tuple and node[0] in self.lognameFields and lognames is None:
+                lognames = self.exactValues(node[1])
+                if lognames is not None:
+                    continue
+            generated = self.generateXPathNode(node)
+            if generated is None:
+                post.append(node)
+            else:
+                xpath.append(generated)
+        result = "-LogName %s" % (",".join([ self.psString(logname) for logname in lognames ]) if lognames else "*")
+        if xpath:
+            result += " -FilterXPath %s" % self.psString("*[%s]" % " and ".join(xpath))
+        return result, post
+
+    def generateXPathNode(self, node):
+        """XPath expression for condition or None if it can't be expressed"""
+        if type(node) == sigma.parser.condition.NodeSubexpression:
+            return self.generateXPathNode(node.items)
+        elif type(node) in (sigma.parser.condition.ConditionAND, sigma.parser.condition.ConditionOR):
+            generated = [ self.generateXPathNode(item) for item in node ]
+            if not generated or None in generated:
+                return None
+            elif len(generated) == 1:
+                return generated[0]
+            operator = " and " if type(node) == sigma.parser.condition.ConditionAND else " or "
+            return "(%s)" % operator.join(generated)
+        elif type(node) == tuple:
+            key, value = node
+            values = self.exactValues(value)
+            if values is None or any([ "\"" in value for value in values ]):
+                return None
+            if key in self.eventidFields:
+                ids = self.eventIDs(values)
+                if ids is None:
+                    return None
+                expressions = [ "EventID=%d" % eventid for eventid in ids ]
+                template = "System[%s]"
+            elif key in self.providerFields:
+                expressions = [ "Provider[@Name=\"%s\"]" % value for value in values ]
+                template = "System[%s]"
+            elif key not in self.lognameFields and self.reNamedData.match(key):
+                expressions = [ "Data[@Name=\"%s\"]=\"%s\"" % (key, value) for value in values ]
+                template = "EventData[%s]"
+            else:
+                return None
+            if len(expressions) == 1:
+                return template % expressions[0]
+            return template % ("(%s)" % " or ".join(expressions))
+        return None
+
+    def generatePostFilterNode(self, node):
+        """Where-Object condition on event properties and EventData hashtable $d"""
+        if type(node) in (sigma.parser.condition.ConditionAND, sigma.parser.condition.ConditionOR):
+            generated = [ self.generatePostFilterNode(item) for item in node ]
+            generated = [ g for g in generated if g is not None ]
+            if not generated:
+                return None
+            token = self.andToken if type(node) == sigma.parser.condition.ConditionAND else self.orToken
+            return "(%s)" % token.join(generated) if len(generated) > 1 else generated[0]
+        elif type(node) == sigma.parser.condition.ConditionNOT:
+            generated = self.generatePostFilterNode(node.item)
+            return "-not (%s)" % generated if generated is not None else None
+        elif type(node) == sigma.parser.condition.NodeSubexpression:
+            return self.generatePostFilterNode(node.items)
+        elif type(node) == sigma.parser.condition.ConditionNULLValue:
+            return "[string]::IsNullOrEmpty(%s)" % self.postFilterField(node.item)
+        elif type(node) == sigma.parser.condition.ConditionNotNULLValue:
+            return "-not [string]::IsNullOrEmpty(%s)" % self.postFilterField(node.item)
+        elif type(node) == tuple:
+            key, value = node
+            field = self.postFilterField(key)
+            if type(value) == list:
+                return "(%s)" % self.orToken.join([ self.generatePostFilterValue(field, item) for item in value ])
+            return self.generatePostFilterValue(field, value)
+        elif type(node) in (str, int):
+            return "$_.Message -like %s" % self.psString("*%s*" % self.likePattern(str(node)))
+        elif type(node) == list:
+            return "(%s)" % self.orToken.join([ self.generatePostFilterNode(item) for item in node ])
+        else:
+            raise TypeError("Node type %s was not expected in Sigma parse tree" % (str(type(node))))
+
+    def postFilterField(self, key):
+        if key in self.lognameFields:
+            return "$_.LogName"
+        elif key in self.eventidFields:
+            return "$_.Id"
+        elif key in self.providerFields:
+            return "$_.ProviderName"
+        return "$d[%s]" % self.psString(key)
+
+    def generatePostFilterValue(self, field, value):
+        if value is None:
+            return "[string]::IsNullOrEmpty(%s)" % field
+        elif isinstance(value, sigma.parser.modifiers.type.SigmaRegularExpressionModifier):
+            return "%s -match %s" % (field, self.psString(value.value))
+        elif type(value) not in (str, int):
+            raise TypeError("Backend does not support map values of type " + str(type(value)))
+        values = self.exactValues(value)
+        if values is not None:
+            return "%s -eq %s" % (field, self.psString(values[0]))
+        return "%s -like %s" % (field, self.psString(self.likePattern(str(value))))
+
+    def sigmaValueTokens(self, value):
+        """Split Sigma value into list of (wildcard, text) tuples of unescaped literal text and * or ? wildcards"""
+        tokens = list()
+        for token in self.reSigmaToken.findall(value):
+            if token in ("*", "?"):
+                tokens.append((True, token))
+            elif len(token) == 2 and token[0] == "\\":
+                tokens.append((False, token[1]))
+            else:
+                tokens.append((False, token))
+        return tokens
+
+    def likePattern(self, value):
+        """PowerShell -like pattern of Sigma value"""
+        return "".join([ text if wildcard else self.reLikeSpecial.sub("`\\1", text) for wildcard, text in self.sigmaValueTokens(value) ])
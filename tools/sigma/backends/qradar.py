@@ -18,17 +18,22 @@
 import re
 import sigma
 from sigma.parser.modifiers.base import SigmaTypeModifier
-from sigma.parser.modifiers.type import SigmaRegularExpressionModifier
+from sigma.parser.modifiers.type import SigmaRegularExpressionModifier, SigmaValueListModifier
 from .base import SingleTextQueryBackend
-from .mixins import MultiRuleOutputMixin
+from .mixins import MultiRuleOutputMixin, ValueListMixin
 
 
-class QRadarBackend(SingleTextQueryBackend):
-    """Converts Sigma rule into Qradar saved search. Contributed by SOC Prime. https://socprime.com"""
+class QRadarBackend(ValueListMixin, SingleTextQueryBackend):
+    """
+    Converts Sigma rule into Qradar saved search. Contributed by SOC Prime. https://socprime.com
+
+    Large value lists are matched against the reference set with the name of the list.
+    """
     identifier = "qradar"
     active = True
     config_required = False
     default_config = ["sysmon", "qradar"]
+    options = SingleTextQueryBackend.options + ValueListMixin.options
     reEscape = re.compile('(")')
     reClear = None
     andToken = " and "
@@ -43,6 +48,7 @@ class QRadarBackend(SingleTextQueryBackend):
     notNullExpression = "not (%s is null)"
     mapExpression = "%s=%s"
     mapListsSpecialHandling = True
+    valueListExpression = "REFERENCESETCONTAINS('%s', %s)"
     aql_database = "events"
 
     def cleanKey(self, key):
@@ -71,6 +77,8 @@ class QRadarBackend(SingleTextQueryBackend):
             return self.generateNotNULLValueNode(node)
         elif type(node) == sigma.parser.condition.NodeSubexpression:
             return self.generateSubexpressionNode(node)
+        elif type(node) == tuple and isinstance(node[1], SigmaValueListModifier):
+            return self.generateValueListNode(node)
         elif type(node) == tuple:
             return self.generateMapItemNode(node)
         elif type(node) in (str, int):
@@ -100,6 +108,9 @@ class QRadarBackend(SingleTextQueryBackend):
         else:
             raise TypeError("Backend does not support map values of type " + str(type(value)))
 
+    def generateValueListLookup(self, fieldname, valuelist):
+        return self.valueListExpression % (valuelist.name, self.cleanKey(fieldname))
+
     def generateMapItemListNode(self, key, value):
         itemslist = list()
         for item in value:
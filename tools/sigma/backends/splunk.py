@@ -14,16 +14,36 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 import re
 import sigma
+from sigma.configuration import SigmaLogsourceConfiguration
+from sigma.parser.modifiers.base import SigmaTypeModifier
 from .base import SingleTextQueryBackend
-from .mixins import MultiRuleOutputMixin
+from sigma.parser.modifiers.type import SigmaValueListModifier
+from .mixins import MultiRuleOutputMixin, ValueListMixin
 
-class SplunkBackend(SingleTextQueryBackend):
-    """Converts Sigma rule into Splunk Search Processing Language (SPL)."""
+logger = logging.getLogger(__name__)
+
+class SplunkBackend(ValueListMixin, SingleTextQueryBackend):
+    """
+    Converts Sigma rule into Splunk Search Processing Language (SPL).
+
+    Large value lists are searched with an inputlookup subsearch on a lookup table with the column value. Splunk
+    truncates subsearch results at the maxout limit of limits.conf (subsearch_limit option), a warning is emitted for
+    lists with more values because values beyond the limit are silently not matched.
+    """
     identifier = "splunk"
     active = True
     index_field = "index"
+    options = SingleTextQueryBackend.options + ValueListMixin.options + (
+            ("list_lookup", "%s.csv", "Lookup table of value lists, %s is replaced with the list name", None),
+            ("subsearch_limit", 10000, "Maximum number of subsearch results (maxout in limits.conf), warns about larger value lists", None),
+            )
+    costWeights = dict(SingleTextQueryBackend.costWeights,
+            leading_wildcards=30,       # terms with leading wildcards can't be looked up in the index
+            unbound_keywords=5,         # keywords are searched in the index of raw events
+            )
 
     # \   -> \\
     # \*  -> \*
@@ -42,6 +62,13 @@ class SplunkBackend(SingleTextQueryBackend):
     mapExpression = "%s=%s"
     mapListsSpecialHandling = True
     mapListValueExpression = "%s IN %s"
+    valueListExpression = "[| inputlookup %s | rename value as %s | fields %s]"
+
+    def generateValueListLookup(self, fieldname, valuelist):
+        fieldname = self.fieldNameMapping(fieldname, valuelist)
+        if len(valuelist) > int(self.subsearch_limit):
+            logger.warning("Value list %s has %d values, the subsearch returns only the first %d of them", valuelist.name, len(valuelist), int(self.subsearch_limit))
+        return self.valueListExpression % (self.list_lookup % valuelist.name, fieldname, fieldname)
 
     def generateMapItemListNode(self, key, value):
         if not set([type(val) for val in value]).issubset({str, int}):
@@ -106,8 +133,140 @@ class SplunkBackend(SingleTextQueryBackend):
 
             return result
     
+class SplunkTstatsBackend(SplunkBackend):
+    """
+    Converts Sigma rule into Splunk tstats searches on accelerated CIM data models.
+
+    The data model of a rule is determined by the datamodels section of the configuration, which maps
+    log sources to a data model, node and the data model fields of Sigma fields:
+
+        datamodels:
+          process_creation:
+            category: process_creation
+            datamodel: Endpoint
+            node: Processes
+            fields:
+              Image: process_path
+
+    Aggregations are translated into the statistics function and by clause of tstats. Rules that can't
+    be expressed as tstats search (no data model for log source, fields that are not contained in the
+    data model, regular expressions and other type modifiers, values not bound to a field) are converted
+    into a raw search, marked with a comment macro that states the reason.
+    """
+    identifier = "splunk-tstats"
+    active = True
+    options = SplunkBackend.options + (
+            ("summariesonly", True, "Search only accelerated data model summaries (summariesonly=false searches raw events for not summarized time ranges)", None),
+            )
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.datamodel = None
+        if str(self.summariesonly).lower() in ("false", "0", "no"):
+            self.summariesonly = False
+        else:
+            self.summariesonly = True
+
+    def getDatamodel(self, sigmaparser):
+        """Return first data model definition from configuration that matches the log source of the rule."""
+        logsource = sigmaparser.parsedyaml.get("logsource", dict())
+        datamodels = (self.sigmaconfig.config or dict()).get("datamodels", dict())
+        for datamodel in datamodels.values():
+            if SigmaLogsourceConfiguration(datamodel).matches(logsource.get("category"), logsource.get("product"), logsource.get("service")):
+                return datamodel
+        return None
+
+    def fieldNameMapping(self, fieldname, value):
+        if self.datamodel is None:
+            return fieldname
+        return "%s.%s" % (self.datamodel["node"], self.datamodel["fields"][fieldname])
+
+    def unsupportedReason(self, node, datamodel):
+        """Return reason why parse tree node can't be expressed in tstats search or None if it can."""
+        if type(node) in (sigma.parser.condition.ConditionAND, sigma.parser.condition.ConditionOR):
+            for item in node:
+                if type(item) in (str, int):
+                    return "value not bound to a field"
+                reason = self.unsupportedReason(item, datamodel)
+                if reason is not None:
+                    return reason
+        elif type(node) == sigma.parser.condition.ConditionNOT:
+            return self.unsupportedReason(node.item, datamodel)
+        elif type(node) == sigma.parser.condition.NodeSubexpression:
+            return self.unsupportedReason(node.items, datamodel)
+        elif type(node) in (sigma.parser.condition.ConditionNULLValue, sigma.parser.condition.ConditionNotNULLValue):
+            if node.item not in datamodel["fields"]:
+                return "field %s not contained in data model %s" % (node.item, datamodel["datamodel"])
+        elif type(node) == tuple:
+            fieldname, value = node
+            if fieldname not in datamodel["fields"]:
+                return "field %s not contained in data model %s" % (fieldname, datamodel["datamodel"])
+            if isinstance(value, SigmaTypeModifier) and not isinstance(value, SigmaValueListModifier) or type(value) == list and any([ isinstance(item, SigmaTypeModifier) for item in value ]):
+                return "type modifier in value of field %s" % fieldname
+        elif type(node) in (str, int, list):
+            return "value not bound to a field"
+        return None
+
+    def generate(self, sigmaparser):
+        """Method is called for each sigma rule and receives the parsed rule (SigmaParser)"""
+        datamodel = self.getDatamodel(sigmaparser)
+        for parsed in sigmaparser.condparsed:
+            if datamodel is None:
+                reason = "no data model for log source"
+            else:
+                reason = self.unsupportedReason(parsed.parsedSearch, datamodel)
+            if reason is None and parsed.parsedAgg is not None:
+                if parsed.parsedAgg.aggfunc == sigma.parser.condition.SigmaAggregationParser.AGGFUNC_NEAR:
+                    raise NotImplementedError("The 'near' aggregation operator is not yet implemented for this backend")
+                for fieldname in (parsed.parsedAgg.aggfield, parsed.parsedAgg.groupfield):
+                    if fieldname is not None and fieldname not in datamodel["fields"]:
+                        reason = "aggregation field %s not contained in data model %s" % (fieldname, datamodel["datamodel"])
+            if reason is not None:
+                return "`comment(\"tstats not possible, raw search: %s\")` %s" % (reason, super().generate(sigmaparser))
+
+            self.datamodel = datamodel
+            try:
+                query = self.generateTstats(parsed, sigmaparser)
+            finally:
+                self.datamodel = None
+            before = self.generateBefore(parsed)
+            after = self.generateAfter(parsed)
+            return (before or "") + query + (after or "")
+
+    def generateTstats(self, parsed, sigmaparser):
+        where = self.generateNode(parsed.parsedSearch)
+        agg = parsed.parsedAgg
+        condition = ""
+        by = list()
+        if agg is None:
+            function = "count"
+            for field in sigmaparser.parsedyaml.get("fields", list()):      # group by fields that should be displayed
+                if field in self.datamodel["fields"]:
+                    by.append(self.fieldNameMapping(field, None))
+        else:
+            if agg.aggfield is None:
+                function = "count"
+            else:
+                aggfunc = agg.aggfunc_notrans
+                if aggfunc == "count":
+                    aggfunc = "dc"
+                function = "%s(%s) as count" % (aggfunc, self.fieldNameMapping(agg.aggfield, None))
+            if agg.groupfield is not None:
+                by.append(self.fieldNameMapping(agg.groupfield, None))
+            condition = " | where count %s %s" % (agg.cond_op, agg.condition)
+
+        result = "| tstats summariesonly=%s %s from datamodel=%s.%s" % (str(self.summariesonly).lower(), function, self.datamodel["datamodel"], self.datamodel["node"])
+        if where:
+            result += " where " + where
+        if by:
+            result += " by " + ", ".join(by)
+        return result + condition
+
 class SplunkXMLBackend(SingleTextQueryBackend, MultiRuleOutputMixin):
-    """Converts Sigma rule into XML used for Splunk Dashboard Panels"""
+    """
+    Converts Sigma rule into XML used for Splunk Dashboard Panels. The panels are returned as soon as they are
+    generated, the first one is preceded by the beginning of the dashboard that is closed by finalize().
+    """
     identifier = "splunkxml"
     active = True
     index_field = "index"
@@ -123,7 +282,7 @@ class SplunkXMLBackend(SingleTextQueryBackend, MultiRuleOutputMixin):
     dash_pre = "<form><label>MyDashboard</label><fieldset submitButton=\"false\"><input type=\"time\" token=\"field1\">" \
                "<label></label><default><earliest>-24h@h</earliest><latest>now</latest></default></input></fieldset>"
     dash_suf = "</form>"
-    queries = dash_pre
+    dashboardStarted = False
 
 
     reEscape = re.compile('("|(?<!\\\\)\\\\(?![*?\\\\]))')
@@ -156,17 +315,23 @@ class SplunkXMLBackend(SingleTextQueryBackend, MultiRuleOutputMixin):
 
     def generate(self, sigmaparser):
         """Method is called for each sigma rule and receives the parsed rule (SigmaParser)"""
+        panels = ""
         for parsed in sigmaparser.condparsed:
             query = self.generateQuery(parsed)
             if query is not None:
-                self.queries += self.panel_pre
-                self.queries += self.getRuleName(sigmaparser)
-                self.queries += self.panel_inf
+                panels += self.panel_pre
+                panels += self.getRuleName(sigmaparser)
+                panels += self.panel_inf
                 query = query.replace("<", "&lt;")
                 query = query.replace(">", "&gt;")
-                self.queries += query
-                self.queries += self.panel_suf
+                panels += query
+                panels += self.panel_suf
+        if panels and not self.dashboardStarted:
+            self.dashboardStarted = True
+            return self.dash_pre + panels
+        return panels
 
     def finalize(self):
-        self.queries += self.dash_suf
-        return self.queries
+        if not self.dashboardStarted:
+            return self.dash_pre + self.dash_suf
+        return self.dash_suf
@@ -16,12 +16,65 @@
 
 import re
 import sigma
+from sigma.parser.modifiers.type import SigmaRegularExpressionModifier
 from .base import SingleTextQueryBackend
+from .mixins import MultiRuleOutputMixin, ValueListMixin
 
-class SQLBackend(SingleTextQueryBackend):
-    """Converts Sigma rule into SQL query"""
+class SQLBackend(ValueListMixin, SingleTextQueryBackend, MultiRuleOutputMixin):
+    """
+    Converts Sigma rule into SQL query
+
+    The output option selects between:
+
+    * where: search condition of each rule (default)
+    * query: SELECT statement for each rule
+    * multirule: one SELECT statement per table that evaluates all rules in a single table scan and returns the
+      rule_id of the matching rule followed by the columns of the event row. Conditions contained in all rules of a
+      table are evaluated once in the WHERE clause of a CTE that preselects the rows matched by any rule, the remaining
+      condition of each rule is evaluated on these rows in the WHERE clause of the SELECT statement of the rule. The
+      CTE is referenced once per rule and is materialized by SQLite >= 3.35 and PostgreSQL >= 12.
+
+    The dialect option selects the SQL flavour. The default dialect keeps the generic output of this backend, all other
+    dialects use standard string literals, Sigma wildcard and escaping semantics, IS NULL conditions and evaluate NOT
+    of conditions on missing (NULL) columns to true. Exact values are matched case-insensitive with = and IN like
+    wildcard values, conditions that can be served by an index are put first in AND conditions. With negations=grouped, negations are grouped into one NOT
+    block after them.
+
+    * sqlite: LIKE with escape character and REGEXP (requires a user function in SQLite) for regular expressions. Exact
+      values are compared with COLLATE NOCASE, which is served by an index on the column with COLLATE NOCASE. Like
+      LIKE, it only folds the case of ASCII characters.
+    * sqlite-fts5: like sqlite, but values with literal parts of at least three characters and keywords are searched
+      in an external content FTS5 table with trigram tokenizer and the same columns as the queried table (fts_table
+      option), created with:
+      CREATE VIRTUAL TABLE eventlog_fts USING fts5(..., content='eventlog', content_rowid='rowid column', tokenize='trigram')
+    * postgresql: case-insensitive ILIKE and ~ for regular expressions, both are served by pg_trgm GIN indexes. Exact
+      values are compared in lower case with LOWER(column), which is served by an expression index on LOWER(column).
+
+    Large value lists are matched with a semi-join against a (temporary) table with the column value that contains the
+    list (list_table option). The lookup compares like the inlined list of the dialect, so rules match the same rows on
+    both sides of list_threshold: with COLLATE NOCASE in the SQLite dialects, with LOWER() on both sides in postgresql
+    and the default dialect, whose inlined lists are matched with the case-insensitive LIKE.
+    """
     identifier = "sql"
     active = True
+    options = SingleTextQueryBackend.options + ValueListMixin.options + (
+            ("table", "eventlog", "Table that is queried by rules whose log source doesn't define an index", None),
+            ("output", "where", "Output format: where = search condition, query = SELECT statement per rule, multirule = one SELECT statement per table for all rules", "output_type"),
+            ("dialect", "default", "SQL dialect: default, sqlite, sqlite-fts5 or postgresql", None),
+            ("fts_table", "%s_fts", "FTS5 table used by the sqlite-fts5 dialect, %s is replaced with the queried table", None),
+            ("list_table", "sigma_list_%s", "Table with values of a value list in column value, %s is replaced with the list name", None),
+            )
+    dialects = {                            # dialect -> (LIKE expression, regular expression match), first %s is field name, second is value
+            "default": (None, None),
+            "sqlite": ("%s LIKE %s ESCAPE '\\'", "%s REGEXP %s"),
+            "sqlite-fts5": ("%s LIKE %s ESCAPE '\\'", "%s REGEXP %s"),
+            "postgresql": ("%s ILIKE %s", "%s ~ %s"),
+            }
+    dialectCaseInsensitive = {              # dialect -> (=, IN, value list lookup) of case-insensitive comparisons of exact values with letters, first %s is field name
+            "sqlite": ("%s = %s COLLATE NOCASE", "%s COLLATE NOCASE IN %s", "%s COLLATE NOCASE IN (SELECT value FROM %s)"),
+            "sqlite-fts5": ("%s = %s COLLATE NOCASE", "%s COLLATE NOCASE IN %s", "%s COLLATE NOCASE IN (SELECT value FROM %s)"),
+            "postgresql": ("LOWER(%s) = %s", "LOWER(%s) IN %s", "LOWER(%s) IN (SELECT LOWER(value) FROM %s)"),
+            }
 
     andToken = " AND "                      # Token used for linking expressions with logical AND
     orToken = " OR "                        # Same for OR
@@ -36,11 +89,100 @@ class SQLBackend(SingleTextQueryBackend):
     mapMulti = "%s IN %s"                   # Syntax for field/value conditions. First %s is fieldname, second is value
     mapWildcard = "%s LIKE %s"              # Syntax for swapping wildcard conditions.
     mapSource = "%s=%s"                     # Syntax for sourcetype
+    valueListExpression = "LOWER(%s) IN (SELECT LOWER(value) FROM %s)"     # Syntax for value list lookups. First %s is fieldname, second is table
     mapListsSpecialHandling = False         # Same handling for map items with list values as for normal values (strings, integers) if True, generateMapItemListNode method is called with node
     mapListValueExpression = "%s OR %s"     # Syntax for field/value condititons where map value is a list
     mapLength = "(%s %s)"
+    multiRuleCTE = "sigma_matches"          # Name of the CTE that contains the matches of all rules in multirule output
+    dialectNullExpression = "%s IS NULL"    # Expression of queries for null values in dialects. %s is field name
+    dialectNotNullExpression = "%s IS NOT NULL"     # Same for not null values
+    dialectNotExpression = "NOT COALESCE(%s, FALSE)"    # NOT of conditions in dialects, conditions on NULL values are false instead of NULL
+    ftsExpression = "rowid IN (SELECT rowid FROM %s WHERE %s MATCH %s)"     # Full text search in sqlite-fts5 dialect. First and second %s is FTS table, third is query
+    ftsMinLength = 3                        # Minimum length of literal value parts searched with trigram index
+    reSigmaToken = re.compile(r"\\[*?\\]|[*?]|[^\\*?]+|\\")     # Escaped characters, wildcards, literal text and single backslashes
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tableRules = dict()            # table name -> list of (rule_id, list of conditions that are ANDed)
+        self.currentTable = self.table
+        if self.dialect not in self.dialects:
+            raise NotImplementedError("SQL dialect '%s' not supported" % self.dialect)
+        self.likeExpression, self.regexExpression = self.dialects[self.dialect]
+        self.nocaseExpression, self.nocaseMulti, self.valueListExpression = self.dialectCaseInsensitive.get(self.dialect, (self.mapExpression, self.mapMulti, self.valueListExpression))
+
+    def generate(self, sigmaparser):
+        logsource = sigmaparser.get_logsource()
+        tables = [ self.table ]
+        if logsource is not None and len(logsource.index) > 0:
+            tables = logsource.index
+
+        if self.output_type == "where":
+            self.currentTable = tables[0]
+            return super().generate(sigmaparser)
+        elif self.output_type == "query":
+            queries = list()
+            for table in tables:
+                self.currentTable = table
+                queries.append("SELECT * FROM %s WHERE %s;" % (table, super().generate(sigmaparser)))
+            return "\n".join(queries)
+        elif self.output_type == "multirule":
+            for parsed in sigmaparser.condparsed:
+                if parsed.parsedAgg:
+                    self.generateAggregation(parsed.parsedAgg)
+                rulename = self.getRuleName(sigmaparser)
+                for table in tables:
+                    self.currentTable = table
+                    self.tableRules.setdefault(table, list()).append((rulename, self.generateConjunction(parsed.parsedSearch)))
+        else:
+            raise NotImplementedError("Output type '%s' not supported" % self.output_type)
+
+    def generateConjunction(self, node):
+        """Generate list of conditions of the top-level AND node of a parse tree or a list with the whole condition"""
+        while type(node) == sigma.parser.condition.NodeSubexpression:
+            node = node.items
+        if type(node) == sigma.parser.condition.ConditionAND:
+            items = node.items
+        else:
+            items = [ node ]
+        conditions = list()
+        for item in items:
+            generated = self.generateNode(item)
+            if generated is None:
+                continue
+            if type(item) in (sigma.parser.condition.ConditionAND, sigma.parser.condition.ConditionOR):
+                generated = self.subExpression % generated
+            conditions.append(generated)
+        return conditions
+
+    def generateMultiRuleQuery(self, table, rules):
+        """Generate one query that evaluates all rules of a table and returns (rule_id, row) pairs"""
+        common = [ condition for condition in rules[0][1] if all([ condition in conditions for _, conditions in rules[1:] ]) ]
+        predicates = list()
+        for _, conditions in rules:
+            remaining = [ condition for condition in conditions if condition not in common ]
+            predicates.append(self.andToken.join(remaining) if remaining else None)
+
+        where = list(common)
+        if None not in predicates:      # a rule that consists only of common conditions matches all preselected rows
+            where.append(self.subExpression % self.orToken.join([ self.subExpression % predicate for predicate in predicates ]))
+        projections = [
+                "SELECT '%s' AS rule_id, * FROM %s%s" % (rulename.replace("'", "''"), self.multiRuleCTE, "" if predicate is None else " WHERE " + predicate)
+                for (rulename, _), predicate in zip(rules, predicates)
+                ]
+        return "WITH %s AS (\n  SELECT *\n  FROM %s%s\n)\n%s;" % (
+                self.multiRuleCTE,
+                table,
+                "\n  WHERE " + self.andToken.join(where) if where else "",
+                "\nUNION ALL\n".join(projections),
+                )
+
+    def finalize(self):
+        if self.output_type == "multirule":
+            return "\n\n".join([ self.generateMultiRuleQuery(table, rules) for table, rules in self.tableRules.items() ])
 
     def generateANDNode(self, node):
+        if self.dialect != "default":
+            return self.generateDialectANDNode(node)
         generated = [ self.generateNode(val) for val in node ]
         filtered = [ g for g in generated if g is not None ]
         if filtered:
@@ -58,7 +200,9 @@ class SQLBackend(SingleTextQueryBackend):
 
     def generateNOTNode(self, node):
         generated = self.generateNode(node.item)
-        if generated is not None:
+        if generated is not None and self.dialect != "default":
+            return self.dialectNotExpression % generated
+        elif generated is not None:
             return self.notToken + generated
         else:
             return None
@@ -73,11 +217,15 @@ class SQLBackend(SingleTextQueryBackend):
     def generateListNode(self, node):
         if not set([type(value) for value in node]).issubset({str, int}):
             raise TypeError("List values must be strings or numbers")
+        if self.dialect != "default":
+            return self.subExpression % self.orToken.join([ self.generateValueNode(value) for value in node ])
         return self.listExpression % (self.listSeparator.join([self.generateNode(value) for value in node]))
 
     def generateMapItemNode(self, node):
         fieldname, value = node
         transformed_fieldname = self.fieldNameMapping(fieldname, value)
+        if self.dialect != "default":
+            return self.generateDialectMapItemNode(transformed_fieldname, value)
         if "," in self.generateNode(value) and "%" not in self.generateNode(value):
             return self.mapMulti % (transformed_fieldname, self.generateNode(value))
         elif "LENGTH" in transformed_fieldname:
@@ -96,18 +244,166 @@ class SQLBackend(SingleTextQueryBackend):
         else:
             raise TypeError("Backend does not support map values of type " + str(type(value)))
 
+    def generateValueListLookup(self, fieldname, valuelist):
+        return self.valueListExpression % (self.fieldNameMapping(fieldname, valuelist), self.list_table % valuelist.name)
+
     def generateMapItemListNode(self, key, value):
         return "(" + (" OR ".join(['%s LIKE %s' % (key, self.generateValueNode(item)) for item in value])) + ")"
     
     def generateValueNode(self, node):
+        if self.dialect != "default":
+            return self.generateKeywordCondition(self.sigmaValueTokens(node))
         return self.valueExpression % (self.cleanValue(str(node)))
 
     def generateNULLValueNode(self, node):
+        if self.dialect != "default":
+            return self.dialectNullExpression % node.item
         return self.nullExpression % (node.item)
 
     def generateNotNULLValueNode(self, node):
+        if self.dialect != "default":
+            return self.dialectNotNullExpression % node.item
         return self.notNullExpression % (node.item)
 
+    def generateDialectANDNode(self, node):
+        items = sorted(node, key=lambda item: not self.indexServed(item))     # stable sort, index-served conditions first
+        generated = list()
+        for item in items:
+            condition = self.generateNode(item)
+            if condition is None:
+                continue
+            if type(item) == sigma.parser.condition.ConditionOR:
+                condition = self.subExpression % condition
+            generated.append(condition)
+        if generated:
+            return self.andToken.join(generated)
+        else:
+            return None
+
+    def generateDialectMapItemNode(self, fieldname, value):
+        if type(value) == list:
+            tokens = [ self.sigmaValueTokens(item) for item in value ]
+            if len(tokens) > 1 and not any([ self.hasWildcard(item) for item in tokens ]):
+                literals = [ self.literalValue(item) for item in tokens ]
+                if any([ self.hasCase(literal) for literal in literals ]):
+                    return self.nocaseMulti % (fieldname, self.listExpression % self.listSeparator.join([ self.sqlString(self.nocaseLiteral(literal)) for literal in literals ]))
+                return self.mapMulti % (fieldname, self.listExpression % self.listSeparator.join([ self.sqlString(literal) for literal in literals ]))
+            if self.dialect == "sqlite-fts5" and len(tokens) > 1 and all([ self.isContains(item) and len(self.literalValue(item[1:-1])) >= self.ftsMinLength for item in tokens ]):
+                return self.generateFTSCondition([ self.literalValue(item[1:-1]) for item in tokens ], fieldname, " OR ")
+            return self.subExpression % self.orToken.join([ self.generateValueCondition(fieldname, item) for item in tokens ])
+        elif type(value) in (str, int):
+            return self.generateValueCondition(fieldname, self.sigmaValueTokens(value))
+        elif value is None:
+            return self.dialectNullExpression % fieldname
+        elif isinstance(value, SigmaRegularExpressionModifier):
+            return self.regexExpression % (fieldname, self.sqlString(value.value))
+        else:
+            raise TypeError("Backend does not support map values of type " + str(type(value)))
+
+    def generateValueCondition(self, fieldname, tokens):
+        """Condition for Sigma value given as tokens in field"""
+        if not self.hasWildcard(tokens):
+            literal = self.literalValue(tokens)
+            if self.hasCase(literal):
+                return self.nocaseExpression % (fieldname, self.sqlString(self.nocaseLiteral(literal)))
+            return self.mapExpression % (fieldname, self.sqlString(literal))
+        like = self.likeExpression % (fieldname, self.sqlString(self.likePattern(tokens)))
+        if self.dialect == "sqlite-fts5":
+            fragments = [ fragment for fragment in self.literalFragments(tokens) if len(fragment) >= self.ftsMinLength ]
+            if fragments:
+                match = self.generateFTSCondition(fragments, fieldname)
+                if self.isContains(tokens):         # substring search is completely answered by trigram index
+                    return match
+                return self.subExpression % (match + self.andToken + like)
+        return like
+
+    def generateKeywordCondition(self, tokens):
+        """Condition for Sigma keyword given as tokens, which is searched as substring in all columns"""
+        fragments = self.literalFragments(tokens)
+        if self.dialect == "sqlite-fts5" and len(fragments) == 1 and len(fragments[0]) >= self.ftsMinLength:
+            return self.generateFTSCondition(fragments)
+        raise NotImplementedError("Keyword searches are not supported by SQL dialect %s" % self.dialect)
+
+    def generateFTSCondition(self, fragments, fieldname=None, operator=" AND "):
+        terms = [ "\"%s\"" % fragment.replace("\"", "\"\"") for fragment in fragments ]
+        if fieldname is not None:
+            terms = [ "%s : %s" % (fieldname, term) for term in terms ]
+        fts_table = self.fts_table % self.currentTable
+        return self.ftsExpression % (fts_table, fts_table, self.sqlString(operator.join(terms)))
+
+    def indexServed(self, node):
+        """Returns True if condition can be answered by an index in the selected dialect"""
+        if type(node) == sigma.parser.condition.ConditionAND:
+            return any([ self.indexServed(item) for item in node ])
+        elif type(node) == sigma.parser.condition.ConditionOR:
+            return all([ self.indexServed(item) for item in node ])
+        elif type(node) == sigma.parser.condition.NodeSubexpression:
+            return self.indexServed(node.items)
+        elif type(node) == tuple:
+            value = node[1]
+            if type(value) == list:
+                return len(value) > 0 and all([ self.indexServed((node[0], item)) for item in value ])
+            elif type(value) in (str, int):
+                tokens = self.sigmaValueTokens(value)
+                if not self.hasWildcard(tokens):
+                    return True
+                elif self.dialect in ("sqlite-fts5", "postgresql"):
+                    return any([ len(fragment) >= self.ftsMinLength for fragment in self.literalFragments(tokens) ])
+            elif isinstance(value, SigmaRegularExpressionModifier):
+                return self.dialect == "postgresql"
+        elif type(node) in (str, int):
+            return self.dialect == "sqlite-fts5"
+        return False
+
+    def sigmaValueTokens(self, value):
+        """Split Sigma value into list of (wildcard, text) tuples of unescaped literal text and * or ? wildcards"""
+        tokens = list()
+        for token in self.reSigmaToken.findall(str(value)):
+            if token in ("*", "?"):
+                tokens.append((True, token))
+            elif len(token) == 2 and token[0] == "\\":
+                tokens.append((False, token[1]))
+            else:
+                tokens.append((False, token))
+        return tokens
+
+    def hasWildcard(self, tokens):
+        return any([ wildcard for wildcard, _ in tokens ])
+
+    def isContains(self, tokens):
+        """Value is a substring search: *literal*"""
+        return len(tokens) >= 3 and tokens[0] == tokens[-1] == (True, "*") and not self.hasWildcard(tokens[1:-1])
+
+    def literalValue(self, tokens):
+        return "".join([ text for _, text in tokens ])
+
+    def hasCase(self, value):
+        """Value contains letters, values without them (e.g. numbers) are compared with plain = and IN"""
+        return value.lower() != value.upper()
+
+    def nocaseLiteral(self, value):
+        """Value of case-insensitive comparison, lower case for LOWER(column) in PostgreSQL"""
+        return value.lower() if self.dialect == "postgresql" else value
+
+    def literalFragments(self, tokens):
+        """Literal parts of value between wildcards"""
+        fragments = [ "" ]
+        for wildcard, text in tokens:
+            if wildcard:
+                fragments.append("")
+            else:
+                fragments[-1] += text
+        return [ fragment for fragment in fragments if fragment ]
+
+    def likePattern(self, tokens):
+        return "".join([
+            ("%" if text == "*" else "_") if wildcard else re.sub(r"([%_\\])", r"\\\1", text)
+            for wildcard, text in tokens
+            ])
+
+    def sqlString(self, value):
+        return "'%s'" % str(value).replace("'", "''")
+
     def fieldNameMapping(self, fieldname, value):
         """
         Alter field names depending on the value(s). Backends may use this method to perform a final transformation of the field name
@@ -14,19 +14,44 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import json
+import logging
+import re
 from .base import BaseBackend
+from sigma.selectivity import SigmaFieldStatistics
+
+logger = logging.getLogger(__name__)
 
 ### Backends for developement purposes
 
 class FieldnameListBackend(BaseBackend):
-    """List all fieldnames from given Sigma rules for creation of a field mapping configuration."""
+    """
+    List all fieldnames from given Sigma rules for creation of a field mapping configuration. Keyword fields of the
+    configuration are listed for rules with keywords. Rules whose keywords are still searched in all fields because no
+    keyword fields are configured for their log source are reported with the unbound_report option.
+    """
     identifier = "fieldlist"
     active = True
     config_required = False
+    options = BaseBackend.options + (
+            ("unbound_report", False, "Report rules with keywords that are searched in all fields", None),
+            )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.fields = set()
+        self.unboundRules = list()      # titles of rules with keywords that are searched in all fields
+        self.unboundKeywords = False
+
+    def generate(self, sigmaparser):
+        self.unboundKeywords = False
+        for parsed in sigmaparser.condparsed:
+            self.generateQuery(parsed)
+        if self.unboundKeywords:
+            title = sigmaparser.parsedyaml.get("title")
+            self.unboundRules.append(title)
+            if str(self.unbound_report).lower() not in ("false", "0", "no"):
+                logger.warning("Keywords of rule '%s' are searched in all fields, no keyword fields are configured for its log source", title)
 
     def generateQuery(self, parsed):
         fields = list(flatten(self.generateNode(parsed.parsedSearch)))
@@ -58,8 +83,12 @@ class FieldnameListBackend(BaseBackend):
         return [key]
 
     def generateValueNode(self, node):
+        self.unboundKeywords = True
         return []
 
+    def generateTypedValueNode(self, node):
+        return self.generateValueNode(node)
+
     def generateNULLValueNode(self, node):
         return [node.item]
 
@@ -77,6 +106,235 @@ class FieldnameListBackend(BaseBackend):
     def finalize(self):
         return "\n".join(sorted(self.fields))
 
+class IndexAdvisorBackend(FieldnameListBackend):
+    """
+    Collects how fields are searched by the given Sigma rules and recommends storage of the fields by the usage weighted
+    with level and status of the rules. Each field is counted once per rule and usage kind: exact, exact_text (exact
+    values with letters, which SQL dialects compare case-insensitive), prefix, suffix, contains, wildcard, regex, null
+    (existence checks), group_by and aggregation fields of aggregations. Keywords that
+    are not searched in keyword fields of the configuration are counted as usage of the unbound field.
+
+    The output option selects between:
+
+    * report: one tab-separated line per field with number of rules, weight, weight per usage kind and recommendations
+      (default)
+    * es-template: Elasticsearch composable index template. Fields with substring, wildcard or regular expression
+      searches are mapped as wildcard fields, fields with suffix searches get a reversed subfield (suffix searches become
+      prefix searches), other fields are mapped as keyword and the unbound field as text.
+    * splunk: fields.conf stanzas of fields that benefit from indexed extraction (exact values, prefixes and
+      aggregations), ranked by the weight of these usages. Indexed fields additionally require transforms.conf and
+      props.conf configuration.
+    * sql: CREATE INDEX statements for the tables queried by the sql backend in the dialect of the dialect option
+      (B-tree, NOCASE indexes for exact text values and prefix searches with LIKE in SQLite, FTS5 trigram table for
+      sqlite-fts5, LOWER() expression indexes for exact text values and pg_trgm GIN indexes for PostgreSQL).
+    """
+    identifier = "index-advisor"
+    active = True
+    config_required = False
+    options = FieldnameListBackend.options + (
+            ("output", "report", "Output format: report, es-template, splunk or sql", "output_type"),
+            ("index", None, "Index pattern or table for rules whose log source doesn't define an index (default: * for es-template, eventlog for sql)", None),
+            ("dialect", "default", "SQL dialect of sql output: default, sqlite, sqlite-fts5 or postgresql", None),
+            ("fts_table", "%s_fts", "FTS5 table of the sqlite-fts5 dialect, %s is replaced with the table", None),
+            ("unbound_field", "message", "Field that is searched by keywords", None),
+            ("min_weight", 0, "Minimum weight of recommended fields", None),
+            ("top", 0, "Maximum number of recommended fields, 0 = unlimited", None),
+            )
+    levelWeights = {
+            "critical": 8,
+            "high": 4,
+            "medium": 2,
+            "low": 1,
+            "informational": 0.5,
+            }
+    statusWeights = {
+            "stable": 1,
+            "test": 0.75,
+            "testing": 0.75,
+            "experimental": 0.5,
+            "unsupported": 0.1,
+            "deprecated": 0,
+            }
+    defaultLevelWeight = 1              # weight of rules without or with unknown level
+    defaultStatusWeight = 0.5           # same for status
+    usageKinds = ("exact", "exact_text", "prefix", "suffix", "contains", "wildcard", "regex", "null", "keyword", "group_by", "aggregation")
+    splunkIndexedKinds = { "exact", "exact_text", "prefix", "null", "group_by", "aggregation" }   # served by indexed fields and tstats
+    sqlIndexKinds = {                   # dialect -> index kind -> usage kinds served by the index
+            "default": { "btree": { "exact", "exact_text", "prefix", "null", "group_by", "aggregation" } },
+            "sqlite": { "btree": { "exact", "null", "group_by", "aggregation" }, "nocase": { "exact_text", "prefix" } },
+            "sqlite-fts5": { "btree": { "exact", "null", "group_by", "aggregation" }, "nocase": { "exact_text", "prefix" }, "fts": { "suffix", "contains", "wildcard", "keyword" } },
+            "postgresql": { "btree": { "exact", "null", "group_by", "aggregation" }, "lower": { "exact_text" }, "trigram": { "prefix", "suffix", "contains", "wildcard", "regex" } },
+            }
+    sqlIndexExpressions = {             # index kind -> CREATE INDEX statement, %s are index name, table and field
+            "btree": "CREATE INDEX IF NOT EXISTS %s ON %s (%s);",
+            "nocase": "CREATE INDEX IF NOT EXISTS %s ON %s (%s COLLATE NOCASE);",
+            "lower": "CREATE INDEX IF NOT EXISTS %s ON %s (LOWER(%s));",
+            "trigram": "CREATE INDEX IF NOT EXISTS %s ON %s USING gin (%s gin_trgm_ops);",
+            }
+    reIndexName = re.compile("\\W")
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.output_type not in ("report", "es-template", "splunk", "sql"):
+            raise NotImplementedError("Output type '%s' not supported" % self.output_type)
+        if self.dialect not in self.sqlIndexKinds:
+            raise NotImplementedError("SQL dialect '%s' not supported" % self.dialect)
+        self.usage = dict()             # field -> usage kind -> weight
+        self.rules = dict()             # field -> set of rule identifiers
+        self.tables = dict()            # field -> set of indices/tables, None for the default
+        self.valueKinds = SigmaFieldStatistics()
+        self.currentUsage = set()
+
+    def generate(self, sigmaparser):
+        yaml = sigmaparser.parsedyaml
+        weight = self.levelWeights.get(yaml.get("level"), self.defaultLevelWeight) * self.statusWeights.get(yaml.get("status"), self.defaultStatusWeight)
+        self.currentUsage = set()
+        super().generate(sigmaparser)
+        logsource = sigmaparser.get_logsource()
+        tables = logsource.index if logsource is not None and len(logsource.index) > 0 else [ None ]
+        rule = yaml.get("id") or yaml.get("title")
+        for field, kind in self.currentUsage:
+            usage = self.usage.setdefault(field, dict())
+            usage[kind] = usage.get(kind, 0) + weight
+            self.rules.setdefault(field, set()).add(rule)
+            self.tables.setdefault(field, set()).update(tables)
+
+    def generateMapItemNode(self, node):
+        key, value = node
+        for item in value if type(value) == list else [ value ]:
+            self.currentUsage.add((key, "null" if item is None else self.valueKind(item)))
+        return [key]
+
+    def valueKind(self, value):
+        kind = self.valueKinds.valueKind(value)
+        if kind == "exact" and type(value) == str and value.lower() != value.upper():
+            return "exact_text"
+        return kind
+
+    def generateListNode(self, node):
+        return [ self.generateNode(value) for value in node ]
+
+    def generateValueNode(self, node):
+        self.currentUsage.add((self.unbound_field, "keyword"))
+        return super().generateValueNode(node)
+
+    def generateNULLValueNode(self, node):
+        self.currentUsage.add((node.item, "null"))
+        return [node.item]
+
+    def generateNotNULLValueNode(self, node):
+        return self.generateNULLValueNode(node)
+
+    def generateAggregation(self, agg):
+        if agg.groupfield is not None:
+            self.currentUsage.add((agg.groupfield, "group_by"))
+        if agg.aggfield is not None:
+            self.currentUsage.add((agg.aggfield, "aggregation"))
+        return super().generateAggregation(agg)
+
+    def weight(self, field, kinds=None):
+        """Weight of all usages of a field or of the given usage kinds"""
+        return sum([ weight for kind, weight in self.usage[field].items() if kinds is None or kind in kinds ])
+
+    def rankedFields(self, kinds=None):
+        """Fields with usages of the given kinds ordered by descending weight, limited by the min_weight and top options"""
+        fields = [ field for field in self.usage if self.weight(field, kinds) > 0 and self.weight(field, kinds) >= float(self.min_weight) ]
+        fields.sort(key=lambda field: (-self.weight(field, kinds), field))
+        if int(self.top) > 0:
+            fields = fields[:int(self.top)]
+        return fields
+
+    def recommendElasticsearch(self, field):
+        """Elasticsearch field type: text, wildcard, keyword+reversed or keyword"""
+        usage = self.usage[field]
+        if set(usage) == { "keyword" }:
+            return "text"
+        elif any([ kind in usage for kind in ("contains", "wildcard", "regex") ]):
+            return "wildcard"
+        elif "suffix" in usage:
+            return "keyword+reversed"
+        return "keyword"
+
+    def recommendSplunk(self, field):
+        return "indexed" if self.weight(field, self.splunkIndexedKinds) > 0 else "search-time"
+
+    def recommendSQL(self, field):
+        """List of index kinds for the dialect that serve usages of the field"""
+        return [ index for index, kinds in self.sqlIndexKinds[self.dialect].items() if self.weight(field, kinds) > 0 ]
+
+    def finalize(self):
+        if self.output_type == "es-template":
+            return self.generateElasticsearchTemplate()
+        elif self.output_type == "splunk":
+            return self.generateSplunkIndexedFields()
+        elif self.output_type == "sql":
+            return self.generateSQLIndexes()
+        lines = [ "\t".join(("field", "rules", "weight", "usage", "elasticsearch", "splunk", "sql")) ]
+        for field in self.rankedFields():
+            lines.append("\t".join((
+                field,
+                str(len(self.rules[field])),
+                "%g" % self.weight(field),
+                ",".join([ "%s=%g" % (kind, self.usage[field][kind]) for kind in self.usageKinds if kind in self.usage[field] ]),
+                self.recommendElasticsearch(field),
+                self.recommendSplunk(field),
+                ",".join(self.recommendSQL(field)) or "-",
+                )))
+        return "\n".join(lines)
+
+    def tableNames(self, fields, default):
+        return sorted({ default if table is None else table for field in fields for table in self.tables[field] })
+
+    def generateElasticsearchTemplate(self):
+        fields = self.rankedFields()
+        properties = dict()
+        reversed_analyzer = False
+        for field in sorted(fields):
+            recommendation = self.recommendElasticsearch(field)
+            if recommendation == "keyword+reversed":
+                properties[field] = { "type": "keyword", "fields": { "reversed": { "type": "text", "analyzer": "sigma_reversed" } } }
+                reversed_analyzer = True
+            else:
+                properties[field] = { "type": recommendation }
+        template = { "mappings": { "properties": properties } }
+        if reversed_analyzer:
+            template["settings"] = { "analysis": { "analyzer": { "sigma_reversed": { "type": "custom", "tokenizer": "keyword", "filter": [ "lowercase", "reverse" ] } } } }
+        return json.dumps({
+            "index_patterns": self.tableNames(fields, self.index or "*"),
+            "template": template,
+            }, indent=2)
+
+    def generateSplunkIndexedFields(self):
+        lines = list()
+        for field in self.rankedFields(self.splunkIndexedKinds):
+            if field == self.unbound_field and set(self.usage[field]) == { "keyword" }:
+                continue
+            lines.append("# weight %g in %d rules" % (self.weight(field, self.splunkIndexedKinds), len(self.rules[field])))
+            lines.append("[%s]" % field)
+            lines.append("INDEXED = true")
+            lines.append("")
+        return "\n".join(lines)
+
+    def generateSQLIndexes(self):
+        statements = list()
+        if self.dialect == "postgresql":
+            statements.append("CREATE EXTENSION IF NOT EXISTS pg_trgm;")
+        fields = self.rankedFields()
+        for table in self.tableNames(fields, self.index or "eventlog"):
+            fts_columns = list()
+            for field in fields:
+                if table not in self.tables[field] and not (table == (self.index or "eventlog") and None in self.tables[field]):
+                    continue
+                for index in self.recommendSQL(field):
+                    if index == "fts":
+                        fts_columns.append(field)
+                    else:
+                        name = self.reIndexName.sub("_", "sigma_%s_%s_%s" % (table, field, index))
+                        statements.append(self.sqlIndexExpressions[index] % (name, table, field))
+            if fts_columns:
+                statements.append("CREATE VIRTUAL TABLE IF NOT EXISTS %s USING fts5(%s, content='%s', tokenize='trigram');" % (self.fts_table % table, ", ".join(sorted(fts_columns)), table))
+        return "\n".join(statements)
+
 # Helpers
 def flatten(l):
   for i in l:
@@ -16,12 +16,14 @@
 
 import re
 from .base import SingleTextQueryBackend
+from .mixins import KustoTermMixin
 from .exceptions import NotSupportedError
 
-class WindowsDefenderATPBackend(SingleTextQueryBackend):
+class WindowsDefenderATPBackend(KustoTermMixin, SingleTextQueryBackend):
     """Converts Sigma rule into Windows Defender ATP Hunting Queries."""
     identifier = "wdatp"
     active = True
+    options = SingleTextQueryBackend.options + KustoTermMixin.options
     config_required = False
 
     # \   -> \\
@@ -97,6 +99,15 @@ class WindowsDefenderATPBackend(SingleTextQueryBackend):
 
         return "%s \"%s\"" % (op, val)
 
+    def kqlFieldName(self, key):
+        """ATP field name if values of the field are matched with default value mapping, else None"""
+        mapping = self.fieldMappings.get(key)
+        if mapping is None or len(mapping) != 2 or mapping[1] != self.default_value_mapping:
+            return None
+        elif callable(mapping[0]):
+            return mapping[0](key)
+        return mapping[0]
+
     def logontype_mapping(self, src):
         """Value mapping for logon events to reduced ATP LogonType set"""
         logontype_mapping = {
@@ -125,7 +136,7 @@ class WindowsDefenderATPBackend(SingleTextQueryBackend):
         else:   # assume only user name is given if backslash is missing
             return (("InititatingProcessAccountName", src_value),)
 
-    def generate(self, sigmaparser):
+    def initializeRule(self, sigmaparser):
         self.table = None
         try:
             self.category = sigmaparser.parsedyaml['logsource'].setdefault('category', None)
@@ -142,6 +153,8 @@ class WindowsDefenderATPBackend(SingleTextQueryBackend):
             self.table = "MiscEvents"
             self.orToken = ", "
 
+    def generate(self, sigmaparser):
+        self.initializeRule(sigmaparser)
         return super().generate(sigmaparser)
 
     def generateBefore(self, parsed):
@@ -157,7 +170,10 @@ class WindowsDefenderATPBackend(SingleTextQueryBackend):
         and creates an appropriate table reference.
         """
         key, value = node
-        if type(value) == list:         # handle map items with values list like multiple OR-chained conditions
+        fieldname = self.kqlFieldName(key)
+        if type(value) == list and value and all([ type(v) == str for v in value ]) and fieldname is not None:
+            return self.generateKQLListCondition(fieldname, value)
+        elif type(value) == list:         # handle map items with values list like multiple OR-chained conditions
             return self.generateORNode(
                     [(key, v) for v in value]
                     )
@@ -186,6 +202,8 @@ class WindowsDefenderATPBackend(SingleTextQueryBackend):
                 elif self.service == "security" and value == 4624:
                     self.table = "LogonEvents"
                     return None
+        elif type(value) == str and fieldname is not None:
+            return self.generateKQLValueCondition(fieldname, value)
         elif type(value) in (str, int):     # default value processing
             try:
                 mapping = self.fieldMappings[key]
@@ -14,10 +14,28 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
 import yaml
 from sigma.parser.condition import ConditionAND, ConditionOR
 from sigma.config.exceptions import SigmaConfigParseError
 from sigma.config.mapping import FieldMapping, FieldMappingChain
+from sigma.valuelist import SigmaValueList
+
+def get_keywordfields(definition):
+    """Parse keyword fields of a configuration or log source definition given as string or list of strings"""
+    keywordfields = definition.get('keywordfields', list())
+    if type(keywordfields) == str:
+        return [ keywordfields ]
+    elif type(keywordfields) != list or not all([ type(field) == str for field in keywordfields ]):
+        raise SigmaConfigParseError("Keyword fields must be string or list of strings")
+    return keywordfields
+
+def get_valuelist(valuelists, name):
+    """Load value list with given name from configured path or use name as path"""
+    try:
+        return SigmaValueList.load(valuelists[name], name)
+    except KeyError:
+        return SigmaValueList.load(name)
 
 # Chain of multiple configurations
 class SigmaConfigurationChain(list):
@@ -30,9 +48,11 @@ class SigmaConfigurationChain(list):
         super().__init__(*args, **kwargs)
         self.backend = None
         self.defaultindex = None
+        self.keywordfields = list()
         self.config = dict()
         self.fieldmappings = dict()
         self.logsources = dict()
+        self.valuelists = dict()
 
         for config in self:
             self.postprocess_config(config)
@@ -43,9 +63,12 @@ class SigmaConfigurationChain(list):
 
     def postprocess_config(self, config):
         self.defaultindex = config.defaultindex
+        if config.keywordfields:
+            self.keywordfields = config.keywordfields
         self.config.update(config.config)
         self.fieldmappings.update(config.fieldmappings)
         self.logsources.update(config.logsources)
+        self.valuelists.update(config.valuelists)
 
     def get_fieldmapping(self, fieldname):
         """Return mapped fieldname by iterative application of each config stored in configuration chain."""
@@ -68,6 +91,10 @@ class SigmaConfigurationChain(list):
                         category, product, service = logsource.rewrite
         return SigmaLogsourceConfiguration(matching, self.defaultindex)
 
+    def get_valuelist(self, name):
+        """Return value list defined in last configuration of chain that contains it or list loaded from path name."""
+        return get_valuelist(self.valuelists, name)
+
     def set_backend(self, backend):
         """Set backend for all sigma conversion configurations in chain."""
         self.backend = backend
@@ -89,6 +116,8 @@ class SigmaConfiguration:
             self.fieldmappings = dict()
             self.logsources = dict()
             self.defaultindex = None
+            self.keywordfields = list()
+            self.valuelists = dict()
             self.backend = None
         else:
             config = yaml.safe_load(configyaml)
@@ -108,6 +137,14 @@ class SigmaConfiguration:
 
             self.order = config.setdefault("order", None)
             self.defaultindex = config.setdefault('defaultindex', None)
+            self.keywordfields = get_keywordfields(config)      # fields searched by keywords of rules whose log source doesn't define keyword fields
+
+            # value lists: name -> path of list file, relative paths are relative to the configuration file
+            lists = config.setdefault('lists', dict())
+            if type(lists) != dict:
+                raise SigmaConfigParseError("Lists must be a map")
+            basedir = os.path.dirname(getattr(configyaml, "name", ""))
+            self.valuelists = { name: os.path.join(basedir, path) for name, path in lists.items() }
 
             self.logsources = list()
             self.backend = None
@@ -124,6 +161,10 @@ class SigmaConfiguration:
         matching = [logsource for logsource in self.logsources if logsource.matches(category, product, service)]
         return SigmaLogsourceConfiguration(matching, self.defaultindex)
 
+    def get_valuelist(self, name):
+        """Return value list defined in configuration or list loaded from path name."""
+        return get_valuelist(self.valuelists, name)
+
     def set_backend(self, backend):
         """Set backend. This is used by other code to determine target properties for index addressing"""
         self.backend = backend
@@ -150,6 +191,7 @@ class SigmaLogsourceConfiguration:
             self.service = None
             self.index = list()
             self.conditions = list()    # a list of (field, value) tuples which are OR-linked in the generated query. May also contain such a list as list element (in case of merged log sources)
+            self.keywordfields = list()     # fields searched by keywords instead of all fields
             self.rewrite = None
         elif type(logsource) == list and all([isinstance(o, SigmaLogsourceConfiguration) for o in logsource]):      # list of SigmaLogsourceConfigurations: merge
             self.merged = True
@@ -194,6 +236,11 @@ class SigmaLogsourceConfiguration:
                     raise TypeError("Default index must be string or list of strings")
 
             self.conditions = [ ls.conditions for ls in logsource if ls.conditions ]        # build list of list of (field, value) tuples as base for merged query condition.
+
+            # Merge keyword fields in order of the log sources
+            self.keywordfields = list()
+            for ls in logsource:
+                self.keywordfields.extend([ field for field in ls.keywordfields if field not in self.keywordfields ])
         elif type(logsource) == dict:       # create logsource configuration from parsed yaml
             self.merged = False
             if 'category' in logsource and type(logsource['category']) != str \
@@ -243,6 +290,8 @@ class SigmaLogsourceConfiguration:
                 # from a merge, where default index handling applies.
                 self.index = []
 
+            self.keywordfields = get_keywordfields(logsource)
+
             try:
                 if type(logsource['conditions']) != dict:
                     raise SigmaConfigParseError("Logsource conditions must be a map")
@@ -0,0 +1,212 @@
+# Adaptive ordering of conditions for local evaluation of Sigma rules
+# Copyright 2020 Thomas Patzke, Florian Roth
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+The children of AND and OR nodes are evaluated in the order of the rule, which often runs
+expensive checks (regular expressions, substring search in command lines) before cheap and
+selective ones (event identifier equality). The adaptive compiler measures the children while
+events are evaluated and reorders them:
+
+* Every sample_rate-th evaluation of a node evaluates all children and records calls, hits (true
+  results) and evaluation time per child. All other evaluations short-circuit in the current order
+  without any accounting.
+* After reorder_interval sampled evaluations, AND children are ordered by cost / rejection rate
+  and OR children by cost / acceptance rate (ascending), the optimal order for independent checks.
+
+The checks of a condition have no side effects, therefore the result of a node doesn't depend on
+the order of its children. Learned orders are stored in the orderings dict of the compiler by node
+key (a hash of the node content) and can be persisted with saveOrderings() and loadOrderings().
+Compilers that are created with an orderings dict apply the stored orders to nodes with the same
+key, example:
+
+    orderings = loadOrderings(open("orderings.json"))
+    ruleset = SigmaRulesetEvaluator(config, compiler=functools.partial(SigmaAdaptiveConditionCompiler, orderings))
+"""
+
+import json
+import time
+from hashlib import blake2b
+import sigma
+from sigma.parser.modifiers.base import SigmaTypeModifier
+from .evaluator import SigmaConditionCompiler
+
+def nodeDescription(node):
+    """Canonical textual description of a parse tree node."""
+    if type(node) == sigma.parser.condition.ConditionAND:
+        return "and(%s)" % ", ".join([ nodeDescription(item) for item in node ])
+    elif type(node) == sigma.parser.condition.ConditionOR:
+        return "or(%s)" % ", ".join([ nodeDescription(item) for item in node ])
+    elif type(node) == sigma.parser.condition.ConditionNOT:
+        return "not(%s)" % nodeDescription(node.item)
+    elif type(node) == sigma.parser.condition.ConditionNULLValue:
+        return "null(%s)" % node.item
+    elif type(node) == sigma.parser.condition.ConditionNotNULLValue:
+        return "notnull(%s)" % node.item
+    elif type(node) == sigma.parser.condition.NodeSubexpression:
+        return nodeDescription(node.items)
+    elif type(node) == tuple:
+        return "%s=%s" % (node[0], nodeDescription(node[1]))
+    elif type(node) == list:
+        return "[%s]" % ", ".join([ nodeDescription(item) for item in node ])
+    elif isinstance(node, SigmaTypeModifier):
+        return "%s:%r" % (node.identifier, str(node))
+    else:
+        return repr(node)
+
+def nodeKey(description):
+    return blake2b(description.encode("utf-8", "surrogatepass"), digest_size=8).hexdigest()
+
+class AdaptiveNode:
+    """
+    Callable AND or OR node that samples its children and reorders them. Counters of the children are
+    available as lists calls, hits and cost (accumulated seconds) in the order of the parse tree.
+    """
+    __slots__ = ("key", "description", "conjunction", "children", "keys", "descriptions", "order", "ordered",
+            "sample_rate", "reorder_interval", "orderings", "countdown", "samples", "calls", "hits", "cost")
+
+    def __init__(self, node, children, conjunction, orderings, sample_rate, reorder_interval):
+        self.description = nodeDescription(node)
+        self.key = nodeKey(self.description)
+        self.conjunction = conjunction
+        self.children = children
+        self.descriptions = [ nodeDescription(item) for item in node ]
+        self.keys = [ nodeKey(description) for description in self.descriptions ]
+        self.orderings = orderings
+        self.sample_rate = sample_rate
+        self.reorder_interval = reorder_interval
+        self.countdown = sample_rate
+        self.samples = 0
+        self.calls = [ 0 ] * len(children)
+        self.hits = [ 0 ] * len(children)
+        self.cost = [ 0.0 ] * len(children)
+
+        self.order = list(range(len(children)))
+        stored = orderings.get(self.key)
+        if stored is not None and sorted(stored) == sorted(self.keys) and len(set(self.keys)) == len(self.keys):
+            self.order = [ self.keys.index(key) for key in stored ]
+        self.ordered = tuple([ children[i] for i in self.order ])
+
+    def __call__(self, event):
+        self.countdown -= 1
+        if self.countdown <= 0:
+            return self.sample(event)
+        if self.conjunction:
+            for child in self.ordered:
+                if not child(event):
+                    return False
+            return True
+        else:
+            for child in self.ordered:
+                if child(event):
+                    return True
+            return False
+
+    def sample(self, event):
+        """Evaluate all children with accounting."""
+        self.countdown = self.sample_rate
+        result = self.conjunction
+        perf_counter = time.perf_counter
+        for i, child in enumerate(self.children):
+            start = perf_counter()
+            hit = child(event)
+            self.cost[i] += perf_counter() - start
+            self.calls[i] += 1
+            if hit:
+                self.hits[i] += 1
+                if not self.conjunction:
+                    result = True
+            elif self.conjunction:
+                result = False
+        self.samples += 1
+        if self.samples % self.reorder_interval == 0:
+            self.reorder()
+        return result
+
+    def rank(self, i):
+        calls = self.calls[i]
+        if calls == 0:
+            return 0.0
+        cost = self.cost[i] / calls
+        if self.conjunction:
+            rate = (calls - self.hits[i]) / calls
+        else:
+            rate = self.hits[i] / calls
+        return cost / max(rate, 1 / (calls + 1))
+
+    def reorder(self):
+        self.order = sorted(range(len(self.children)), key=self.rank)
+        self.ordered = tuple([ self.children[i] for i in self.order ])
+        if len(set(self.keys)) == len(self.keys):
+            self.orderings[self.key] = [ self.keys[i] for i in self.order ]
+
+    def statistics(self):
+        """List of counters per child in evaluation order."""
+        return [
+                {
+                    "node": self.descriptions[i],
+                    "calls": self.calls[i],
+                    "hits": self.hits[i],
+                    "cost": self.cost[i],
+                }
+                for i in self.order
+                ]
+
+class SigmaAdaptiveConditionCompiler(SigmaConditionCompiler):
+    """
+    Condition compiler that creates AdaptiveNode objects for AND and OR nodes with more than one child.
+    All adaptive nodes are collected in the nodes attribute for inspection of their counters.
+    """
+    def __init__(self, orderings=None, sample_rate=32, reorder_interval=64):
+        super().__init__()
+        if orderings is None:
+            orderings = dict()
+        self.orderings = orderings
+        self.sample_rate = sample_rate
+        self.reorder_interval = reorder_interval
+        self.nodes = list()
+
+    def compileAdaptiveNode(self, node, conjunction):
+        children = [ self.compileNode(item) for item in node ]
+        if len(children) == 1:
+            return children[0]
+        adaptive = AdaptiveNode(node, children, conjunction, self.orderings, self.sample_rate, self.reorder_interval)
+        self.nodes.append(adaptive)
+        return adaptive
+
+    def compileANDNode(self, node):
+        return self.compileAdaptiveNode(node, True)
+
+    def compileORNode(self, node):
+        return self.compileAdaptiveNode(node, False)
+
+    def statistics(self):
+        """Counters of all adaptive nodes as list of dicts."""
+        return [
+                {
+                    "node": node.description,
+                    "samples": node.samples,
+                    "children": node.statistics(),
+                }
+                for node in self.nodes
+                ]
+
+def loadOrderings(f):
+    """Load orderings from JSON file object."""
+    return json.load(f)
+
+def saveOrderings(orderings, f):
+    """Save orderings as JSON to file object."""
+    json.dump(orderings, f, indent=1, sort_keys=True)
@@ -0,0 +1,328 @@
+# Precompiled ruleset bundles for local evaluation of Sigma rules
+# Copyright 2020 Thomas Patzke, Florian Roth
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+A bundle contains the parsed, mapped and optimized condition trees of a ruleset, so evaluating
+processes don't have to parse YAML, apply modifiers, field mappings and log source conditions and
+optimize conditions on each start. Bundles are built with the sigma-bundle tool or from a
+SigmaRulesetEvaluator:
+
+    SigmaBundle.fromRuleset(ruleset).write(open("rules.bundle", "wb"))
+    ruleset = SigmaBundle.load("rules.bundle").ruleset()
+
+File layout: a fixed header (magic, format version, payload length, SHA-256 of the payload)
+followed by the payload, a compact JSON document with sorted keys. The payload contains:
+
+* sigma_version: version of the sigmatools package that built the bundle. Bundles are only
+  loaded by the same version because the condition trees depend on parser and optimizer.
+* patterns: table of all distinct string values, referenced by index from the condition trees.
+* rules: metadata (id, title, level, tags), required fields and the condition trees of each rule.
+  Values of value lists referenced with the list modifier are embedded, the bundle doesn't depend
+  on list files.
+
+The bundle is deterministic for the same inputs, therefore it can be diffed and cached by its
+content hash. Decoded rules are Python objects that are private to each process, workers that
+should share them must load the bundle before they are forked.
+"""
+
+import hashlib
+import json
+import struct
+from sigma.parser.condition import ConditionAND, ConditionOR, ConditionNOT, ConditionNULLValue, ConditionNotNULLValue, NodeSubexpression, SigmaAggregationParser
+from sigma.parser.modifiers.base import SigmaTypeModifier
+from sigma.parser.modifiers.type import SigmaRegularExpressionModifier, SigmaValueListModifier
+from .exceptions import NotSupportedError
+
+BUNDLE_MAGIC = b"SIGMABDL"
+BUNDLE_FORMAT = 2
+header = struct.Struct("<8sIQ32s")
+
+class SigmaBundleError(Exception):
+    pass
+
+def sigmaVersion():
+    """Version of the installed sigmatools package or None if the package is used from source."""
+    try:
+        from importlib.metadata import version
+    except ImportError:                 # Python < 3.8, pkg_resources is much slower to import
+        try:
+            import pkg_resources
+            return pkg_resources.get_distribution("sigmatools").version
+        except Exception:
+            return None
+    try:
+        return version("sigmatools")
+    except Exception:
+        return None
+
+class BundledAggregation:
+    """Aggregation of a bundled rule with the attributes of SigmaAggregationParser used by the evaluator."""
+    def __init__(self, aggfunc_notrans, aggfield, groupfield, cond_op, condition):
+        self.aggfunc_notrans = aggfunc_notrans
+        self.aggfunc = SigmaAggregationParser.aggfuncmap[aggfunc_notrans]
+        self.aggfield = aggfield
+        self.groupfield = groupfield
+        self.cond_op = cond_op
+        self.condition = condition
+
+class BundledCondition:
+    def __init__(self, parsedSearch, parsedAgg):
+        self.parsedSearch = parsedSearch
+        self.parsedAgg = parsedAgg
+
+class BundledValueList:
+    """Value list embedded in a bundle with the interface of SigmaValueList used by the evaluator and backends."""
+    def __init__(self, name, values):
+        self.name = name
+        self.values = values
+        self.lowered = { value.lower() for value in values }
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __contains__(self, value):
+        return str(value).lower() in self.lowered
+
+    def __str__(self):
+        return self.name
+
+class BundledRule:
+    """Rule loaded from a bundle. Can be used instead of a SigmaParser object for rule evaluation."""
+    def __init__(self, parsedyaml, condparsed):
+        self.parsedyaml = parsedyaml
+        self.condparsed = condparsed
+
+class SigmaBundle:
+    """Serializable representation of the rules of a SigmaRulesetEvaluator."""
+    def __init__(self, payload):
+        self.payload = payload
+
+    @classmethod
+    def fromRuleset(cls, ruleset):
+        encoder = BundleEncoder()
+        rules = list()
+        for rule in ruleset.rules:
+            parsedyaml = rule.sigmaparser.parsedyaml
+            rules.append({
+                "id": parsedyaml.get("id"),
+                "title": parsedyaml.get("title"),
+                "level": parsedyaml.get("level"),
+                "tags": parsedyaml.get("tags", []),
+                "fields": None if rule.fields is None else sorted(rule.fields),
+                "conditions": [
+                    {
+                        "search": encoder.encodeNode(condition.parsed.parsedSearch),
+                        "aggregation": encoder.encodeAggregation(condition.parsed.parsedAgg),
+                    }
+                    for condition in rule.conditions
+                    ],
+                })
+
+        return cls({
+            "sigma_version": sigmaVersion(),
+            "patterns": encoder.patterns,
+            "rules": rules,
+            })
+
+    def serialize(self):
+        """Return bundle file content as bytes."""
+        payload = json.dumps(self.payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+        return header.pack(BUNDLE_MAGIC, BUNDLE_FORMAT, len(payload), hashlib.sha256(payload).digest()) + payload
+
+    def write(self, f):
+        f.write(self.serialize())
+
+    @property
+    def hash(self):
+        """SHA-256 content hash of the bundle payload (hex)."""
+        return hashlib.sha256(self.serialize()[header.size:]).hexdigest()
+
+    @classmethod
+    def fromBytes(cls, data, ignore_version=False):
+        """Decode bundle from bytes-like object after verification of header, content hash and version."""
+        if len(data) < header.size:
+            raise SigmaBundleError("File is too short for a Sigma bundle")
+        magic, bundleformat, length, digest = header.unpack_from(data)
+        if magic != BUNDLE_MAGIC:
+            raise SigmaBundleError("File is not a Sigma bundle")
+        if bundleformat != BUNDLE_FORMAT:
+            raise SigmaBundleError("Sigma bundle format version %d is not supported (expected %d)" % (bundleformat, BUNDLE_FORMAT))
+        payload = data[header.size:header.size + length]
+        if len(payload) != length or hashlib.sha256(payload).digest() != digest:
+            raise SigmaBundleError("Sigma bundle is truncated or corrupted (content hash mismatch)")
+        bundle = cls(json.loads(payload))
+        version = sigmaVersion()
+        if not ignore_version and bundle.payload["sigma_version"] != version:
+            raise SigmaBundleError("Sigma bundle was built by version %s and can't be used with version %s, please rebuild it" % (bundle.payload["sigma_version"], version))
+        return bundle
+
+    @classmethod
+    def load(cls, path, ignore_version=False):
+        """Load bundle from file."""
+        with open(path, "rb") as f:
+            return cls.fromBytes(f.read(), ignore_version)
+
+    @property
+    def fields(self):
+        """Set of fields that are required by the rules of the bundle, None if a rule requires all fields."""
+        fields = set()
+        for rule in self.payload["rules"]:
+            if rule["fields"] is None:
+                return None
+            fields.update(rule["fields"])
+        return fields
+
+    def rules(self):
+        """Return list of BundledRule objects."""
+        decoder = BundleDecoder(self.payload["patterns"])
+        return [
+                BundledRule(
+                    { key: rule[key] for key in ("id", "title", "level", "tags") if rule[key] is not None },
+                    [
+                        BundledCondition(decoder.decodeNode(condition["search"]), decoder.decodeAggregation(condition["aggregation"]))
+                        for condition in rule["conditions"]
+                    ])
+                for rule in self.payload["rules"]
+                ]
+
+    def ruleset(self, *args, **kwargs):
+        """Return SigmaRulesetEvaluator with the rules of the bundle. Parameters are passed to the evaluator."""
+        from .evaluator import SigmaRulesetEvaluator
+        ruleset = SigmaRulesetEvaluator(*args, **kwargs)
+        for rule in self.rules():
+            ruleset.add(rule)
+        return ruleset
+
+class BundleEncoder:
+    """
+    Encodes condition trees into nested lists. String values are replaced by their index in the
+    pattern table.
+    """
+    def __init__(self):
+        self.patterns = list()
+        self.patternindex = dict()
+
+    def pattern(self, value):
+        try:
+            return self.patternindex[value]
+        except KeyError:
+            i = self.patternindex[value] = len(self.patterns)
+            self.patterns.append(value)
+            return i
+
+    def encodeNode(self, node):
+        if type(node) == ConditionAND:
+            return [ "and" ] + [ self.encodeNode(item) for item in node ]
+        elif type(node) == ConditionOR:
+            return [ "or" ] + [ self.encodeNode(item) for item in node ]
+        elif type(node) == ConditionNOT:
+            return [ "not", self.encodeNode(node.item) ]
+        elif type(node) == ConditionNULLValue:
+            return [ "null", node.item ]
+        elif type(node) == ConditionNotNULLValue:
+            return [ "notnull", node.item ]
+        elif type(node) == NodeSubexpression:
+            return self.encodeNode(node.items)
+        elif type(node) == tuple:
+            return [ "map", node[0], self.encodeValue(node[1]) ]
+        elif type(node) in (str, int):
+            return [ "value", self.encodeValue(node) ]
+        elif type(node) == list:
+            return [ "list" ] + [ self.encodeValue(item) for item in node ]
+        else:
+            raise TypeError("Node type %s was not expected in Sigma parse tree" % (str(type(node))))
+
+    def encodeValue(self, value):
+        if value is None:
+            return None
+        elif type(value) == str:
+            return [ "s", self.pattern(value) ]
+        elif type(value) == int:
+            return [ "i", value ]
+        elif type(value) == list:
+            return [ "l" ] + [ self.encodeValue(item) for item in value ]
+        elif isinstance(value, SigmaRegularExpressionModifier):
+            return [ "re", self.pattern(value.value) ]
+        elif isinstance(value, SigmaValueListModifier):
+            return [ "vl", self.pattern(value.value), self.pattern(value.valuelist.name) ] + [ self.pattern(item) for item in value.valuelist ]
+        elif isinstance(value, SigmaTypeModifier):
+            raise NotSupportedError("Type modifier '{}' is not supported in Sigma bundles".format(value.identifier))
+        else:
+            raise TypeError("Value type %s was not expected in Sigma parse tree" % (str(type(value))))
+
+    def encodeAggregation(self, agg):
+        if agg is None:
+            return None
+        return {
+                "aggfunc": agg.aggfunc_notrans,
+                "aggfield": agg.aggfield,
+                "groupfield": agg.groupfield,
+                "cond_op": agg.cond_op,
+                "condition": agg.condition,
+                }
+
+class BundleDecoder:
+    """Decodes condition trees encoded by BundleEncoder into parse tree nodes."""
+    def __init__(self, patterns):
+        self.patterns = patterns
+
+    def decodeNode(self, node):
+        nodetype = node[0]
+        if nodetype == "and":
+            return ConditionAND(None, None, *[ self.decodeNode(item) for item in node[1:] ])
+        elif nodetype == "or":
+            return ConditionOR(None, None, *[ self.decodeNode(item) for item in node[1:] ])
+        elif nodetype == "not":
+            return ConditionNOT(None, None, self.decodeNode(node[1]))
+        elif nodetype == "null":
+            return ConditionNULLValue(val=node[1])
+        elif nodetype == "notnull":
+            return ConditionNotNULLValue(val=node[1])
+        elif nodetype == "map":
+            return (node[1], self.decodeValue(node[2]))
+        elif nodetype == "value":
+            return self.decodeValue(node[1])
+        elif nodetype == "list":
+            return [ self.decodeValue(item) for item in node[1:] ]
+        else:
+            raise SigmaBundleError("Unknown node type '%s' in Sigma bundle" % nodetype)
+
+    def decodeValue(self, value):
+        if value is None:
+            return None
+        valuetype = value[0]
+        if valuetype == "s":
+            return self.patterns[value[1]]
+        elif valuetype == "i":
+            return value[1]
+        elif valuetype == "l":
+            return [ self.decodeValue(item) for item in value[1:] ]
+        elif valuetype == "re":
+            return SigmaRegularExpressionModifier(self.patterns[value[1]])
+        elif valuetype == "vl":
+            modifier = SigmaValueListModifier(self.patterns[value[1]])
+            modifier.valuelist = BundledValueList(self.patterns[value[2]], [ self.patterns[item] for item in value[3:] ])
+            return modifier
+        else:
+            raise SigmaBundleError("Unknown value type '%s' in Sigma bundle" % valuetype)
+
+    def decodeAggregation(self, agg):
+        if agg is None:
+            return None
+        return BundledAggregation(agg["aggfunc"], agg["aggfield"], agg["groupfield"], agg["cond_op"], agg["condition"])
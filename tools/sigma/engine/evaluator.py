@@ -0,0 +1,334 @@
+# Local evaluation of Sigma rules against events
+# Copyright 2020 Thomas Patzke, Florian Roth
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import sigma
+from sigma.configuration import SigmaConfigurationChain
+from sigma.parser.collection import SigmaCollectionParser
+from sigma.parser.modifiers.base import SigmaTypeModifier
+from sigma.parser.modifiers.type import SigmaRegularExpressionModifier, SigmaValueListModifier
+from .aggregation import ExactAggregation
+from .events import getFieldValue, iterValues, normalizeValue
+from .exceptions import NotSupportedError
+
+class SigmaValueMatcher:
+    """
+    Converts a Sigma value into a matching function that is called with a normalized (lower case
+    string) event value. Wildcards * and ? are converted into the cheapest possible check: equality,
+    substring, prefix or suffix tests are used where possible, regular expressions otherwise.
+    Wildcards can be escaped with a backslash, a double backslash before a wildcard is a literal
+    backslash followed by a wildcard.
+    """
+    reToken = re.compile("\\\\\\\\(?=[*?])|\\\\[*?]|[*?]|[^\\\\*?]+|\\\\")
+
+    def __init__(self, value):
+        self.value = value
+        self.parts = self.tokenize(str(value))
+        self.match = self.compile()
+
+    def tokenize(self, value):
+        """
+        Split value into list of literal strings and wildcard markers (None for *, False for ?).
+        Adjacent literals are merged.
+        """
+        parts = list()
+        for token in self.reToken.findall(value):
+            if token == "*":
+                part = None
+            elif token == "?":
+                part = False
+            elif token == "\\\\":
+                part = "\\"
+            elif token in ("\\*", "\\?"):
+                part = token[1]
+            else:
+                part = token
+            if type(part) == str and parts and type(parts[-1]) == str:
+                parts[-1] += part
+            else:
+                parts.append(part)
+        return [ part.lower() if type(part) == str else part for part in parts ]
+
+    @property
+    def literals(self):
+        """All literal parts of the value."""
+        return [ part for part in self.parts if type(part) == str ]
+
+    @property
+    def hasWildcards(self):
+        return any(( type(part) != str for part in self.parts ))
+
+    def compile(self):
+        parts = self.parts
+        if len(parts) == 0:
+            return lambda v: v == ""
+        elif not self.hasWildcards:
+            literal = parts[0]
+            return lambda v: v == literal
+        elif False not in parts:
+            if len(parts) == 3 and parts[0] is None and parts[2] is None:    # *literal*
+                literal = parts[1]
+                return lambda v: literal in v
+            elif len(parts) == 2 and parts[0] is None:      # *literal
+                literal = parts[1]
+                return lambda v: v.endswith(literal)
+            elif len(parts) == 2 and parts[1] is None:      # literal*
+                literal = parts[0]
+                return lambda v: v.startswith(literal)
+            elif parts == [ None ]:                         # *
+                return lambda v: True
+
+        regex = "".join([
+            ".*" if part is None else
+            "." if part is False else
+            re.escape(part)
+            for part in parts
+            ])
+        return re.compile(regex, re.DOTALL).fullmatch
+
+    def __call__(self, value):
+        return bool(self.match(value))
+
+class SigmaConditionCompiler:
+    """
+    Compiles a parsed Sigma condition tree into a Python function that is called with an event
+    (dict) and returns a boolean. Dispatching to the compile* methods follows the conventions of
+    the generate* methods of the conversion backends.
+
+    The compiler records the names of all fields referenced by compiled conditions in the fields
+    attribute. The attribute unbound is set if a condition contains values that are not bound to
+    a field and therefore require all fields of an event.
+    """
+    def __init__(self):
+        self.fields = set()
+        self.unbound = False
+
+    def compileNode(self, node):
+        if type(node) == sigma.parser.condition.ConditionAND:
+            return self.compileANDNode(node)
+        elif type(node) == sigma.parser.condition.ConditionOR:
+            return self.compileORNode(node)
+        elif type(node) == sigma.parser.condition.ConditionNOT:
+            return self.compileNOTNode(node)
+        elif type(node) == sigma.parser.condition.ConditionNULLValue:
+            return self.compileNULLValueNode(node)
+        elif type(node) == sigma.parser.condition.ConditionNotNULLValue:
+            return self.compileNotNULLValueNode(node)
+        elif type(node) == sigma.parser.condition.NodeSubexpression:
+            return self.compileSubexpressionNode(node)
+        elif type(node) == tuple:
+            return self.compileMapItemNode(node)
+        elif type(node) in (str, int):
+            return self.compileValueNode(node)
+        elif type(node) == list:
+            return self.compileListNode(node)
+        else:
+            raise TypeError("Node type %s was not expected in Sigma parse tree" % (str(type(node))))
+
+    def compileANDNode(self, node):
+        children = tuple([ self.compileNode(item) for item in node ])
+        return lambda event: all(( child(event) for child in children ))
+
+    def compileORNode(self, node):
+        children = tuple([ self.compileNode(item) for item in node ])
+        return lambda event: any(( child(event) for child in children ))
+
+    def compileNOTNode(self, node):
+        child = self.compileNode(node.item)
+        return lambda event: not child(event)
+
+    def compileSubexpressionNode(self, node):
+        return self.compileNode(node.items)
+
+    def compileListNode(self, node):
+        if not set([type(value) for value in node]).issubset({str, int}):
+            raise NotSupportedError("List values must be strings or numbers")
+        return self.compileORNode(node)
+
+    def compileValueNode(self, node):
+        """Values that are not bound to a field match as substring of any event value."""
+        self.unbound = True
+        matcher = SigmaValueMatcher("*%s*" % str(node).strip("*"))
+        return lambda event: any(( matcher(normalizeValue(value)) for value in iterValues(event) ))
+
+    def compileMapItemNode(self, node):
+        fieldname, value = node
+        if value is None:
+            return self.compileNULLValueNode(sigma.parser.condition.ConditionNULLValue(val=fieldname))
+        self.fields.add(fieldname)
+        matcher = self.compileValueMatcher(value)
+
+        def matchMapItem(event):
+            eventvalue = getFieldValue(event, fieldname)
+            if eventvalue is None:
+                return False
+            elif type(eventvalue) in (list, tuple):
+                return any(( matcher(normalizeValue(v)) for v in eventvalue if v is not None ))
+            else:
+                return matcher(normalizeValue(eventvalue))
+        return matchMapItem
+
+    def compileValueMatcher(self, value):
+        """Return function that matches normalized event values against the given Sigma value."""
+        if type(value) in (str, int):
+            return SigmaValueMatcher(value)
+        elif type(value) == list:
+            matchers = tuple([ self.compileValueMatcher(v) for v in value ])
+            return lambda v: any(( matcher(v) for matcher in matchers ))
+        elif isinstance(value, SigmaRegularExpressionModifier):
+            regex = re.compile(str(value), re.IGNORECASE)
+            return lambda v: regex.search(v) is not None
+        elif isinstance(value, SigmaValueListModifier):
+            valuelist = value.valuelist
+            return lambda v: v in valuelist
+        elif isinstance(value, SigmaTypeModifier):
+            raise NotSupportedError("Type modifier '{}' is not supported by local evaluation".format(value.identifier))
+        else:
+            raise NotSupportedError("Map values must be strings, numbers, lists, null or regular expression, not " + str(type(value)))
+
+    def compileNULLValueNode(self, node):
+        fieldname = node.item
+        self.fields.add(fieldname)
+        return lambda event: getFieldValue(event, fieldname) in (None, "")
+
+    def compileNotNULLValueNode(self, node):
+        fieldname = node.item
+        self.fields.add(fieldname)
+        return lambda event: getFieldValue(event, fieldname) not in (None, "")
+
+class SigmaConditionEvaluator:
+    """Evaluator of one parsed Sigma condition (search and optional aggregation)."""
+    def __init__(self, parsed, compiler, aggregation):
+        self.parsed = parsed
+        self.search = compiler.compileNode(parsed.parsedSearch)
+        if parsed.parsedAgg is not None:
+            self.aggregation = aggregation(parsed.parsedAgg)
+        else:
+            self.aggregation = None
+
+class SigmaRuleEvaluator:
+    """
+    Evaluates a parsed Sigma rule (SigmaParser) against events. Events are dicts with field names
+    that are already in the target naming as defined by the configuration used for rule parsing.
+
+    Conditions without aggregation are matched directly with match(). Aggregating conditions are
+    updated with all events that match their search and the results are retrieved with
+    aggregate(). The aggregation state implementation is chosen with the aggregation parameter,
+    a callable that gets a SigmaAggregationParser object and returns an aggregation state
+    object (see sigma.engine.aggregation). Example for opt-in approximate aggregation:
+
+        SigmaRuleEvaluator(parser, functools.partial(ApproximateAggregation, error=0.02, memory_limit=2**24))
+
+    The condition compiler is created per rule by the compiler parameter, a callable without
+    arguments, e.g. for adaptive ordering of conditions (see sigma.engine.adaptive). The compiler
+    object is available in the compiler attribute.
+    """
+    compiler_class = SigmaConditionCompiler
+
+    def __init__(self, sigmaparser, aggregation=ExactAggregation, compiler=None):
+        self.sigmaparser = sigmaparser
+        if compiler is None:
+            compiler = self.compiler_class
+        compiler = self.compiler = compiler()
+        self.conditions = [ SigmaConditionEvaluator(parsed, compiler, aggregation) for parsed in sigmaparser.condparsed ]
+
+        # Fields required for evaluation of the rule, None if all fields are required
+        if compiler.unbound:
+            self.fields = None
+        else:
+            self.fields = compiler.fields
+            for condition in self.conditions:
+                agg = condition.parsed.parsedAgg
+                if agg is not None:
+                    self.fields.update({ field for field in (agg.groupfield, agg.aggfield) if field is not None })
+
+    def match(self, event):
+        """
+        Returns True if the event matches one of the non-aggregating conditions of the rule. Aggregation
+        states of aggregating conditions are updated with matching events.
+        """
+        result = False
+        for condition in self.conditions:
+            if condition.search(event):
+                if condition.aggregation is None:
+                    result = True
+                else:
+                    condition.aggregation.update(event)
+        return result
+
+    def aggregate(self):
+        """Return list of (group value, aggregated value) tuples of all aggregation conditions that are fulfilled."""
+        results = list()
+        for condition in self.conditions:
+            if condition.aggregation is not None:
+                results.extend(condition.aggregation.results())
+        return results
+
+    def reset(self):
+        """Reset aggregation states, e.g. at the end of a time frame."""
+        for condition in self.conditions:
+            if condition.aggregation is not None:
+                condition.aggregation.reset()
+
+class SigmaRulesetEvaluator:
+    """
+    Evaluates a set of Sigma rules against events. The evaluator takes the role of a backend for the
+    conversion configuration, which makes log source definitions available for rule parsing. Rules
+    are loaded from Sigma files (with load()) after the evaluator was initialized.
+    """
+    index_field = None      # index conditions from log sources are not evaluated locally
+
+    def __init__(self, sigmaconfig=None, aggregation=ExactAggregation, compiler=None):
+        if sigmaconfig is None:
+            sigmaconfig = SigmaConfigurationChain()
+        self.sigmaconfig = sigmaconfig
+        self.sigmaconfig.set_backend(self)
+        self.aggregation = aggregation
+        self.compiler = compiler
+        self.rules = list()
+
+    def load(self, content, rulefilter=None):
+        """Load rules from Sigma collection given as string or file-like object."""
+        parser = SigmaCollectionParser(content, self.sigmaconfig, rulefilter)
+        for sigmaparser in parser.parsers:
+            self.add(sigmaparser)
+
+    def add(self, sigmaparser):
+        rule = SigmaRuleEvaluator(sigmaparser, self.aggregation, self.compiler)
+        self.rules.append(rule)
+        return rule
+
+    @property
+    def fields(self):
+        """
+        Set of fields that are required for evaluation of all rules: fields used in detections,
+        log source conditions and aggregations. None if all fields are required, e.g. because of
+        values that are not bound to a field.
+        """
+        fields = set()
+        for rule in self.rules:
+            if rule.fields is None:
+                return None
+            fields.update(rule.fields)
+        return fields
+
+    def match(self, event):
+        """Return list of all rule evaluators whose non-aggregating conditions match the event."""
+        return [ rule for rule in self.rules if rule.match(event) ]
+
+    def aggregate(self):
+        """Return list of (rule evaluator, group value, aggregated value) tuples of fulfilled aggregations."""
+        return [ (rule, group, value) for rule in self.rules for group, value in rule.aggregate() ]
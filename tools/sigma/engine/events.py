@@ -0,0 +1,150 @@
+# Event access for local evaluation of Sigma rules
+# Copyright 2020 Thomas Patzke, Florian Roth
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import csv
+import json
+
+try:
+    import simdjson
+except ImportError:         # optional on-demand JSON parser for projected reading
+    simdjson = None
+
+def getFieldValue(event, fieldname):
+    """
+    Return value of field from event. Field names that are not contained as key in the event are
+    resolved as dotted path into nested objects, e.g. event_data.CommandLine. Returns None if the
+    field doesn't exists.
+    """
+    try:
+        return event[fieldname]
+    except KeyError:
+        pass
+    except TypeError:
+        return None
+
+    value = event
+    for part in fieldname.split("."):
+        try:
+            value = value[part]
+        except (KeyError, TypeError):
+            return None
+    return value
+
+def iterValues(event):
+    """Iterate recursively over all scalar values contained in an event."""
+    if isinstance(event, dict):
+        for value in event.values():
+            yield from iterValues(value)
+    elif isinstance(event, (list, tuple)):
+        for value in event:
+            yield from iterValues(value)
+    elif event is not None:
+        yield event
+
+def normalizeValue(value):
+    """Normalize scalar event values for case-insensitive comparison."""
+    return str(value).lower()
+
+def projectionKeys(fields):
+    """
+    Top-level keys that contain the given fields: the first component of dotted field names and the
+    field name itself for exports with dotted keys.
+    """
+    keys = set()
+    for field in fields:
+        keys.add(field)
+        keys.add(field.split(".")[0])
+    return keys
+
+class JSONEventReader:
+    """
+    Reads events from a file-like object that contains one JSON object per line. If a set of field
+    names is given, events only contain the top-level keys that are required for these fields.
+
+    Without projection or if pysimdjson isn't installed, records are decoded completely with
+    json.loads() and unreferenced keys are dropped afterwards. With pysimdjson, records are parsed
+    into a document from which only the values of required keys are converted into Python objects,
+    the other keys are skipped. Records that aren't JSON objects or that simdjson rejects are
+    decoded with json.loads() (see tests/benchmark-event-reader.py for measurements).
+    """
+    def __init__(self, f, fields=None):
+        self.f = f
+        self.keys = None if fields is None else projectionKeys(fields)
+
+    def __iter__(self):
+        keys = self.keys
+        if keys is not None and simdjson is not None:
+            yield from self.iterSkipping(keys)
+            return
+        for line in self.f:
+            line = line.strip()
+            if line:
+                event = json.loads(line)
+                if keys is not None and type(event) == dict:
+                    event = { key: value for key, value in event.items() if key in keys }
+                yield event
+
+    def iterSkipping(self, keys):
+        """Parse records with simdjson and convert only values of required top-level keys."""
+        parser = simdjson.Parser()
+        for line in self.f:
+            line = line.strip()
+            if line:
+                try:
+                    event = self.project(parser.parse(line), keys)
+                except ValueError:
+                    event = None
+                if event is None:
+                    event = json.loads(line)
+                yield event
+
+    @staticmethod
+    def project(document, keys):
+        """Return dict of required keys of a parsed object or None if document isn't an object."""
+        if not isinstance(document, simdjson.Object):
+            return None
+        event = dict()
+        for key in document.keys():
+            if key in keys:
+                value = document[key]
+                if isinstance(value, simdjson.Object):
+                    value = value.as_dict()
+                elif isinstance(value, simdjson.Array):
+                    value = value.as_list()
+                event[key] = value
+        # proxies of the document are released when returning, the parser can be reused afterwards
+        return event
+
+class CSVEventReader:
+    """
+    Reads events from a CSV file with header line. If a set of field names is given, events only
+    contain the columns of these fields. Empty values are treated as missing fields.
+    """
+    def __init__(self, f, fields=None, **kwargs):
+        self.reader = csv.reader(f, **kwargs)
+        try:
+            header = next(self.reader)
+        except StopIteration:
+            header = list()
+        if fields is None:
+            self.columns = list(enumerate(header))
+        else:
+            self.columns = [ (i, column) for i, column in enumerate(header) if column in fields ]
+
+    def __iter__(self):
+        columns = self.columns
+        for row in self.reader:
+            yield { column: row[i] for i, column in columns if i < len(row) and row[i] != "" }
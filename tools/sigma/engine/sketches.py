@@ -0,0 +1,184 @@
+# Probabilistic data structures for approximate aggregations
+# Copyright 2020 Thomas Patzke, Florian Roth
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import math
+from array import array
+from hashlib import blake2b
+
+def hash64(value):
+    """Stable 64 bit hash of a value (not randomized per process like hash())."""
+    return int.from_bytes(blake2b(str(value).encode("utf-8", "surrogatepass"), digest_size=8).digest(), "little")
+
+class HyperLogLog:
+    """
+    HyperLogLog cardinality estimator with a sparse representation for small cardinalities.
+
+    Values are kept as set of hashes as long as this is smaller than the register array. The count is
+    exact (up to hash collisions) in this state. The sketch switches to the dense register
+    representation once the sparse set would exceed its size. The relative standard error of the dense
+    representation is 1.04/sqrt(2^precision).
+    """
+    __slots__ = ("precision", "m", "sparse", "registers", "sparse_limit")
+    SPARSE_ENTRY_SIZE = 64      # estimated memory usage of a hash in the sparse set (int object + set slot)
+    OVERHEAD = 300              # estimated memory usage of an object with empty set
+
+    def __init__(self, precision=12):
+        if not 4 <= precision <= 18:
+            raise ValueError("HyperLogLog precision must be between 4 and 18")
+        self.precision = precision
+        self.m = 1 << precision
+        self.sparse = set()
+        self.registers = None
+        self.sparse_limit = self.m // self.SPARSE_ENTRY_SIZE
+
+    @classmethod
+    def from_error(cls, error):
+        """Create HyperLogLog with the smallest precision that achieves the given relative standard error."""
+        precision = math.ceil(2 * math.log2(1.04 / error))
+        return cls(min(max(precision, 4), 18))
+
+    def add(self, value):
+        """Add value. Returns True if the internal state was changed."""
+        return self.addHash(hash64(value))
+
+    def addHash(self, h):
+        """Add value by its hash64() hash. Returns True if the internal state was changed."""
+        if self.registers is None:
+            if h in self.sparse:
+                return False
+            self.sparse.add(h)
+            if len(self.sparse) > self.sparse_limit:
+                self.densify()
+            return True
+        else:
+            return self.addRegister(h)
+
+    def addRegister(self, h):
+        idx = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[idx]:
+            self.registers[idx] = rank
+            return True
+        return False
+
+    def densify(self):
+        """Convert sparse set into register array."""
+        self.registers = bytearray(self.m)
+        for h in self.sparse:
+            self.addRegister(h)
+        self.sparse = None
+
+    def count(self):
+        """Estimated number of distinct values."""
+        if self.registers is None:
+            return len(self.sparse)
+
+        m = self.m
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        elif m == 64:
+            alpha = 0.709
+        elif m == 32:
+            alpha = 0.697
+        else:
+            alpha = 0.673
+        estimate = alpha * m * m / math.fsum([ 2.0 ** -r for r in self.registers ])
+        if estimate <= 2.5 * m:         # small range correction
+            zeros = self.registers.count(0)
+            if zeros > 0:
+                estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def merge(self, other):
+        """Merge other HyperLogLog with same precision into this one."""
+        if self.precision != other.precision:
+            raise ValueError("Only HyperLogLog sketches with same precision can be merged")
+        if other.registers is None:
+            for h in other.sparse:
+                self.addHash(h)
+        else:
+            if self.registers is None:
+                self.densify()
+            self.registers = bytearray(map(max, self.registers, other.registers))
+
+    @property
+    def memory(self):
+        """Estimated memory usage in bytes."""
+        if self.registers is None:
+            return self.OVERHEAD + len(self.sparse) * self.SPARSE_ENTRY_SIZE
+        else:
+            return self.OVERHEAD + self.m
+
+    def __len__(self):
+        return self.count()
+
+class CountMinSketch:
+    """
+    Count-min sketch with conservative update. Estimates never underestimate the true count. With
+    probability confidence an estimate exceeds the true count by at most error * total count.
+    """
+    OVERHEAD = 120
+
+    def __init__(self, width, depth):
+        if width < 1 or depth < 1:
+            raise ValueError("Width and depth of count-min sketch must be positive")
+        self.width = width
+        self.depth = depth
+        self.tables = [ array("Q", bytes(8 * width)) for i in range(depth) ]
+        self.total = 0
+
+    @classmethod
+    def from_error(cls, error, confidence=0.99, memory_limit=None):
+        """
+        Create sketch from error bound (relative to total count) and confidence. The width is reduced
+        if the sketch would exceed the memory limit (bytes).
+        """
+        width = math.ceil(math.e / error)
+        depth = math.ceil(math.log(1 / (1 - confidence)))
+        if memory_limit is not None and width * depth * 8 > memory_limit:
+            width = max(memory_limit // (8 * depth), 1)
+        return cls(width, depth)
+
+    def indices(self, value):
+        h = hash64(value)
+        h1 = h & 0xffffffff
+        h2 = h >> 32
+        width = self.width
+        return [ (h1 + i * h2) % width for i in range(self.depth) ]
+
+    def add(self, value, count=1):
+        """Add value count times and return new estimate."""
+        self.total += count
+        indices = self.indices(value)
+        tables = self.tables
+        estimate = min([ table[i] for table, i in zip(tables, indices) ]) + count
+        for table, i in zip(tables, indices):
+            if table[i] < estimate:
+                table[i] = estimate
+        return estimate
+
+    def estimate(self, value):
+        return min([ table[i] for table, i in zip(self.tables, self.indices(value)) ])
+
+    @property
+    def error(self):
+        """Additive error bound of estimates for the current total count."""
+        return math.e / self.width * self.total
+
+    @property
+    def memory(self):
+        return self.OVERHEAD + 8 * self.width * self.depth
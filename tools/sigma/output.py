@@ -1,5 +1,5 @@
 # Sigma output library
-# Copyright 2016-2019 Thomas Patzke, Florian Roth
+# Copyright 2016-2020 Thomas Patzke, Florian Roth
 
 # This program is free software: you can redistribute it and/or modify
 # it under the terms of the GNU Lesser General Public License as published by
@@ -14,9 +14,258 @@
 # You should have received a copy of the GNU Lesser General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+"""
+YAML dumper for Sigma rules and serialization of structured backend results.
+
+Backends with structured output (StructuredOutputMixin) generate documents instead of text: dicts, lists or strings,
+optionally wrapped into a StructuredResult with metadata like the name of the rule. Documents are serialized once by
+an output sink in one of the formats:
+
+* json: one JSON document per document, pretty-printed with indentation or compact
+* ndjson: one compact JSON document per line, items of list documents are written as separate lines
+* yaml: YAML documents separated by ---, block style or compact flow style
+
+Strings are written unchanged in all formats, they are text output of backends like shell scripts. JSON is encoded
+with the json module of the standard library or the faster orjson encoder if it is installed.
+
+Results are written as soon as they are generated. Documents of backends whose JSON output is one array are written
+as array elements, the array is opened by the first and closed after the last document. SigmaShardedOutput writes
+each result into an own file of a directory instead.
+"""
+
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import types
 import yaml
 
+try:
+    import orjson
+except ImportError:         # optional fast JSON encoder
+    orjson = None
+
+outputFormats = ("json", "ndjson", "yaml")
+
 class SigmaYAMLDumper(yaml.Dumper):
     """YAML dumper that increases amount of indentation, e.g. for lists"""
     def increase_indent(self, flow=False, indentless=False):
         return super().increase_indent(flow, False)
+
+class StructuredResult:
+    """Document (dict, list or str) generated by a backend with metadata, e.g. name of the rule"""
+    def __init__(self, value, **meta):
+        self.value = value
+        self.meta = meta
+
+    def __repr__(self):     # pragma: no cover
+        return "StructuredResult(%r, **%r)" % (self.value, self.meta)
+
+def documentValue(document):
+    """Value of a document that is optionally wrapped into a StructuredResult"""
+    if isinstance(document, StructuredResult):
+        return document.value
+    return document
+
+def resultDocuments(result):
+    """
+    Documents of a backend result: lists and generators of structured backends are sequences of documents, any other
+    value, e.g. a dict generated by a backend without structured output, is one document.
+    """
+    if isinstance(result, (list, types.GeneratorType)):
+        return result
+    return [ result ]
+
+def jsonEncoder(name="json", pretty=True):
+    """
+    Function that encodes a value as JSON string with the encoder name json (standard library), orjson or auto (orjson
+    if installed, else json).
+    """
+    if name == "auto":
+        name = "json" if orjson is None else "orjson"
+    if name == "json":
+        if pretty:
+            return lambda value: json.dumps(value, indent=2)
+        return lambda value: json.dumps(value, separators=(",", ":"))
+    elif name == "orjson":
+        if orjson is None:
+            raise ValueError("JSON encoder orjson is not installed")
+        options = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if pretty else 0)
+        return lambda value: orjson.dumps(value, option=options).decode("utf-8")
+    raise ValueError("Unknown JSON encoder '%s'" % name)
+
+def dumpYAML(value, pretty=True):
+    """YAML document of a value, with the C implementation of the dumper if available"""
+    dumper = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+    return yaml.dump(value, Dumper=dumper, default_flow_style=not pretty, width=10000)
+
+class SigmaOutputSink:
+    """
+    Serializes results of backends in the requested output format and writes them to a text stream as soon as they
+    are generated. Results are strings (text backends) or lists of documents (structured backends).
+    """
+    def __init__(self, out, outputFormat="json", pretty=True, encoder="json", array=False):
+        """
+        array: JSON documents are written as elements of one array, "multiple" writes a single document without
+        array like it is.
+        """
+        if outputFormat not in outputFormats:
+            raise ValueError("Unknown output format '%s'" % outputFormat)
+        self.out = out
+        self.outputFormat = outputFormat
+        self.pretty = pretty
+        self.encode = jsonEncoder(encoder, pretty and outputFormat == "json")
+        self.array = array if outputFormat == "json" else False
+        self.documents = 0      # number of written documents, YAML documents are separated from the previous ones
+        self.elements = 0       # number of array elements
+        self.pending = None     # first array element, held back until it is known if there are more elements
+
+    def serialize(self, document):
+        """Serialize one document into a string without trailing line break"""
+        value = documentValue(document)
+        if type(value) == str:
+            return value
+        elif self.outputFormat == "json":
+            return self.encode(value)
+        elif self.outputFormat == "ndjson":
+            if type(value) == list:
+                return "\n".join([ self.serialize(item) for item in value ])
+            return self.encode(value)
+        else:
+            return dumpYAML(value, self.pretty).rstrip("\n")
+
+    def write(self, result):
+        """Write a string result unchanged or the documents of a structured result"""
+        if type(result) == str:
+            print(result, file=self.out)
+            return
+        for document in resultDocuments(result):
+            if self.array and type(documentValue(document)) != str:
+                self.writeElement(document)
+                continue
+            serialized = self.serialize(document)
+            if self.outputFormat == "yaml" and self.documents > 0 and type(documentValue(document)) != str:
+                print("---", file=self.out)
+            print(serialized, file=self.out)
+            self.documents += 1
+
+    def writeElement(self, document):
+        if self.elements == 0 and self.array == "multiple":
+            self.pending = document
+        else:
+            if self.pending is not None:
+                self.printElement(self.pending)
+                self.pending = None
+            self.printElement(document)
+        self.elements += 1
+
+    def printElement(self, document):
+        serialized = self.serialize(document)
+        if self.pretty:
+            serialized = "  " + serialized.replace("\n", "\n  ")     # JSON strings don't contain line breaks
+        if self.documents == 0:
+            self.out.write("[\n" if self.pretty else "[")
+        else:
+            self.out.write(",\n" if self.pretty else ",")
+        self.out.write(serialized)
+        self.documents += 1
+
+    def close(self):
+        """Finish output after the last result, closes the JSON array"""
+        if not self.array:
+            return
+        if self.pending is not None:
+            print(self.serialize(self.pending), file=self.out)
+            self.pending = None
+        elif self.documents == 0:
+            print("[]", file=self.out)
+        else:
+            self.out.write("\n]\n" if self.pretty else "]\n")
+
+def serializeDocuments(documents, outputFormat="json", pretty=True, encoder="json", array=False):
+    """Serialize list of documents into one string like an output sink"""
+    out = io.StringIO()
+    sink = SigmaOutputSink(out, outputFormat, pretty, encoder, array)
+    sink.write(documents)
+    sink.close()
+    result = out.getvalue()
+    if result.endswith("\n"):
+        result = result[:-1]
+    return result
+
+class SigmaShardedOutput:
+    """
+    Writes results into files of a directory, each document with a name in its metadata starts a new file with this
+    name that contains the following documents without name, e.g. one file per rule. Files are replaced atomically and
+    only if the content changed, unchanged files keep their modification time and deployments can pick up changed
+    artifacts only.
+    """
+    extensions = { "json": "json", "ndjson": "ndjson", "yaml": "yml" }
+    reUnsafe = re.compile(r"[^\w.-]+")
+
+    def __init__(self, directory, outputFormat="json", pretty=True, encoder="json", array=False):
+        SigmaOutputSink(None, outputFormat, pretty, encoder, array)        # validate parameters
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.outputFormat = outputFormat
+        self.pretty = pretty
+        self.encoder = encoder
+        self.array = array
+        self.umask = os.umask(0)        # files get the permissions of files created by open()
+        os.umask(self.umask)
+        self.names = set()
+        self.written = list()
+        self.unchanged = list()
+
+    def filename(self, meta):
+        name = self.reUnsafe.sub("_", meta.get("name", "sigma")).lstrip(".") or "sigma"
+        extension = meta.get("extension", self.extensions[self.outputFormat])
+        filename = "%s.%s" % (name, extension)
+        n = 1
+        while filename in self.names:       # names of results must be unique in one run
+            n += 1
+            filename = "%s-%d.%s" % (name, n, extension)
+        self.names.add(filename)
+        return filename
+
+    def write(self, result):
+        """Write documents of result into their files"""
+        meta = dict()
+        documents = list()
+        for document in resultDocuments(result):
+            if isinstance(document, StructuredResult) and "name" in document.meta and documents:
+                self.writeFile(meta, documents)
+                documents = list()
+            if not documents:
+                meta = getattr(document, "meta", dict())
+            documents.append(document)
+        if documents:
+            self.writeFile(meta, documents)
+
+    def writeFile(self, meta, documents):
+        """Write documents into file named by metadata if the content differs from the existing file"""
+        filename = self.filename(meta)
+        path = os.path.join(self.directory, filename)
+        content = (serializeDocuments(documents, self.outputFormat, self.pretty, self.encoder, self.array) + "\n").encode("utf-8")
+        try:
+            with open(path, "rb") as f:
+                if hashlib.sha256(f.read()).digest() == hashlib.sha256(content).digest():
+                    self.unchanged.append(filename)
+                    return
+        except FileNotFoundError:
+            pass
+        fd, temppath = tempfile.mkstemp(prefix="." + filename, suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.chmod(temppath, 0o666 & ~self.umask)
+            os.replace(temppath, path)
+        except:
+            os.unlink(temppath)
+            raise
+        self.written.append(filename)
+
+    def close(self):
+        pass
@@ -66,9 +66,19 @@ class SigmaCollectionParser:
         """Calls backend for all parsed rules"""
         return filter(
                 lambda x: bool(x),      # filter None's and empty strings
-                [ backend.generate(parser) for parser in self.parsers ]
+                [ result for parser in self.parsers for result in backend.generateBudgeted(parser) ]
                 )
 
+    def generateStream(self, backend):
+        """
+        Generator that calls backend for each parsed rule when the next result is requested. Results of rules are
+        available before following rules are converted and are not lost if a following rule fails.
+        """
+        for parser in self.parsers:
+            for result in backend.generateBudgeted(parser):
+                if result:      # filter None's and empty strings
+                    yield result
+
     def __iter__(self):
         return iter([parser.parsedyaml for parser in self.parsers])
 
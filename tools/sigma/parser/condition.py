@@ -305,8 +305,12 @@ def convertId(sigma, op):
 # Optimizer
 class SigmaConditionOptimizer:
     """
-    Optimizer for the parsed AST.
+    Optimizer for the parsed AST. Terms eliminated by wildcard subsumption are recorded in the eliminated attribute as
+    tuples of condition type (AND or OR), field name, eliminated value and the value that subsumes it.
     """
+    def __init__(self):
+        self.eliminated = list()
+
     def _stripSubexpressionNode(self, node):
         """
         Recursively strips all subexpressions (i.e. brackets) from the AST.
@@ -351,6 +355,211 @@ class SigmaConditionOptimizer:
                 out.append(x)
         return out
 
+    reWildcard = re.compile(r"\\\\(?=[*?])|\\[*?]|([*?])")      # escaped backslash before wildcard, escaped wildcard or wildcard (group 1)
+
+    def _valueKind(self, value):
+        """
+        Match kind of a value: exact, prefix (trailing *), suffix (leading *), contains (* at both ends) or wildcard
+        (other wildcard usage).
+        """
+        if type(value) == int:
+            return "exact"
+        wildcards = [ m.start() for m in self.reWildcard.finditer(value) if m.group(1) ]
+        ends = { 0, len(value) - 1 }
+        if not wildcards:
+            return "exact"
+        elif any([ pos not in ends or value[pos] == "?" for pos in wildcards ]) or len(value) < 2:
+            return "wildcard"
+        elif len(wildcards) == 2:
+            return "contains"
+        elif wildcards[0] == 0:
+            return "suffix"
+        else:
+            return "prefix"
+
+    def _valueSetKey(self, item):
+        """Field and match kind of map items with plain values that can be collapsed into value sets, else None"""
+        if type(item) != tuple or type(item[0]) != str:
+            return None
+        values = item[1] if type(item[1]) == list else [ item[1] ]
+        if len(values) == 0 or not all([ type(value) in (str, int) for value in values ]):
+            return None
+        kinds = { self._valueKind(value) for value in values }
+        if len(kinds) != 1:
+            return None
+        return (item[0], kinds.pop())
+
+    def _collapseValueSets(self, items):
+        """
+        Collapse map items of an OR node with the same field and match kind into one map item with a list of all their
+        values at the position of the first item.
+        """
+        slots = list()
+        groups = dict()
+        for item in items:
+            key = self._valueSetKey(item)
+            if key in groups:
+                groups[key].append(item)
+            else:
+                slot = [ item ]
+                slots.append(slot)
+                if key is not None:
+                    groups[key] = slot
+        collapsed = list()
+        for slot in slots:
+            if len(slot) == 1:
+                collapsed.append(slot[0])
+            else:
+                values = list()
+                for fieldname, value in slot:
+                    for v in (value if type(value) == list else [ value ]):
+                        if v not in values:
+                            values.append(v)
+                collapsed.append((slot[0][0], values))
+        return collapsed
+
+    reValueToken = re.compile(r"\\\\(?=[*?])|\\[*?]|[*?]|[^\\*?]+|\\")
+
+    def _valueTokens(self, value):
+        """Lower case characters of value and wildcard markers (None for *, False for ?)"""
+        tokens = list()
+        for token in self.reValueToken.findall(str(value)):
+            if token == "*":
+                tokens.append(None)
+            elif token == "?":
+                tokens.append(False)
+            elif token in ("\\\\", "\\*", "\\?"):
+                tokens.append(token[1])
+            else:
+                tokens.extend(token.lower())
+        return tokens
+
+    def _covers(self, general, specific):
+        """
+        True if every value matched by the Sigma value pattern general is also matched by specific, values are
+        compared case-insensitive. The test is conservative: wildcards of specific can only be covered by * or the same
+        wildcard in general.
+        """
+        return self._coversTokens(self._valueTokens(general), self._valueTokens(specific))
+
+    def _coversTokens(self, p, q):
+        matched = [ True ] + [ False ] * len(q)         # matched[j]: processed tokens of p match q[:j]
+        for token in p:
+            if token is None:       # * consumes any sequence
+                for j in range(1, len(q) + 1):
+                    matched[j] = matched[j] or matched[j - 1]
+            else:
+                for j in range(len(q), 0, -1):
+                    matched[j] = matched[j - 1] and (q[j - 1] == token if token is not False else q[j - 1] is not None)
+                matched[0] = False
+        return matched[len(q)]
+
+    def _tokensRegex(self, tokens):
+        """Compiled regular expression that matches lower case literal values matched by the tokens"""
+        return re.compile("".join([ ".*" if token is None else "." if token is False else re.escape(token) for token in tokens ]), re.DOTALL)
+
+    def _plainValues(self, item):
+        """List of plain values (strings and numbers) of map item or None if the item has other values"""
+        if type(item) != tuple or type(item[0]) != str:
+            return None
+        values = item[1] if type(item[1]) == list else [ item[1] ]
+        if len(values) == 0 or not all([ type(value) in (str, int) for value in values ]):
+            return None
+        return values
+
+    def _eliminateSubsumedOR(self, items):
+        """
+        Remove values of map items that are subsumed by other values of the same field in an OR condition. Returns
+        new item list or None if nothing was eliminated. Values without wildcards are looked up in a dict, only values
+        with wildcards are compared pairwise.
+        """
+        fields = dict()         # field -> (dict of literal values, list of patterns), values are lists [ value, tokens, eliminated ]
+        itemvalues = list()
+        changed = False
+        for item in items:
+            values = self._plainValues(item)
+            if values is None:
+                itemvalues.append(None)
+                continue
+            literals, patterns = fields.setdefault(item[0], (dict(), list()))
+            entries = list()
+            for value in values:
+                tokens = self._valueTokens(value)
+                if None in tokens or False in tokens:
+                    covering = [ entry for entry in patterns if not entry[2] and self._coversTokens(entry[1], tokens) ]
+                else:
+                    literal = "".join(tokens)
+                    covering = [ literals[literal] ] if literal in literals and not literals[literal][2] else []
+                    covering += [ entry for entry in patterns if not entry[2] and entry[3].fullmatch(literal) ]
+                if covering:
+                    self.eliminated.append(("OR", item[0], value, covering[0][0]))
+                    changed = True
+                    continue
+
+                entry = [ value, tokens, False ]
+                if None in tokens or False in tokens:
+                    regex = self._tokensRegex(tokens)
+                    entry.append(regex)
+                    covered = [ other for other in patterns if not other[2] and self._coversTokens(tokens, other[1]) ]
+                    covered += [ other for other in literals.values() if not other[2] and regex.fullmatch("".join(other[1])) ]
+                    patterns.append(entry)
+                else:
+                    covered = list()
+                    literals["".join(tokens)] = entry
+                for other in covered:
+                    other[2] = True
+                    self.eliminated.append(("OR", item[0], other[0], value))
+                    changed = True
+                entries.append(entry)
+            itemvalues.append(entries)
+
+        if not changed:
+            return None
+        newitems = list()
+        for item, entries in zip(items, itemvalues):
+            if entries is None:
+                newitems.append(item)
+                continue
+            values = [ entry[0] for entry in entries if not entry[2] ]
+            if len(values) == 1:
+                newitems.append((item[0], values[0]))
+            elif len(values) > 1:
+                newitems.append((item[0], values))
+        return newitems
+
+    def _eliminateSubsumedAND(self, items):
+        """
+        Remove map items of an AND condition that are implied by other map items of the same field, i.e. each value
+        of the implying item is subsumed by a value of the implied item. Returns new item list or None if nothing was
+        eliminated.
+        """
+        kept = list()
+        eliminated = list()
+        for item in items:
+            values = self._plainValues(item)
+            if values is None:
+                kept.append(item)
+                continue
+            implying = [ other for other in kept if self._plainValues(other) is not None and other[0] == item[0] and self._implies(other, item) ]
+            if implying:
+                eliminated.append(item)
+                self.eliminated.append(("AND", item[0], item[1], implying[0][1]))
+                continue
+            for other in kept:
+                if self._plainValues(other) is not None and other[0] == item[0] and self._implies(item, other):
+                    eliminated.append(other)
+                    self.eliminated.append(("AND", other[0], other[1], item[1]))
+            kept = [ other for other in kept if not any([ other is e for e in eliminated ]) ]
+            kept.append(item)
+        if not eliminated:
+            return None
+        return kept
+
+    def _implies(self, specific, general):
+        """Map item specific implies map item general"""
+        generalvalues = self._plainValues(general)
+        return all([ any([ self._covers(g, s) for g in generalvalues ]) for s in self._plainValues(specific) ])
+
     def _optimizeNode(self, node, changes=False):
         """
         Recursively optimize the AST rooted at *node* once.  Returns the new
@@ -390,6 +599,23 @@ class SigmaConditionOptimizer:
                 node.items = newitems
                 return self._optimizeNode(node, changes=True)
 
+            # OR((F, X), (F, Y))            =>  OR((F, [X, Y])) for values of same match kind
+            if type(node) == ConditionOR:
+                collapsed = self._collapseValueSets(node.items)
+                if len(collapsed) < len(node.items):
+                    node.items = collapsed
+                    return self._optimizeNode(node, changes=True)
+
+            # OR((F, X), (F, Y))            =>  OR((F, X)) if X subsumes Y
+            # AND((F, X), (F, Y))           =>  AND((F, Y)) if X subsumes Y
+            if type(node) == ConditionOR:
+                reduced = self._eliminateSubsumedOR(node.items)
+            else:
+                reduced = self._eliminateSubsumedAND(node.items)
+            if reduced is not None:
+                node.items = reduced
+                return self._optimizeNode(node, changes=True)
+
             # OR(AND(X, ...), AND(X, ...))  =>  AND(X, OR(AND(...), AND(...)))
             if type(node) == ConditionOR:
                 othertype = ConditionAND
@@ -406,7 +632,8 @@ class SigmaConditionOptimizer:
                             child.items.remove(cand)
                     newnode = othertype()
                     newnode.items = promoted
-                    newnode.add(node)
+                    if all(len(child.items) > 0 for child in node.items):     # else absorbed: OR(AND(X, Y), AND(X)) => X
+                        newnode.add(node)
                     return self._optimizeNode(newnode, changes=True)
 
             # fallthrough
@@ -430,6 +657,13 @@ class SigmaConditionOptimizer:
 
             # fallthrough
 
+        elif type(node) == tuple and type(node[1]) == list:
+            # (F, [X, Y])                   =>  (F, [X]) if X subsumes Y
+            reduced = self._eliminateSubsumedOR([ node ])
+            if reduced is not None:
+                return reduced[0], True
+            return node, changes
+
         else:
             return node, changes
 
@@ -458,7 +692,17 @@ class SigmaConditionOptimizer:
         -   OR(X), AND(X)                 =>  X
         -   OR(X, X, ...), AND(X, X, ...) =>  OR(X, ...), AND(X, ...)
         -   OR(X, OR(Y))                  =>  OR(X, Y)
+        -   OR((F, X), (F, Y))            =>  OR((F, [X, Y])) if X and Y are plain
+            values of the same match kind (exact, prefix, suffix, contains or
+            other wildcard usage), backends render value sets with their list
+            constructs
+        -   OR((F, X), (F, Y))            =>  OR((F, X)) if the wildcard pattern X
+            matches all values matched by Y (case-insensitive, escaped wildcards
+            are literals, regular expressions are never compared)
+        -   AND((F, X), (F, Y))           =>  AND((F, Y)) if X subsumes Y
+        -   (F, [X, Y])                   =>  (F, X) if X subsumes Y
         -   OR(AND(X, ...), AND(X, ...))  =>  AND(X, OR(AND(...), AND(...)))
+        -   OR(AND(X, Y), AND(X))         =>  X
         -   NOT(NOT(X))                   =>  X
         -   NOT(ConditionNULLValue)       =>  ConditionNotNULLValue
         -   NOT(ConditionNotNULLValue)    =>  ConditionNULLValue
@@ -477,6 +721,66 @@ class SigmaConditionOptimizer:
         tree = self._unstripSubexpressionNode(tree)
         return tree
 
+    def pushDownNegations(self, tree, grouped=False, notnull=True):
+        """
+        Return an equivalent copy of the AST rooted at *tree* with negations only in front of atoms (map items, value
+        lists, keywords and null conditions) by application of De Morgan's laws. The given tree is not changed.
+
+        -   NOT(AND(X, Y))                =>  OR(NOT(X), NOT(Y))
+        -   NOT(OR(X, Y))                 =>  AND(NOT(X), NOT(Y))
+        -   NOT((F, null))                =>  ConditionNotNULLValue(F) if *notnull* is set
+        -   NOT((F, [X, Y]))              =>  kept as negated value list (NOT IN)
+
+        Negated items of AND and OR conditions are moved behind the positive items. If *grouped* is set, the negated
+        items of an AND condition are aggregated into one negated block: AND(X, NOT(Y), NOT(Z)) => AND(X, NOT(OR(Y, Z))).
+        """
+        tree = self._pushDownNegation(tree, False, grouped, notnull)
+        return self._unstripSubexpressionNode(tree)
+
+    def _pushDownNegation(self, node, negated, grouped, notnull):
+        if type(node) == NodeSubexpression:
+            return self._pushDownNegation(node.items, negated, grouped, notnull)
+        elif type(node) in (ConditionAND, ConditionOR):
+            if negated:
+                cls = ConditionOR if type(node) == ConditionAND else ConditionAND
+            else:
+                cls = type(node)
+            items = list()
+            for item in node.items:
+                item = self._pushDownNegation(item, negated, grouped, notnull)
+                if type(item) == cls:           # flatten nested conditions of same type
+                    items.extend(item.items)
+                else:
+                    items.append(item)
+            positive = [ item for item in items if type(item) != ConditionNOT ]
+            negative = [ item for item in items if type(item) == ConditionNOT ]
+            if grouped and cls == ConditionAND and len(negative) > 1:
+                block = ConditionOR()
+                block.items = list()
+                for item in negative:           # negated blocks of flattened AND conditions are merged
+                    if type(item.item) == NodeSubexpression:
+                        block.items.extend(item.item.items.items)
+                    else:
+                        block.items.append(item.item)
+                negative = [ ConditionNOT(None, None, NodeSubexpression(block)) ]
+            if len(positive + negative) == 1:
+                return (positive + negative)[0]
+            newnode = cls()
+            newnode.items = positive + negative
+            return newnode
+        elif type(node) == ConditionNOT:
+            return self._pushDownNegation(node.item, not negated, grouped, notnull)
+        elif not negated:
+            return node
+        elif type(node) == ConditionNULLValue:
+            return ConditionNotNULLValue(val=node.item)
+        elif type(node) == ConditionNotNULLValue:
+            return ConditionNULLValue(val=node.item)
+        elif type(node) == tuple and node[1] is None and notnull:
+            return ConditionNotNULLValue(val=node[0])
+        else:
+            return ConditionNOT(None, None, node)
+
 # Condition parser
 class SigmaConditionParser:
     """Parser for Sigma condition expression"""
@@ -493,6 +797,7 @@ class SigmaConditionParser:
         self.sigmaParser = sigmaParser
         self.config = sigmaParser.config
         self._optimizer = SigmaConditionOptimizer()
+        self.eliminated = self._optimizer.eliminated    # terms eliminated by the optimizer
 
         if SigmaConditionToken.TOKEN_PIPE in tokens:    # Condition contains atr least one aggregation expression
             pipepos = tokens.index(SigmaConditionToken.TOKEN_PIPE)
@@ -21,3 +21,10 @@ class SigmaRegularExpressionModifier(SigmaTypeModifier):
     identifier = "re"
     active = True
     valid_input_types = (str,)
+
+class SigmaValueListModifier(SigmaTypeModifier):
+    """Match values contained in external value list. The value is the name of a list from the configuration or a path."""
+    identifier = "list"
+    active = True
+    valid_input_types = (str,)
+    valuelist = None            # SigmaValueList, set by the parser
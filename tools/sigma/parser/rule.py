@@ -16,11 +16,15 @@
 
 import re
 from .exceptions import SigmaParseError
-from .condition import SigmaConditionTokenizer, SigmaConditionParser, ConditionAND, ConditionOR, ConditionNULLValue
+from .condition import SigmaConditionTokenizer, SigmaConditionParser, ConditionAND, ConditionOR, ConditionNULLValue, NodeSubexpression
 from .modifiers import apply_modifiers
+from .modifiers.type import SigmaValueListModifier
+from sigma.valuelist import SigmaValueListError
 
 class SigmaParser:
     """Parse a Sigma rule (definitions, conditions and aggregations)"""
+    part = None         # number of the part if the rule is split by the backend into several queries
+    reTrailingWildcard = re.compile("(?<!\\\\)(?:\\\\\\\\)*\\*$")     # unescaped * at end of value
     def __init__(self, sigma, config):
         self.definitions = dict()
         self.values = dict()
@@ -48,6 +52,7 @@ class SigmaParser:
         except KeyError:
             raise SigmaParseError("No condition found")
 
+        self.keywordfields = self.get_keywordfields()
         self.condparsed = list()        # list of parsed conditions
         for tokens in self.condtoken:
             condparsed = SigmaConditionParser(self, tokens)
@@ -73,7 +78,7 @@ class SigmaParser:
             subcond = None
             for value in definition:
                 if type(value) in (str, int):
-                    cond.add(value)
+                    cond.add(self.scope_keyword(value))
                 elif type(value) in (dict, list):
                     cond.add(self.parse_definition(value))
                 else:
@@ -84,6 +89,11 @@ class SigmaParser:
                 if "|" in key:  # field name contains value modifier
                     fieldname, *modifiers = key.split("|")
                     value = apply_modifiers(value, modifiers)
+                    if isinstance(value, SigmaValueListModifier):
+                        try:
+                            value.valuelist = self.config.get_valuelist(value.value)
+                        except SigmaValueListError as e:
+                            raise SigmaParseError(str(e)) from e
                 else:
                     fieldname = key
                 mapping = self.config.get_fieldmapping(fieldname)
@@ -96,6 +106,30 @@ class SigmaParser:
 
         return cond
 
+    def get_keywordfields(self):
+        """Fields searched by keywords: keyword fields of the log source configuration or of the configuration"""
+        logsource = self.get_logsource()
+        if logsource is not None and logsource.keywordfields:
+            return logsource.keywordfields
+        return self.config.keywordfields
+
+    def scope_keyword(self, value):
+        """
+        Keyword value as search for values that contain the keyword in any of the keyword fields. The value is returned
+        unchanged and searched in all fields by the backend if no keyword fields are configured.
+        """
+        if not self.keywordfields:
+            return value
+        pattern = str(value)
+        if not pattern.startswith("*"):
+            pattern = "*" + pattern
+        if not self.reTrailingWildcard.search(pattern):
+            pattern += "*"
+        cond = ConditionOR()
+        for field in self.keywordfields:
+            cond.add(self.config.get_fieldmapping(field).resolve(field, pattern, self))
+        return NodeSubexpression(cond)
+
     def extract_values(self, definition):
         """Extract all values from map key:value pairs info self.values"""
         if type(definition) == list:     # iterate through items of list
@@ -0,0 +1,254 @@
+# Selectivity estimation and ordering of conditions by field statistics
+# Copyright 2020 Thomas Patzke, Florian Roth
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Many query languages evaluate the children of AND and OR conditions from left to right. The order of the rule often
+puts expensive checks (substring search in command lines, regular expressions) in front of cheap and selective ones
+(event identifier equality). SigmaFieldStatistics estimates for each node of a search the probability that it matches
+an event and the cost of its evaluation and orders AND children by cost / rejection probability and OR children by
+cost / match probability (ascending), the optimal order for independent checks.
+
+Statistics are given as dict or JSON/YAML file with the following content, all keys are optional:
+
+    events: 100000                  # number of sampled events
+    costs:                          # relative evaluation cost per operator
+        exact: 1
+        contains: 8
+    indexed_cost_factor: 0.01       # cost factor for conditions on indexed fields
+    fields:
+        EventID:
+            indexed: true
+            presence: 1.0           # fraction of events that contain the field
+            cardinality: 40         # number of distinct values
+            values:                 # fraction of events with the most frequent values
+                "1": 0.12
+                "4688": 0.3
+
+Without statistics, a default heuristic applies: conditions on indexed fields first, followed by exact values,
+prefixes, suffixes, substrings and other wildcards, regular expressions and keywords. Statistics can be gathered
+from a JSONL export with sampleStatistics() or the sigma-fieldstats tool.
+"""
+
+import re
+import yaml
+import sigma
+from sigma.parser.modifiers.base import SigmaTypeModifier
+from sigma.parser.modifiers.type import SigmaRegularExpressionModifier
+from sigma.engine.evaluator import SigmaValueMatcher
+from sigma.engine.sketches import HyperLogLog
+
+class SigmaFieldStatistics:
+    defaultCosts = {
+            "exact": 1,
+            "null": 1,
+            "prefix": 2,
+            "suffix": 4,
+            "contains": 8,
+            "wildcard": 8,
+            "regex": 16,
+            "keyword": 32,
+            }
+    defaultProbabilities = {     # match probability of values of fields without statistics
+            "exact": 0.05,
+            "prefix": 0.1,
+            "suffix": 0.1,
+            "contains": 0.2,
+            "wildcard": 0.2,
+            "regex": 0.2,
+            }
+    defaultPresence = 0.5        # probability that a field without statistics is contained in an event
+    indexedCostFactor = 0.01
+
+    def __init__(self, statistics=None, indexed=()):
+        statistics = statistics or dict()
+        self.costs = dict(self.defaultCosts)
+        self.costs.update(statistics.get("costs") or dict())
+        self.indexedCostFactor = statistics.get("indexed_cost_factor", self.indexedCostFactor)
+        self.fields = statistics.get("fields") or dict()
+        self.indexed = set(indexed) | { field for field, fieldstats in self.fields.items() if fieldstats.get("indexed") }
+        self.values = dict()    # field -> lower case value -> frequency
+        for field, fieldstats in self.fields.items():
+            values = self.values[field] = dict()
+            for value, frequency in (fieldstats.get("values") or dict()).items():
+                value = str(value).lower()
+                values[value] = values.get(value, 0) + frequency
+        self._optimizer = sigma.parser.condition.SigmaConditionOptimizer()
+
+    @classmethod
+    def load(cls, path, indexed=()):
+        """Load statistics from JSON or YAML file"""
+        with open(path, encoding="utf-8") as f:
+            return cls(yaml.safe_load(f), indexed)
+
+    def order(self, node):
+        """
+        Return a copy of the search tree with AND and OR children ordered by estimated cost and selectivity. AND and OR
+        conditions are enclosed in subexpressions.
+        """
+        node, _, _ = self._order(node)
+        return node
+
+    def estimate(self, node):
+        """Estimated match probability and evaluation cost of a search node in given order as tuple (probability, cost)."""
+        _, probability, cost = self._order(node, False)
+        return probability, cost
+
+    def _order(self, node, reorder=True):
+        """Return (ordered node, probability, cost) of a search tree, cost in given order if reorder is not set"""
+        if type(node) == sigma.parser.condition.NodeSubexpression:
+            return self._order(node.items, reorder)
+        elif type(node) in (sigma.parser.condition.ConditionAND, sigma.parser.condition.ConditionOR):
+            conjunction = type(node) == sigma.parser.condition.ConditionAND
+            children = [ self._order(item, reorder) for item in node.items ]
+            if reorder and conjunction:
+                children.sort(key=lambda child: child[2] / (1 - child[1]) if child[1] < 1 else float("inf"))
+            elif reorder:
+                children.sort(key=lambda child: child[2] / child[1] if child[1] > 0 else float("inf"))
+            newnode = type(node)()
+            newnode.items = [ item for item, _, _ in children ]
+            probability = 1.0           # probability that evaluation continues with the next child
+            cost = 0.0
+            for _, childProbability, childCost in children:
+                cost += probability * childCost
+                probability *= childProbability if conjunction else 1 - childProbability
+            return sigma.parser.condition.NodeSubexpression(newnode), probability if conjunction else 1 - probability, cost
+        elif type(node) == sigma.parser.condition.ConditionNOT:
+            item, probability, cost = self._order(node.item, reorder)
+            return sigma.parser.condition.ConditionNOT(None, None, item), 1 - probability, cost
+        elif type(node) == sigma.parser.condition.ConditionNULLValue:
+            return node, 1 - self.presence(node.item), self.costs["null"]
+        elif type(node) == sigma.parser.condition.ConditionNotNULLValue:
+            return node, self.presence(node.item), self.costs["null"]
+        elif type(node) == tuple:
+            probability, cost = self.valuesEstimate(node[0], node[1])
+            return node, probability, cost
+        else:                           # keywords
+            probability, cost = self.valuesEstimate(None, node)
+            return node, probability, cost
+
+    def valuesEstimate(self, field, value):
+        """Probability and cost of the match of a value or a list of values of field, keywords if field is None"""
+        if type(value) == list:         # values of one field are mostly disjoint
+            estimates = [ self.valuesEstimate(field, item) for item in value ]
+            return min(sum([ probability for probability, _ in estimates ]), 1.0), sum([ cost for _, cost in estimates ])
+        elif value is None:
+            return 1 - self.presence(field), self.costs["null"]
+        kind = self.valueKind(value)
+        if field is None:
+            return self.defaultProbabilities[kind], self.costs["keyword"]
+        cost = self.costs[kind]
+        if field in self.indexed:
+            cost *= self.indexedCostFactor
+        return self.valueProbability(field, value, kind), cost
+
+    def valueKind(self, value):
+        """Match kind of a value: regex, exact (also for other type modifiers) or wildcard kind"""
+        if isinstance(value, SigmaRegularExpressionModifier):
+            return "regex"
+        elif isinstance(value, SigmaTypeModifier):
+            return "exact"
+        return self._optimizer._valueKind(value)
+
+    def presence(self, field):
+        try:
+            return self.fields[field].get("presence", 1.0)
+        except KeyError:
+            return self.defaultPresence
+
+    def valueProbability(self, field, value, kind):
+        """
+        Match probability of a value. Exact values that are not contained in the statistics share the remaining
+        frequency equally with the other values that were not listed. Patterns match the listed values they match and
+        the default probability of the kind of the values that were not listed.
+        """
+        if field not in self.fields:
+            return self.defaultProbabilities[kind]
+        fieldstats = self.fields[field]
+        values = self.values[field]
+        remaining = max(self.presence(field) - sum(values.values()), 0.0)
+        if isinstance(value, SigmaTypeModifier) and kind != "regex":
+            return self.defaultProbabilities[kind]
+        elif kind == "exact":
+            try:
+                return values[str(value).lower()]
+            except KeyError:
+                unlisted = fieldstats.get("cardinality", 0) - len(values)
+                if unlisted > 0:
+                    return remaining / unlisted
+                return remaining * self.defaultProbabilities[kind]
+        elif kind == "regex":
+            regex = re.compile(str(value))
+            matched = sum([ frequency for listed, frequency in (fieldstats.get("values") or dict()).items() if regex.search(str(listed)) ])
+        else:
+            matcher = SigmaValueMatcher(value)
+            matched = sum([ frequency for listed, frequency in values.items() if matcher(listed) ])
+        return min(matched + remaining * self.defaultProbabilities[kind], 1.0)
+
+def flattenEvent(event, prefix=""):
+    """Iterate over (dotted field name, scalar value) pairs of an event, values of lists are returned separately"""
+    for key, value in event.items():
+        if isinstance(value, dict):
+            yield from flattenEvent(value, prefix + key + ".")
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                if isinstance(item, dict):
+                    yield from flattenEvent(item, prefix + key + ".")
+                elif item is not None:
+                    yield prefix + key, item
+        elif value is not None:
+            yield prefix + key, value
+
+def sampleStatistics(events, limit=None, sample_rate=1, top_values=100, indexed=()):
+    """
+    Gather field statistics in the format of SigmaFieldStatistics from an iterable of events (dicts), e.g. a
+    JSONEventReader of a JSONL export. Every sample_rate-th event is sampled up to limit sampled events. Cardinalities
+    are estimated with HyperLogLog sketches. Value counts are kept for the most frequent values, counters of rare values
+    are dropped when more than 10 * top_values values are counted, therefore the frequencies of values that become
+    frequent late in the sample are underestimated.
+    """
+    count = 0
+    presence = dict()
+    cardinalities = dict()
+    counters = dict()
+    for i, event in enumerate(events):
+        if i % sample_rate != 0 or not isinstance(event, dict):
+            continue
+        if limit is not None and count >= limit:
+            break
+        count += 1
+        fields = set()
+        for field, value in flattenEvent(event):
+            value = str(value)
+            if field not in fields:
+                fields.add(field)
+                presence[field] = presence.get(field, 0) + 1
+            cardinalities.setdefault(field, HyperLogLog()).add(value.lower())
+            counter = counters.setdefault(field, dict())
+            counter[value] = counter.get(value, 0) + 1
+            if len(counter) > 10 * top_values:
+                counters[field] = dict(sorted(counter.items(), key=lambda item: -item[1])[:top_values])
+
+    fields = dict()
+    for field in sorted(presence):
+        values = sorted(counters[field].items(), key=lambda item: (-item[1], item[0]))[:top_values]
+        fields[field] = {
+                "presence": presence[field] / count,
+                "cardinality": max(cardinalities[field].count(), len(values)),
+                "values": { value: frequency / count for value, frequency in values },
+                }
+        if field in indexed:
+            fields[field]["indexed"] = True
+    return { "events": count, "fields": fields }
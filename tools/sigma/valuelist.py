@@ -0,0 +1,130 @@
+# External value lists referenced by Sigma rules
+# Copyright 2020 Thomas Patzke, Florian Roth
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import hashlib
+import mmap
+import os
+import re
+import struct
+import tempfile
+
+class SigmaValueListError(Exception):
+    pass
+
+class SigmaValueList:
+    """
+    Sorted and deduplicated set of values from an external list file that is referenced by the list value modifier.
+
+    List files contain one value per line, empty lines and lines beginning with # are ignored. Values are literal,
+    wildcards and backslashes have no special meaning. A list file is converted once into a compiled file in the cache
+    directory that is memory-mapped, values are sorted case-insensitive and membership tests are case-insensitive like
+    comparisons of Sigma values. Compiled files can also be referenced directly.
+
+    Compiled file format: magic, number of values n (unsigned 64 bit, little endian), n + 1 offsets of the values in
+    the data section relative to its beginning, UTF-8 encoded values.
+    """
+    magic = b"SIGMALST"
+    header = struct.Struct("<8sQ")
+    offset = struct.Struct("<Q")
+    reName = re.compile("[^A-Za-z0-9_]")
+    cachedir = os.path.join(tempfile.gettempdir(), "sigma-valuelists")
+    loaded = dict()             # path -> SigmaValueList, lists are loaded only once per process
+
+    def __init__(self, path, name=None):
+        self.path = path
+        self.name = name or self.reName.sub("_", os.path.splitext(os.path.basename(path))[0])
+        with open(path, "rb") as f:
+            compiled = f.read(len(self.magic)) == self.magic
+        if not compiled:
+            path = self.compiled_path(path)
+            if not os.path.exists(path):
+                self.compile(self.path, path)
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = self.header.unpack_from(self.mmap, 0)
+        if magic != self.magic:
+            raise SigmaValueListError("File '%s' is not a compiled value list" % path)
+        self.data = self.header.size + (self.count + 1) * self.offset.size
+
+    @classmethod
+    def load(cls, path, name=None):
+        """Return value list from path, each file is only loaded once"""
+        key = (os.path.abspath(path), name)
+        try:
+            return cls.loaded[key]
+        except KeyError:
+            pass
+        try:
+            valuelist = cls(path, name)
+        except OSError as e:
+            raise SigmaValueListError("Value list '%s' can't be loaded: %s" % (path, str(e))) from e
+        cls.loaded[key] = valuelist
+        return valuelist
+
+    @classmethod
+    def compiled_path(cls, path):
+        """Path of the compiled version of a list file in the cache directory, which changes with the list file"""
+        stat = os.stat(path)
+        key = "%s:%d:%d" % (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        return os.path.join(cls.cachedir, hashlib.sha1(key.encode("utf-8")).hexdigest() + ".lst")
+
+    @classmethod
+    def compile(cls, source, target):
+        """Read values from list file source and write them sorted and deduplicated to compiled file target"""
+        with open(source, encoding="utf-8") as f:
+            values = { line.strip() for line in f }
+        values = sorted([ value for value in values if value != "" and not value.startswith("#") ], key=lambda value: (value.lower(), value))
+        encoded = [ value.encode("utf-8") for value in values ]
+        offsets = [ 0 ]
+        for value in encoded:
+            offsets.append(offsets[-1] + len(value))
+
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        tmp = "%s.%d.tmp" % (target, os.getpid())
+        with open(tmp, "wb") as f:
+            f.write(cls.header.pack(cls.magic, len(encoded)))
+            f.write(b"".join([ cls.offset.pack(offset) for offset in offsets ]))
+            f.write(b"".join(encoded))
+        os.replace(tmp, target)         # atomic, concurrent conversions of the same list don't see partial files
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if not 0 <= i < self.count:
+            raise IndexError("Value list index out of range")
+        start, = self.offset.unpack_from(self.mmap, self.header.size + i * self.offset.size)
+        end, = self.offset.unpack_from(self.mmap, self.header.size + (i + 1) * self.offset.size)
+        return self.mmap[self.data + start:self.data + end].decode("utf-8")
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self[i]
+
+    def __contains__(self, value):
+        """Case-insensitive binary search"""
+        value = str(value).lower()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self[mid].lower() < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo < self.count and self[lo].lower() == value
+
+    def __str__(self):
+        return self.name
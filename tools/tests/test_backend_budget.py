@@ -0,0 +1,121 @@
+import itertools
+import pytest
+from sigma.backends.ala import AzureLogAnalyticsBackend
+from sigma.backends.base import BackendOptions
+from sigma.backends.elasticsearch import ElasticsearchQuerystringBackend, KibanaBackend
+from sigma.backends.exceptions import QueryBudgetError
+from sigma.configuration import SigmaConfiguration
+from sigma.engine.evaluator import SigmaRuleEvaluator
+from sigma.parser.collection import SigmaCollectionParser
+
+rule = """
+id: budget-test
+title: Budget Test
+logsource:
+    category: process_creation
+    product: windows
+detection:
+    selection:
+        Image|endswith:
+            - '\\\\a.exe'
+            - '\\\\b.exe'
+            - '\\\\c.exe'
+            - '\\\\d.exe'
+            - '\\\\e.exe'
+        CommandLine|contains:
+            - 'x1'
+            - 'x2'
+            - 'x3'
+    filter:
+        User:
+            - 'SYSTEM'
+            - 'LOCAL SERVICE'
+    keywords:
+        - 'k1'
+        - 'k2'
+    condition: selection and not filter or keywords
+"""
+
+
+class RecordingBackend(ElasticsearchQuerystringBackend):
+    """Records the parsers of all generated parts"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.parsers = list()
+
+    def generate(self, sigmaparser):
+        self.parsers.append(sigmaparser)
+        return super().generate(sigmaparser)
+
+
+def generate(rule, options, backend_class=RecordingBackend):
+    sigma_config = SigmaConfiguration()
+    backend = backend_class(sigma_config, BackendOptions(options, None))
+    return backend, list(SigmaCollectionParser(rule, sigma_config).generate(backend))
+
+
+def test_backend_budget_unsplit():
+    _, default = generate(rule, [])
+    assert len(default) == 1
+    _, unlimited = generate(rule, [ "max_clauses=0" ])
+    assert unlimited == default
+    _, budget = generate(rule, [ "max_clauses=12" ])
+    assert budget == default
+
+
+def test_backend_budget_split():
+    """Parts stay within budget and match together the same events as the rule"""
+    backend, queries = generate(rule, [ "max_clauses=4" ])
+    assert len(queries) > 1
+    assert len(set(queries)) == len(queries)
+    assert all([ backend.budgetViolation(parser.condparsed[0].parsedSearch) is None for parser in backend.parsers ])
+    assert [ parser.part for parser in backend.parsers ] == list(range(1, len(queries) + 1))
+
+    original = SigmaRuleEvaluator(SigmaCollectionParser(rule).parsers[0])
+    parts = [ SigmaRuleEvaluator(parser) for parser in backend.parsers ]
+    images = [ "C:\\%s.exe" % name for name in "abcz" ]
+    commandlines = [ "run x1", "run x3", "run y" ]
+    users = [ "SYSTEM", "alice" ]
+    messages = [ "k2 found", "nothing" ]
+    for image, commandline, user, message in itertools.product(images, commandlines, users, messages):
+        event = { "Image": image, "CommandLine": commandline, "User": user, "Message": message }
+        assert original.match(event) == any([ part.match(event) for part in parts ])
+
+    _, lengths = generate(rule, [ "max_query_length=150" ])
+    assert len(lengths) > 1
+    assert all([ len(query) <= 150 for query in lengths ])
+
+
+def test_backend_budget_names():
+    backend, _ = generate(rule, [ "max_clauses=4" ], KibanaBackend)
+    assert len(backend.rulenames) > 1
+    assert backend.rulenames == { "budget-test-part%d" % part for part in range(1, len(backend.rulenames) + 1) }
+
+
+def test_backend_budget_error():
+    with pytest.raises(QueryBudgetError, match="can't be split further"):
+        generate(rule.replace("condition: selection and not filter or keywords", "condition: not filter"), [ "max_clauses=1" ])
+    with pytest.raises(QueryBudgetError, match="aggregation"):
+        generate(rule.replace("condition: selection and not filter or keywords", "condition: selection | count() by User > 3"), [ "max_clauses=4" ])
+
+
+
+def test_backend_budget_stateful():
+    """Query length is measured with the log source state of the converted rule, also for the first rule"""
+    security = """
+title: Share Access
+logsource:
+    product: windows
+    service: security
+detection:
+    selection:
+        EventID: 5145
+        ShareName: 'SYSVOL'
+    condition: selection
+"""
+    _, (query,) = generate(security, [], AzureLogAnalyticsBackend)
+    assert query.startswith("SecurityEvent | where ")
+    _, queries = generate(security + "---\n" + rule, [ "max_query_length=300" ], AzureLogAnalyticsBackend)
+    assert len(queries) > 2
+    assert queries[0] == query
+    assert all([ query.startswith("SecurityEvent | where EventID == \"4688\" | where ") for query in queries[1:] ])
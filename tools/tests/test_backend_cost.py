@@ -0,0 +1,114 @@
+import pathlib
+import subprocess
+import sys
+import pytest
+from sigma.backends.base import BackendOptions
+from sigma.backends.elasticsearch import ElasticsearchQuerystringBackend
+from sigma.backends.splunk import SplunkBackend
+from sigma.configuration import SigmaConfiguration
+from sigma.parser.collection import SigmaCollectionParser
+
+toolsdir = pathlib.Path(__file__).resolve().parents[1]
+
+rule = """
+title: Cost Test
+logsource:
+    product: windows
+detection:
+    selection:
+        EventID: 4688
+        CommandLine|contains:
+            - 'mimikatz'
+            - 'sekurlsa'
+        Image|re: '.*\\\\[a-z]+\\.exe'
+    keywords:
+        - 'lsass'
+    condition: selection or keywords
+"""
+
+aggregation = """
+    timeframe: 10m
+    condition: selection | count(CommandLine) by ComputerName > 10
+"""
+
+
+def cost_report(rule, backend_class=ElasticsearchQuerystringBackend, options=()):
+    sigma_config = SigmaConfiguration()
+    backend = backend_class(sigma_config, BackendOptions(list(options), None))
+    parser = SigmaCollectionParser(rule, sigma_config).parsers[0]
+    return backend.costReport(parser)
+
+
+def test_cost_factors():
+    score, factors = cost_report(rule)
+    assert factors["leading_wildcards"] == 2
+    assert factors["regexes"] == 1
+    assert factors["clauses"] == 5
+    assert factors["unbound_keywords"] == 1
+    assert factors["aggregation_risk"] == 0
+    assert factors["query_length"] > 0
+    assert score == pytest.approx(sum([ ElasticsearchQuerystringBackend.costWeights.get(factor, 0) * value for factor, value in factors.items() ]))
+
+
+def test_cost_aggregation_risk():
+    with_timeframe = rule.replace("    condition: selection or keywords\n", aggregation)
+    _, factors = cost_report(with_timeframe)
+    assert factors["aggregation_risk"] == pytest.approx(7)
+    assert factors["unbound_keywords"] == 0
+    _, factors = cost_report(with_timeframe.replace("    timeframe: 10m\n", ""))
+    assert factors["aggregation_risk"] == pytest.approx(14)
+
+
+def test_cost_elasticsearch_factors():
+    _, factors = cost_report(rule)
+    assert factors["all_field_searches"] == 1
+    assert factors["keyword_wildcards"] == 2
+    assert factors["text_wildcards"] == 0
+    _, factors = cost_report(rule, options=[ "unbound_fields=message", "keyword_blacklist=CommandLine" ])
+    assert factors["all_field_searches"] == 0
+    assert factors["keyword_wildcards"] == 0
+    assert factors["text_wildcards"] == 2
+
+
+def test_cost_backend_weights():
+    es_score, es_factors = cost_report(rule)
+    splunk_score, splunk_factors = cost_report(rule, SplunkBackend)
+    assert splunk_factors["query_length"] != es_factors["query_length"]     # exact length of the generated queries
+    assert "all_field_searches" not in splunk_factors
+    assert splunk_score < es_score
+
+
+def test_cost_threshold_factors(tmp_path):
+    path = tmp_path / "rule.yml"
+    path.write_text(rule, encoding="utf-8")
+    def sigmac(target, config, threshold):
+        return subprocess.run([ sys.executable, str(toolsdir / "sigmac"), "-t", target, "-c", config, "--cost-threshold", threshold, str(path) ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    result = sigmac("es-qs", "winlogbeat", "leading_wildcard=0")       # typo of leading_wildcards
+    assert result.returncode == 12
+    assert "Unknown cost factor leading_wildcard" in result.stderr
+    assert sigmac("splunk", "splunk-windows", "text_wildcards=0").returncode == 12       # factor of Elasticsearch backends only
+    result = sigmac("es-qs", "winlogbeat", "text_wildcards=0")
+    assert result.returncode == 0
+    result = sigmac("es-qs", "winlogbeat", "regexes=0")
+    assert result.returncode == 12
+    assert "cost threshold exceeded: regexes 1 > 0" in result.stderr
+
+
+def test_cost_threshold_exit_code(tmp_path):
+    """sigmac converts all rules and fails with exit code 12 if a rule exceeds a threshold, e.g. in CI pipelines"""
+    (tmp_path / "expensive.yml").write_text(rule, encoding="utf-8")
+    (tmp_path / "cheap.yml").write_text(rule.replace("Cost Test", "Cheap Test").replace("selection or keywords", "selection").split("        Image|re")[0] + "    condition: selection\n", encoding="utf-8")
+    def sigmac(*thresholds):
+        args = [ sys.executable, str(toolsdir / "sigmac"), "-rd", "-t", "es-qs", "-c", "winlogbeat" ]
+        for threshold in thresholds:
+            args += [ "--cost-threshold", threshold ]
+        return subprocess.run(args + [ str(tmp_path) ], stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    result = sigmac("regexes=0")
+    assert result.returncode == 12
+    assert len(result.stdout.splitlines()) == 2
+    assert "Cost Test: cost threshold exceeded: regexes 1 > 0" in result.stderr
+    assert "Cheap Test" not in result.stderr
+    assert sigmac("regexes=1", "1000").returncode == 0
+    result = sigmac("1")
+    assert result.returncode == 12
+    assert "Cheap Test: cost threshold exceeded: score" in result.stderr
@@ -1,5 +1,11 @@
-from sigma.backends.elasticsearch import ElasticsearchDSLBackend
+import json
+import logging
+import pathlib
+from sigma.backends.base import BackendOptions
+from sigma.backends.elasticsearch import ElasticsearchDSLBackend, ElasticsearchQuerystringBackend, XPackWatcherBackend
+from sigma.backends.exceptions import NotSupportedError
 from sigma.configuration import SigmaConfiguration
+from sigma.parser.collection import SigmaCollectionParser
 from sigma.parser.condition import SigmaAggregationParser
 
 
@@ -63,3 +69,306 @@ def test_backend_elastic_count_nofield_agg():
     assert ("GroupedField_count" in backend.queries[0]["aggs"]), "GroupedField_count is the top aggregation key"
     assert ("params.count < 3" in bucket_selector["script"]), "bucket selector script must be 'params.count < 3'"
     assert "count" in bucket_selector["buckets_path"], "buckets_path must be 'count'"
+
+
+def generate_dsl(rule, options=None):
+    sigma_config = SigmaConfiguration()
+    backend = ElasticsearchDSLBackend(sigma_config, BackendOptions(options, None))
+    SigmaCollectionParser(rule, sigma_config).generate(backend)
+    return backend.queries[0]["query"]["constant_score"]["filter"]
+
+
+def test_backend_elastic_query_types():
+    """Cheapest equivalent query types for values"""
+    rule = """
+title: Test
+detection:
+    selection:
+        Image:
+            - 'C:\\Windows\\\\*'
+            - '*\\cmd.exe'
+        CommandLine|contains: 'whoami'
+        EventID:
+            - 1
+            - 4688
+        ParentImage: 'C:\\Windows\\explorer.exe'
+        User: '*'
+    condition: selection
+"""
+    assert generate_dsl(rule) == {"bool": {"must": [
+        {"bool": {"should": [
+            {"prefix": {"Image.keyword": "C:\\Windows\\"}},
+            {"wildcard": {"Image.keyword": "*\\\\cmd.exe"}},
+        ]}},
+        {"wildcard": {"CommandLine.keyword": "*whoami*"}},
+        {"terms": {"EventID": ["1", "4688"]}},
+        {"match_phrase": {"ParentImage": "C:\\Windows\\explorer.exe"}},
+        {"exists": {"field": "User.keyword"}},
+    ]}}
+    assert generate_dsl(rule, ["query_types=legacy", "filter_context"])["bool"]["filter"][2] == {"bool": {"should": [
+        {"match_phrase": {"EventID": "1"}},
+        {"match_phrase": {"EventID": "4688"}},
+    ]}}
+    assert generate_dsl(rule, ["keyword_field="])["bool"]["must"][3] == {"term": {"ParentImage": "C:\\Windows\\explorer.exe"}}
+
+
+def count_clauses(query):
+    """Count leaf queries of a query DSL expression"""
+    if type(query) == list:
+        return sum([count_clauses(item) for item in query])
+    elif "bool" in query:
+        return sum([count_clauses(item) for item in query["bool"].values()])
+    else:
+        return 1
+
+
+def test_backend_elastic_clause_counts():
+    """Golden test: optimized query types never need more clauses than legacy output for rules/"""
+    totals = {"legacy": 0, "optimized": 0}
+    for path in sorted(pathlib.Path(__file__).resolve().parents[2].joinpath("rules").glob("**/*.yml")):
+        counts = dict()
+        for query_types in totals.keys():
+            sigma_config = SigmaConfiguration(open(str(pathlib.Path(__file__).resolve().parents[1] / "config" / "winlogbeat.yml")))
+            backend = ElasticsearchDSLBackend(sigma_config, BackendOptions(["query_types=" + query_types], None))
+            try:
+                with path.open(encoding="utf-8") as f:
+                    SigmaCollectionParser(f, sigma_config).generate(backend)
+            except (NotImplementedError, TypeError):
+                continue
+            counts[query_types] = sum([count_clauses(query["query"]["constant_score"]["filter"]) for query in backend.queries])
+        if counts:
+            assert counts["optimized"] <= counts["legacy"], str(path)
+            for query_types, count in counts.items():
+                totals[query_types] += count
+    assert totals["optimized"] < totals["legacy"]
+
+
+percolator_query_types = {"bool", "constant_score", "term", "terms", "prefix", "wildcard", "regexp", "exists", "match_phrase", "multi_match", "range"}
+
+
+def mapped_fields(properties, prefix=""):
+    fields = set()
+    for name, mapping in properties.items():
+        if "properties" in mapping:
+            fields |= mapped_fields(mapping["properties"], prefix + name + ".")
+        else:
+            assert "type" in mapping
+            fields.add(prefix + name)
+            fields |= {prefix + name + "." + subfield for subfield in mapping.get("fields", {})}
+    return fields
+
+
+def validate_percolator(bulk, mapping):
+    """Offline validation of percolator bulk request against the generated index definition"""
+    properties = mapping["mappings"]["properties"]
+    assert properties["sigma"]["properties"]["query"] == {"type": "percolator"}
+    fields = mapped_fields(properties)
+    lines = bulk.split("\n")
+    assert len(lines) % 2 == 0
+    ids = set()
+    for action, document in zip(lines[::2], lines[1::2]):
+        action = json.loads(action)
+        document = json.loads(document)
+        assert set(action) == {"index"} and set(action["index"]) == {"_index", "_id"}
+        ids.add(action["index"]["_id"])
+        assert set(document) == {"sigma"} and set(document["sigma"]) == {"query", "rule"}
+        rule = document["sigma"]["rule"]
+        assert set(rule) <= {"id", "title", "level", "tags"} and "title" in rule
+        used = set()
+        ElasticsearchDSLBackend.collectQueryFields(document["sigma"]["query"], used)
+        assert used <= fields
+        stack = [document["sigma"]["query"]]
+        while stack:
+            query = stack.pop()
+            if type(query) == list:
+                stack.extend(query)
+            else:
+                assert len(query) == 1 and set(query) <= percolator_query_types
+                for querytype, value in query.items():
+                    if querytype in ("bool", "constant_score"):
+                        stack.extend(value.values())
+    assert len(ids) == len(lines) // 2
+    return len(ids)
+
+
+def generate_percolator(rules, sigma_config, options=()):
+    outputs = list()
+    for output in ("percolator", "percolator-mapping"):
+        backend = ElasticsearchDSLBackend(sigma_config, BackendOptions(["output=" + output] + list(options), None))
+        for rule in rules:
+            try:
+                SigmaCollectionParser(rule, sigma_config).generate(backend)
+            except (NotImplementedError, NotSupportedError, TypeError):
+                pass
+        outputs.append(backend.finalize())
+    return outputs[0], json.loads(outputs[1])
+
+
+def test_backend_elastic_percolator():
+    rule = """
+id: 1
+title: Test
+level: high
+tags:
+    - attack.t1086
+detection:
+    selection:
+        EventID: 1
+        Image|endswith: '\\cmd.exe'
+    keywords:
+        - evil
+    condition:
+        - selection
+        - keywords
+"""
+    aggregation = """
+title: Aggregation
+detection:
+    selection:
+        EventID: 4625
+    condition: selection | count() by IpAddress > 10
+"""
+    bulk, mapping = generate_percolator([rule, aggregation], SigmaConfiguration(), ["percolator_index=rules", "keyword_field=raw"])
+    assert validate_percolator(bulk, mapping) == 2
+    lines = [json.loads(line) for line in bulk.split("\n")]
+    assert lines[0] == {"index": {"_index": "rules", "_id": "1-1"}}
+    assert lines[1]["sigma"]["rule"] == {"id": 1, "title": "Test", "level": "high", "tags": ["attack.t1086"]}
+    assert lines[1]["sigma"]["query"]["constant_score"]["filter"]["bool"]["must"][1] == {"wildcard": {"Image.raw": "*\\\\cmd.exe"}}
+    assert lines[2]["index"]["_id"] == "1-2"
+    assert mapping["mappings"]["properties"]["Image"] == {"type": "text", "fields": {"raw": {"type": "keyword"}}}
+
+
+def test_backend_elastic_percolator_rules():
+    """Validate percolator output of all rules in rules/"""
+    paths = sorted(pathlib.Path(__file__).resolve().parents[2].joinpath("rules").glob("**/*.yml"))
+    rules = [path.read_text(encoding="utf-8") for path in paths]
+    sigma_config = SigmaConfiguration(open(str(pathlib.Path(__file__).resolve().parents[1] / "config" / "winlogbeat.yml")))
+    bulk, mapping = generate_percolator(rules, sigma_config)
+    assert validate_percolator(bulk, mapping) > 0
+
+
+def test_backend_xpack_watcher_fused():
+    rules = """
+id: rule.1
+title: Rule 1
+logsource:
+    product: windows
+detection:
+    selection:
+        EventID: 1
+    condition: selection
+---
+id: rule.2
+title: Rule 2
+logsource:
+    product: windows
+detection:
+    selection:
+        EventID: 2
+    condition: selection
+---
+id: rule.3
+title: Rule 3
+logsource:
+    product: windows
+detection:
+    selection:
+        EventID: 3
+    condition: selection
+---
+id: rule.4
+title: Rule 4
+logsource:
+    product: windows
+detection:
+    selection:
+        EventID: 4625
+    condition: selection | count() by IpAddress > 10
+"""
+    sigma_config = SigmaConfiguration(open(str(pathlib.Path(__file__).resolve().parents[1] / "config" / "winlogbeat.yml")))
+    backend = XPackWatcherBackend(sigma_config, BackendOptions(["fuse", "fuse_max_rules=2", "output=json", "alert_methods=email,webhook"], None))
+    SigmaCollectionParser(rules, sigma_config).generate(backend)
+    watchers = [json.loads(line) for line in backend.finalize().splitlines()]
+    assert len(watchers) == 3
+
+    buckets = [watcher["input"]["search"]["request"]["body"]["aggs"]["rules"]["filters"]["filters"] for watcher in watchers]
+    assert [sorted(bucket) for bucket in buckets] == [["rule_1", "rule_2"], ["rule_3"], ["rule_4"]]
+    assert buckets[0]["rule_1"]["query_string"]["query"] == 'winlog.event_id:"1"'
+    assert "aggs" not in watchers[0]["input"]["search"]["request"]["body"]["aggs"]["rules"]
+    assert watchers[2]["input"]["search"]["request"]["body"]["aggs"]["rules"]["aggs"]["by"]["terms"]["field"] == "winlog.event_data.IpAddress.keyword"
+    assert watchers[0]["input"]["search"]["request"]["indices"] == ["winlogbeat-*"]
+    assert watchers[0]["metadata"]["rules"]["rule_2"]["title"] == "Rule 2"
+
+    actions = watchers[0]["actions"]
+    assert sorted(actions) == ["rule_1-httppost", "rule_1-send_email", "rule_2-httppost", "rule_2-send_email"]
+    assert actions["rule_1-send_email"]["condition"] == {"compare": {"ctx.payload.aggregations.rules.buckets.rule_1.doc_count": {"not_eq": 0}}}
+    assert actions["rule_2-httppost"]["webhook"]["body"] == "{{#toJson}}ctx.metadata.rules.rule_2{{/toJson}}"
+    assert watchers[2]["actions"]["rule_4-send_email"]["condition"] == {"compare": {"ctx.payload.aggregations.rules.buckets.rule_4.by.buckets.0.doc_count": {"gt": 10}}}
+
+
+def test_backend_elastic_index_mapping(tmp_path, caplog):
+    mapping = tmp_path / "mapping.json"
+    mapping.write_text(json.dumps({"winlogbeat-7": {"mappings": {"properties": {
+        "EventID": {"type": "long"},
+        "Image": {"type": "keyword"},
+        "CommandLine": {"type": "text", "fields": {"raw": {"type": "keyword"}}},
+        "Message": {"type": "text"},
+        }}}}))
+    rule = """
+title: Test
+detection:
+    selection:
+        EventID: 1
+        Image|endswith: '\\cmd.exe'
+        CommandLine|contains: 'whoami'
+        User: 'admin*'
+    keywords:
+        - 'evil'
+    condition: selection or keywords
+"""
+    options = ["index_mapping=" + str(mapping), "unbound_fields=Message,CommandLine"]
+    caplog.set_level(logging.WARNING)
+    sigma_config = SigmaConfiguration()
+    backend = ElasticsearchQuerystringBackend(sigma_config, BackendOptions(options, None))
+    result = SigmaCollectionParser(rule, sigma_config).generate(backend)
+    assert list(result) == ['((EventID:"1" AND Image:*\\\\cmd.exe AND CommandLine.raw:*whoami* AND User.keyword:admin*) OR (Message:(*evil*) OR CommandLine.raw:(*evil*)))']
+    warnings = [record.getMessage() for record in caplog.records]
+    assert "high cost: leading wildcard in search of field Image for *\\cmd.exe" in warnings
+    assert "high cost: leading wildcard in search of field CommandLine.raw for ['*evil*']" in warnings
+    assert not any(["admin" in warning or "all fields" in warning for warning in warnings])
+
+    assert generate_dsl(rule, options) == {"bool": {"should": [
+        {"bool": {"must": [
+            {"term": {"EventID": "1"}},
+            {"wildcard": {"Image": "*\\\\cmd.exe"}},
+            {"wildcard": {"CommandLine.raw": "*whoami*"}},
+            {"prefix": {"User.keyword": "admin"}},
+            ]}},
+        {"multi_match": {"query": "evil", "fields": ["Message", "CommandLine"], "type": "phrase"}},
+        ]}}
+
+    caplog.clear()
+    sigma_config = SigmaConfiguration()
+    backend = ElasticsearchQuerystringBackend(sigma_config, BackendOptions(["cost_warnings"], None))
+    assert list(SigmaCollectionParser(rule, sigma_config).generate(backend))[0].endswith(" OR evil)")
+    assert "very high cost: search of evil in all fields" in [record.getMessage() for record in caplog.records]
+
+
+def test_backend_elastic_querystring_negations():
+    rule = """
+title: Test
+detection:
+    selection:
+        Image|endswith: '\\\\a.exe'
+    filter1:
+        User: 'SYSTEM'
+    filter2:
+        ParentImage: 'C:\\\\b.exe'
+    condition: selection and not filter1 and not filter2
+"""
+    sigma_config = SigmaConfiguration()
+    generate = lambda options: list(SigmaCollectionParser(rule, sigma_config).generate(ElasticsearchQuerystringBackend(sigma_config, BackendOptions(options, None))))
+    assert generate([]) == [ '((Image.keyword:*\\\\a.exe AND (NOT (User:"SYSTEM"))) AND (NOT (ParentImage:"C\\:\\\\b.exe")))' ]
+    assert generate([ "negations=atoms" ]) == [ '(Image.keyword:*\\\\a.exe AND (NOT User:"SYSTEM") AND (NOT ParentImage:"C\\:\\\\b.exe"))' ]
+    assert generate([ "negations=grouped" ]) == [ '(Image.keyword:*\\\\a.exe AND (NOT (User:"SYSTEM" OR ParentImage:"C\\:\\\\b.exe")))' ]
+    assert generate([]) == generate([ "negations=keep" ])
@@ -0,0 +1,113 @@
+import pathlib
+import random
+import re
+import shutil
+import subprocess
+import pytest
+from sigma.backends.base import BackendOptions
+from sigma.backends.misc import GrepBackend
+from sigma.configuration import SigmaConfiguration
+from sigma.engine.evaluator import SigmaValueMatcher
+from sigma.parser.collection import SigmaCollectionParser
+from sigma.parser.condition import ConditionAND, ConditionOR, ConditionNOT, NodeSubexpression, ConditionNULLValue, ConditionNotNULLValue
+
+toolsdir = pathlib.Path(__file__).resolve().parents[1]
+
+
+def test_backend_grep_fast():
+    rule = """
+title: Test
+detection:
+    selection:
+        Image|endswith: '\\whoami.exe'
+        CommandLine|contains:
+            - '/all'
+            - "/user's"
+    filter:
+        User: 'SYSTEM'
+    condition: selection and not filter
+"""
+    sigma_config = SigmaConfiguration()
+    backend = GrepBackend(sigma_config, BackendOptions([ "output=fast" ], None))
+    assert list(SigmaCollectionParser(rule, sigma_config).generate(backend)) == [ "grep -F -i -e '\\whoami.exe' | grep -P -i '^(?=.*?\\\\whoami\\.exe)(?=.*?(?:/all|/user'\"'\"'s))(?!.*?SYSTEM)'" ]
+
+
+def line_matches(node, line):
+    """Reference semantics of the grep backend: values are searched case-insensitive anywhere in the line"""
+    if type(node) == ConditionAND:
+        return all([ line_matches(item, line) for item in node ])
+    elif type(node) in (ConditionOR, list):
+        return any([ line_matches(item, line) for item in node ])
+    elif type(node) == ConditionNOT:
+        return not line_matches(node.item, line)
+    elif type(node) == NodeSubexpression:
+        return line_matches(node.items, line)
+    elif type(node) == ConditionNULLValue:
+        return node.item.lower() not in line.lower()
+    elif type(node) == ConditionNotNULLValue:
+        return node.item.lower() in line.lower()
+    elif type(node) == tuple and node[1] is None:       # field name is searched for null values
+        return node[0].lower() not in line.lower()
+    elif type(node) == tuple:
+        return line_matches(node[1], line)
+    else:
+        value = str(node)
+        if not value.startswith("*"):
+            value = "*" + value
+        if not value.endswith("*") or value.endswith("\\*"):
+            value += "*"
+        return SigmaValueMatcher(value)(line.lower())
+
+
+def sample_values(node, values):
+    if type(node) in (ConditionAND, ConditionOR, list):
+        for item in node:
+            sample_values(item, values)
+    elif type(node) == ConditionNOT:
+        sample_values(node.item, values)
+    elif type(node) == NodeSubexpression:
+        sample_values(node.items, values)
+    elif type(node) == tuple:
+        sample_values(node[1], values)
+    elif type(node) in (str, int):
+        values.append(str(node).replace("\\*", "*").replace("\\?", "?").replace("*", "x").replace("?", "y"))
+
+
+def test_backend_grep_fast_equivalence(tmp_path):
+    """Fast patterns match the same lines as the reference semantics and every matching line contains a required literal"""
+    backend = GrepBackend(SigmaConfiguration(), BackendOptions([ "output=script" ], None))
+    rules = list()
+    values = list()
+    for path in sorted((toolsdir.parent / "rules" / "windows").glob("**/*.yml")):
+        try:
+            parsers = SigmaCollectionParser(path.read_text(encoding="utf-8"), backend.sigmaconfig).parsers
+            for parser in parsers:
+                for parsed in parser.condparsed[:1]:        # backends convert the first condition
+                    pattern = backend.generateFastPattern(parsed.parsedSearch)
+                    rules.append((parsed.parsedSearch, pattern, backend.requiredLiterals(parsed.parsedSearch)))
+                    sample_values(parsed.parsedSearch, values)
+                backend.generate(parser)
+        except (NotImplementedError, TypeError):
+            continue
+    assert len(rules) > 400
+
+    rnd = random.Random(1)
+    lines = [ " ".join(rnd.sample(values, 3)).replace("\n", " ") for i in range(1000) ]
+    lines = [ line.upper() if i % 5 == 0 else line for i, line in enumerate(lines) ]
+    expected = list()
+    for node, pattern, literals in rules:
+        regex = re.compile(pattern, re.IGNORECASE)
+        matched = { i for i, line in enumerate(lines) if line_matches(node, line) }
+        assert { i for i, line in enumerate(lines) if regex.search(line) } == matched, pattern
+        if literals:
+            assert all([ any([ literal.lower() in lines[i].lower() for literal in literals ]) for i in matched ])
+        expected.append(len(matched))
+    assert sum(expected) > 500
+
+    if shutil.which("grep") and subprocess.run([ "grep", "-P", "x" ], input=b"x").returncode == 0:
+        events = tmp_path / "events.log"
+        events.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        script = tmp_path / "rules.sh"
+        script.write_text(backend.finalize(), encoding="utf-8")
+        output = subprocess.run([ "sh", str(script), str(events) ], stdout=subprocess.PIPE, check=True).stdout.decode("utf-8")
+        assert len(output.splitlines()) == sum(expected)
@@ -0,0 +1,117 @@
+import json
+import pytest
+from sigma.backends.base import BackendOptions
+from sigma.backends.tools import IndexAdvisorBackend
+from sigma.configuration import SigmaConfiguration
+from sigma.parser.collection import SigmaCollectionParser
+
+rules = [ """
+id: rule-1
+title: Rule 1
+status: stable
+level: high
+detection:
+    selection:
+        EventID: 1
+        Image|endswith:
+            - '\\\\a.exe'
+            - '\\\\b.exe'
+        CommandLine|contains: 'x'
+    filter:
+        User: null
+    condition: selection and not filter
+""", """
+id: rule-2
+title: Rule 2
+status: experimental
+level: low
+logsource:
+    product: test
+detection:
+    selection:
+        EventID: 2
+        CommandLine|re: '[a-z]+'
+        ParentImage|startswith: 'C:\\\\'
+    keywords:
+        - 'mimikatz'
+    timeframe: 1h
+    condition: selection or keywords | count() by User > 10
+""" ]
+
+
+def advise(options):
+    sigma_config = SigmaConfiguration()
+    backend = IndexAdvisorBackend(sigma_config, BackendOptions(options, None))
+    for rule in rules:
+        list(SigmaCollectionParser(rule, sigma_config).generate(backend))
+    return backend, backend.finalize()
+
+
+def test_index_advisor_usage():
+    backend, report = advise([])
+    assert backend.usage == {
+            "EventID": { "exact": 4.5 },
+            "Image": { "suffix": 4 },
+            "CommandLine": { "contains": 4, "regex": 0.5 },
+            "User": { "null": 4, "group_by": 0.5 },
+            "ParentImage": { "prefix": 0.5 },
+            "message": { "keyword": 0.5 },
+            }
+    assert backend.rules["EventID"] == { "rule-1", "rule-2" }
+    lines = report.split("\n")
+    assert lines[1] == "CommandLine\t2\t4.5\tcontains=4,regex=0.5\twildcard\tsearch-time\t-"
+    assert lines[2] == "EventID\t2\t4.5\texact=4.5\tkeyword\tindexed\tbtree"
+
+
+def test_index_advisor_elasticsearch():
+    _, template = advise([ "output=es-template", "min_weight=1" ])
+    template = json.loads(template)
+    assert template["index_patterns"] == [ "*" ]
+    assert template["template"]["mappings"]["properties"] == {
+            "EventID": { "type": "keyword" },
+            "Image": { "type": "keyword", "fields": { "reversed": { "type": "text", "analyzer": "sigma_reversed" } } },
+            "CommandLine": { "type": "wildcard" },
+            "User": { "type": "keyword" },
+            }
+    assert "sigma_reversed" in template["template"]["settings"]["analysis"]["analyzer"]
+
+
+def test_index_advisor_splunk():
+    _, conf = advise([ "output=splunk", "top=2" ])
+    assert conf == "# weight 4.5 in 2 rules\n[EventID]\nINDEXED = true\n\n# weight 4.5 in 2 rules\n[User]\nINDEXED = true\n"
+
+
+def test_index_advisor_sql():
+    _, ddl = advise([ "output=sql", "dialect=postgresql", "index=events" ])
+    assert ddl.split("\n") == [
+            "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+            "CREATE INDEX IF NOT EXISTS sigma_events_CommandLine_trigram ON events USING gin (CommandLine gin_trgm_ops);",
+            "CREATE INDEX IF NOT EXISTS sigma_events_EventID_btree ON events (EventID);",
+            "CREATE INDEX IF NOT EXISTS sigma_events_User_btree ON events (User);",
+            "CREATE INDEX IF NOT EXISTS sigma_events_Image_trigram ON events USING gin (Image gin_trgm_ops);",
+            "CREATE INDEX IF NOT EXISTS sigma_events_ParentImage_trigram ON events USING gin (ParentImage gin_trgm_ops);",
+            ]
+    _, ddl = advise([ "output=sql", "dialect=sqlite-fts5" ])
+    assert ddl.split("\n")[-1] == "CREATE VIRTUAL TABLE IF NOT EXISTS eventlog_fts USING fts5(CommandLine, Image, message, content='eventlog', tokenize='trigram');"
+    with pytest.raises(NotImplementedError):
+        advise([ "output=sql", "dialect=oracle" ])
+
+
+def test_index_advisor_sql_text():
+    """Exact values with letters are compared case-insensitive by the SQL dialects"""
+    sigma_config = SigmaConfiguration()
+    rule = "title: Text\ndetection:\n    selection:\n        EventID: 1\n        User: SYSTEM\n    condition: selection"
+    ddl = dict()
+    for dialect in ("sqlite", "postgresql"):
+        backend = IndexAdvisorBackend(sigma_config, BackendOptions([ "output=sql", "dialect=" + dialect ], None))
+        list(SigmaCollectionParser(rule, sigma_config).generate(backend))
+        ddl[dialect] = backend.finalize().split("\n")
+    assert backend.usage == { "EventID": { "exact": 0.5 }, "User": { "exact_text": 0.5 } }       # default level and status weights
+    assert ddl["sqlite"] == [
+            "CREATE INDEX IF NOT EXISTS sigma_eventlog_EventID_btree ON eventlog (EventID);",
+            "CREATE INDEX IF NOT EXISTS sigma_eventlog_User_nocase ON eventlog (User COLLATE NOCASE);",
+            ]
+    assert ddl["postgresql"][1:] == [
+            "CREATE INDEX IF NOT EXISTS sigma_eventlog_EventID_btree ON eventlog (EventID);",
+            "CREATE INDEX IF NOT EXISTS sigma_eventlog_User_lower ON eventlog (LOWER(User));",
+            ]
@@ -0,0 +1,69 @@
+import os
+import pathlib
+import pytest
+from sigma.backends.base import BackendOptions
+from sigma.backends.ala import AzureLogAnalyticsBackend
+from sigma.backends.wdatp import WindowsDefenderATPBackend
+from sigma.configuration import SigmaConfiguration
+from sigma.parser.collection import SigmaCollectionParser
+
+toolsdir = pathlib.Path(__file__).resolve().parents[1]
+goldendir = pathlib.Path(__file__).resolve().parent / "golden"
+
+
+def generate_kql(backend_class, rule, options=None):
+    sigma_config = SigmaConfiguration()
+    backend = backend_class(sigma_config, BackendOptions(options, None))
+    return list(SigmaCollectionParser(rule, sigma_config).generate(backend))
+
+
+def test_backend_kql_terms():
+    rule = """
+title: Test
+logsource:
+    category: process_creation
+    product: windows
+detection:
+    selection:
+        Image|endswith:
+            - '\\\\net.exe'
+            - '\\\\net1.exe'
+        CommandLine|contains:
+            - ' user '
+            - 'mimikatz'
+    filter:
+        ParentImage:
+            - 'C:\\\\Windows\\\\explorer.exe'
+            - 'C:\\\\Windows\\\\System32\\\\cmd.exe'
+            - 'C:\\\\Windows\\\\*\\\\svchost.exe'
+    condition: selection and not filter
+"""
+    assert generate_kql(WindowsDefenderATPBackend, rule) == [ 'ProcessCreationEvents | where (((FolderPath has_any ("net.exe", "net1.exe") and (FolderPath endswith "\\\\net.exe" or FolderPath endswith "\\\\net1.exe")) and ((ProcessCommandLine has "user" and ProcessCommandLine contains " user ") or ProcessCommandLine contains "mimikatz")) and not ((InitiatingProcessFolderPath in~ ("C:\\\\Windows\\\\explorer.exe", "C:\\\\Windows\\\\System32\\\\cmd.exe") or (InitiatingProcessFolderPath has "svchost.exe" and InitiatingProcessFolderPath matches regex @"(?i)^C:\\\\Windows\\\\.*\\\\svchost\\.exe$"))))' ]
+    assert generate_kql(WindowsDefenderATPBackend, rule, [ "matching=fast" ]) == [ 'ProcessCreationEvents | where (((FolderPath has_any ("net.exe", "net1.exe") and (FolderPath endswith "\\\\net.exe" or FolderPath endswith "\\\\net1.exe")) and ProcessCommandLine has_any ("user", "mimikatz")) and not ((InitiatingProcessFolderPath in~ ("C:\\\\Windows\\\\explorer.exe", "C:\\\\Windows\\\\System32\\\\cmd.exe") or (InitiatingProcessFolderPath has "svchost.exe" and InitiatingProcessFolderPath matches regex @"(?i)^C:\\\\Windows\\\\.*\\\\svchost\\.exe$"))))' ]
+    assert generate_kql(AzureLogAnalyticsBackend, rule)[0].startswith('SecurityEvent | where EventID == "4688" | where (((Image has_any ("net.exe", "net1.exe")')
+
+
+def golden_output(backend_class, options):
+    """Output of all rules as lines of relative rule path and generated queries or error type"""
+    sigma_config = SigmaConfiguration()
+    backend = backend_class(sigma_config, BackendOptions(options, None))
+    lines = list()
+    for path in sorted((toolsdir.parent / "rules").glob("**/*.yml")):
+        name = path.relative_to(toolsdir.parent).as_posix()
+        try:
+            for query in SigmaCollectionParser(path.read_text(encoding="utf-8"), sigma_config).generate(backend):
+                lines.append("%s: %s" % (name, query))
+        except Exception as e:
+            lines.append("%s: %s" % (name, type(e).__name__))
+    return "\n".join(lines) + "\n"
+
+
+@pytest.mark.parametrize("backend_class", [ AzureLogAnalyticsBackend, WindowsDefenderATPBackend ])
+@pytest.mark.parametrize("matching", [ "strict", "fast" ])
+def test_backend_kql_golden(backend_class, matching):
+    """Compare output for rules/ with golden files, set SIGMA_UPDATE_GOLDEN=1 to regenerate them after intended changes"""
+    output = golden_output(backend_class, [ "matching=" + matching ])
+    golden = goldendir / ("%s-%s.txt" % (backend_class.identifier, matching))
+    if os.environ.get("SIGMA_UPDATE_GOLDEN"):
+        golden.write_text(output, encoding="utf-8")
+    assert output == golden.read_text(encoding="utf-8")
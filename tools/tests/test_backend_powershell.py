@@ -0,0 +1,73 @@
+import os
+import pathlib
+import pytest
+from sigma.backends.base import BackendOptions
+from sigma.backends.powershell import PowerShellBackend
+from sigma.configuration import SigmaConfiguration, SigmaConfigurationChain
+from sigma.parser.collection import SigmaCollectionParser
+
+toolsdir = pathlib.Path(__file__).resolve().parents[1]
+goldendir = pathlib.Path(__file__).resolve().parent / "golden"
+
+
+def powershell_backend(options=None):
+    """Backend with the default configurations sysmon and powershell"""
+    sigma_config = SigmaConfigurationChain()
+    for path in ("generic/sysmon.yml", "powershell.yml"):
+        with open(str(toolsdir / "config" / path)) as f:
+            sigma_config.append(SigmaConfiguration(f))
+    return sigma_config, PowerShellBackend(sigma_config, BackendOptions(options, None))
+
+
+def generate_powershell(rule, options=None):
+    sigma_config, backend = powershell_backend(options)
+    return list(SigmaCollectionParser(rule, sigma_config).generate(backend))
+
+
+def test_backend_powershell_server_filter():
+    rule = """
+title: Test
+logsource:
+    category: process_creation
+    product: windows
+detection:
+    selection:
+        Image|endswith: '\\\\whoami.exe'
+        User:
+            - 'SYSTEM'
+            - 'O''Brien'
+        IntegrityLevel: 'High'
+    filter:
+        CommandLine|re: '.*/all$'
+    condition: selection and not filter
+"""
+    prefix = "Get-WinEvent -LogName 'Microsoft-Windows-Sysmon/Operational' -FilterXPath '*[System[EventID=1] and EventData[(Data[@Name=\"User\"]=\"SYSTEM\" or Data[@Name=\"User\"]=\"O''Brien\")] and EventData[Data[@Name=\"IntegrityLevel\"]=\"High\"]]'"
+    postfilter = " | where { $d = @{}; ([xml]$_.ToXml()).Event.EventData.Data | foreach { $d[$_.Name] = $_.'#text' }; ($d['Image'] -like '*\\whoami.exe' -and -not ($d['CommandLine'] -match '.*/all$')) } | select TimeCreated,Id,RecordId,ProcessId,MachineName,Message"
+    assert generate_powershell(rule, [ "server_filter=xpath" ]) == [ prefix + postfilter ]
+    assert generate_powershell(rule, [ "server_filter=hashtable" ]) == [ "Get-WinEvent -FilterHashtable @{Id=1; LogName='Microsoft-Windows-Sysmon/Operational'; User='SYSTEM','O''Brien'; IntegrityLevel='High'}" + postfilter ]
+    assert generate_powershell(rule.replace("CommandLine|re: '.*/all$'", "CommandLine|endswith: '/all'"))[0].startswith("Get-WinEvent -LogName Microsoft-Windows-Sysmon/Operational | where {")
+    assert generate_powershell(rule, [ "server_filter=hashtable", "negations=atoms" ]) == generate_powershell(rule, [ "server_filter=hashtable" ])     # -not binds stronger than -match
+
+
+def golden_output(options):
+    """Output of all Windows rules as lines of relative rule path and generated queries or error type"""
+    sigma_config, backend = powershell_backend(options)
+    lines = list()
+    for path in sorted((toolsdir.parent / "rules" / "windows").glob("**/*.yml")):
+        name = path.relative_to(toolsdir.parent).as_posix()
+        try:
+            for query in SigmaCollectionParser(path.read_text(encoding="utf-8"), sigma_config).generate(backend):
+                lines.append("%s: %s" % (name, query))
+        except Exception as e:
+            lines.append("%s: %s" % (name, type(e).__name__))
+    return "\n".join(lines) + "\n"
+
+
+@pytest.mark.parametrize("server_filter", [ "hashtable", "xpath" ])
+def test_backend_powershell_golden(server_filter):
+    """Compare output for rules/windows with golden files, set SIGMA_UPDATE_GOLDEN=1 to regenerate them after intended changes"""
+    output = golden_output([ "server_filter=" + server_filter ])
+    golden = goldendir / ("powershell-%s.txt" % server_filter)
+    if os.environ.get("SIGMA_UPDATE_GOLDEN"):
+        golden.write_text(output, encoding="utf-8")
+    assert output == golden.read_text(encoding="utf-8")
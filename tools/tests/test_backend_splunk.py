@@ -0,0 +1,78 @@
+import pathlib
+import pytest
+from sigma.backends.base import BackendOptions
+from sigma.backends.splunk import SplunkTstatsBackend
+from sigma.configuration import SigmaConfiguration
+from sigma.parser.collection import SigmaCollectionParser
+
+
+def generate_tstats(rule, options=None):
+    sigma_config = SigmaConfiguration(open(str(pathlib.Path(__file__).resolve().parents[1] / "config" / "splunk-cim-tstats.yml")))
+    backend = SplunkTstatsBackend(sigma_config, BackendOptions(options, None))
+    return list(SigmaCollectionParser(rule, sigma_config).generate(backend))[0]
+
+
+def test_backend_splunk_tstats():
+    rule = """
+title: Test
+logsource:
+    category: process_creation
+    product: windows
+detection:
+    selection:
+        Image|endswith: '\\\\cmd.exe'
+        CommandLine|contains:
+            - 'whoami'
+            - 'net user'
+    filter:
+        User: null
+    condition: selection and not filter
+fields:
+    - User
+    - Computer
+    - SomethingElse
+"""
+    assert generate_tstats(rule) == '| tstats summariesonly=true count from datamodel=Endpoint.Processes where ((Processes.process_path="*\\\\cmd.exe" (Processes.process="*whoami*" OR Processes.process="*net user*")) NOT (NOT Processes.user="*")) by Processes.user, Processes.dest'
+    assert generate_tstats(rule, ["summariesonly=false"]).startswith("| tstats summariesonly=false count ")
+
+
+def test_backend_splunk_tstats_aggregation():
+    rule = """
+title: Test
+logsource:
+    category: dns
+detection:
+    selection:
+        query: '*'
+    condition: selection | %s
+"""
+    assert generate_tstats(rule % "count() by src_ip > 1000") == '| tstats summariesonly=true count from datamodel=Network_Resolution.DNS where DNS.query="*" by DNS.src_ip | where count > 1000'
+    assert generate_tstats(rule % "count(query) by src_ip > 100") == '| tstats summariesonly=true dc(DNS.query) as count from datamodel=Network_Resolution.DNS where DNS.query="*" by DNS.src_ip | where count > 100'
+    assert generate_tstats(rule % "sum(question_length) by src_ip > 300000").startswith('`comment("tstats not possible, raw search: aggregation field question_length not contained in data model Network_Resolution")` query="*" | eventstats sum(question_length)')
+
+
+def test_backend_splunk_tstats_fallback():
+    rule = """
+title: Test
+logsource:
+    category: process_creation
+    product: windows
+detection:
+    selection:
+        %s
+    condition: selection
+"""
+    with pytest.raises(NotImplementedError):       # regular expressions aren't supported by raw searches
+        generate_tstats(rule % "CommandLine|re: 'who.*mi'")
+    assert generate_tstats(rule % "EventID: 1") == '`comment("tstats not possible, raw search: field EventID not contained in data model Endpoint")` EventID="1"'
+    assert generate_tstats(rule.replace("process_creation", "antivirus") % "Image: 'x'") == '`comment("tstats not possible, raw search: no data model for log source")` Image="x"'
+    keywords = """
+title: Test
+logsource:
+    category: process_creation
+detection:
+    keywords:
+        - 'evil'
+    condition: keywords
+"""
+    assert generate_tstats(keywords) == '`comment("tstats not possible, raw search: value not bound to a field")` "evil"'
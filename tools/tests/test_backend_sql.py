@@ -0,0 +1,239 @@
+import pathlib
+import pytest
+import random
+import re
+import sqlite3
+from sigma.backends.base import BackendOptions
+from sigma.backends.sql import SQLBackend
+from sigma.configuration import SigmaConfiguration
+from sigma.engine.evaluator import SigmaRuleEvaluator
+from sigma.parser.collection import SigmaCollectionParser
+from sigma.parser.condition import ConditionAND, ConditionOR, ConditionNOT, NodeSubexpression
+
+toolsdir = pathlib.Path(__file__).resolve().parents[1]
+
+
+def sql_backend(options=None):
+    sigma_config = SigmaConfiguration(open(str(toolsdir / "config" / "generic" / "sysmon.yml")))
+    return sigma_config, SQLBackend(sigma_config, BackendOptions(options, None))
+
+
+def generate_sql(rules, options=None):
+    sigma_config, backend = sql_backend(options)
+    results = list()
+    for rule in rules:
+        results.extend(SigmaCollectionParser(rule, sigma_config).generate(backend))
+    final = backend.finalize()
+    if final:
+        results.append(final)
+    return results
+
+
+def test_backend_sql_multirule():
+    rule = """
+id: %s
+title: Test
+logsource:
+    category: process_creation
+    product: windows
+detection:
+    selection:
+        Image|endswith: '%s'
+    condition: selection
+"""
+    rules = [ rule % ("rule-1", "\\whoami.exe"), rule % ("rule-2", "\\net.exe") ]
+    assert generate_sql(rules[:1], ["output=query", "table=events"]) == [ 'SELECT * FROM events WHERE (EventID = "1" AND Image LIKE "%\\whoami.exe");' ]
+    assert generate_sql(rules, ["output=multirule", "table=events"]) == [ """WITH sigma_matches AS (
+  SELECT *
+  FROM events
+  WHERE EventID = "1" AND ((Image LIKE "%\\whoami.exe") OR (Image LIKE "%\\net.exe"))
+)
+SELECT 'rule-1' AS rule_id, * FROM sigma_matches WHERE Image LIKE "%\\whoami.exe"
+UNION ALL
+SELECT 'rule-2' AS rule_id, * FROM sigma_matches WHERE Image LIKE "%\\net.exe";""" ]
+    assert generate_sql([ rules[0], rules[0].replace("rule-1", "rule-3") ], ["output=multirule", "table=events"]) == [ """WITH sigma_matches AS (
+  SELECT *
+  FROM events
+  WHERE EventID = "1" AND Image LIKE "%\\whoami.exe"
+)
+SELECT 'rule-1' AS rule_id, * FROM sigma_matches
+UNION ALL
+SELECT 'rule-3' AS rule_id, * FROM sigma_matches;""" ]
+
+
+def collect_values(node, values):
+    """Collect (field, value) pairs of a parse tree, wildcards are replaced by sample text. SQL identifiers are case-insensitive."""
+    if type(node) in (ConditionAND, ConditionOR):
+        for item in node:
+            collect_values(item, values)
+    elif type(node) == ConditionNOT:
+        collect_values(node.item, values)
+    elif type(node) == NodeSubexpression:
+        collect_values(node.items, values)
+    elif type(node) == tuple:
+        fieldname, value = node
+        if type(value) == list:
+            value = value[0] if value else None
+        if type(value) in (str, int):
+            values.setdefault(fieldname.lower(), str(value).replace("*", "x").replace("?", "y"))
+
+
+def process_creation_rules():
+    """Rules from process_creation directory with one condition and an identifier"""
+    sigma_config, _ = sql_backend()
+    parsers = list()
+    for path in sorted((toolsdir.parent / "rules" / "windows" / "process_creation").glob("*.yml")):
+        try:
+            collection = SigmaCollectionParser(path.read_text(encoding="utf-8"), sigma_config)
+        except Exception:
+            continue
+        if len(collection.parsers) == 1 and len(collection.parsers[0].condparsed) == 1 and "id" in collection.parsers[0].parsedyaml:
+            parsers.append(collection.parsers[0])
+    return parsers
+
+
+def sample_database(parsers):
+    """
+    SQLite database with table events containing one event per rule with values of the rule, the same events with
+    swapped case of the values, plus events that mix values of different rules, and an FTS5 trigram index events_fts
+    of the table.
+    """
+    rnd = random.Random(1)
+    samples = list()
+    for parser in parsers:
+        values = dict()
+        collect_values(parser.condparsed[0].parsedSearch, values)
+        samples.append(values)
+    fields = sorted({ field for sample in samples for field in sample if re.fullmatch("[a-z_][a-z0-9_]*", field) })
+    pool = [ list(sample.items()) for sample in samples if sample ]
+    swapped = [ { field: value.swapcase() for field, value in sample.items() } for sample in samples ]
+    events = samples + swapped + [ dict([ rnd.choice(rnd.choice(pool)) for i in range(4) ]) for j in range(len(samples)) ]
+
+    db = sqlite3.connect(":memory:")
+    db.create_function("regexp", 2, lambda pattern, value: value is not None and re.search(pattern, value) is not None)
+    db.execute("CREATE TABLE events (event_id INTEGER PRIMARY KEY, %s)" % ", ".join(fields))
+    db.executemany("INSERT INTO events VALUES (%s)" % ", ".join([ "?" ] * (len(fields) + 1)), [ [ i ] + [ event.get(field) for field in fields ] for i, event in enumerate(events) ])
+    db.execute("CREATE VIRTUAL TABLE events_fts USING fts5(%s, content='events', content_rowid='event_id', tokenize='trigram')" % ", ".join(fields))
+    db.execute("INSERT INTO events_fts(events_fts) VALUES ('rebuild')")
+    return db
+
+
+def rule_matches(db, parsers, options):
+    """Run queries of rules and return the supported rules and set of (rule id, event id) pairs"""
+    _, backend = sql_backend(options + [ "output=query", "table=events" ])
+    matches = set()
+    supported = list()
+    for parser in parsers:
+        try:
+            query, = backend.generateBudgeted(parser)
+            rows = db.execute(query).fetchall()
+        except (NotImplementedError, TypeError, sqlite3.Error):
+            continue
+        supported.append(parser)
+        matches |= { (parser.parsedyaml["id"], row[0]) for row in rows }
+    return supported, matches
+
+
+def test_backend_sql_multirule_equivalence():
+    """Single-scan query returns the same (rule, row) pairs as the queries of all rules on SQLite"""
+    parsers = process_creation_rules()
+    db = sample_database(parsers)
+    supported, expected = rule_matches(db, parsers, [])
+    assert len(supported) > 100
+    assert len(expected) >= len(supported)
+
+    _, backend = sql_backend(["output=multirule", "table=events"])
+    for parser in supported:
+        backend.generate(parser)
+    query = backend.finalize()
+    assert query.count("FROM events") == 1
+    cursor = db.execute(query)
+    columns = [ column[0] for column in db.execute("SELECT * FROM events LIMIT 0").description ]
+    assert [ column[0] for column in cursor.description ] == [ "rule_id" ] + columns       # rule id and event row only
+    assert { (row[0], row[1]) for row in cursor.fetchall() } == expected
+
+
+def detection_strings(node):
+    """
+    Keys and string values of a detection. Regular expressions and double backslashes that are not in front of a
+    wildcard (unescaped by the SQL dialects, literal in local evaluation) are matched differently.
+    """
+    if type(node) == dict:
+        for key, value in node.items():
+            yield key
+            yield from detection_strings(value)
+    elif type(node) == list:
+        for item in node:
+            yield from detection_strings(item)
+    elif type(node) == str:
+        yield node
+
+
+class ColumnEvent(dict):
+    """Event of a table row for local evaluation, field names are case-insensitive like SQL identifiers"""
+    def __getitem__(self, key):
+        return super().__getitem__(key.lower())
+
+
+def test_backend_sql_case_insensitive():
+    """Queries of the sqlite dialect match the same events as local evaluation, which matches case-insensitive"""
+    parsers = [ parser for parser in process_creation_rules() if not any([ "|re" in text or "\\\\" in text for text in detection_strings(parser.parsedyaml["detection"]) ]) ]
+    db = sample_database(parsers)
+    supported, matches = rule_matches(db, parsers, [ "dialect=sqlite" ])
+    assert len(supported) > 100
+    cursor = db.execute("SELECT * FROM events")
+    columns = [ column[0] for column in cursor.description ]
+    events = [ ColumnEvent([ (column, value) for column, value in zip(columns, row) if value is not None ]) for row in cursor.fetchall() ]
+    expected = { (parser.parsedyaml["id"], event["event_id"]) for parser in supported for event in events if SigmaRuleEvaluator(parser).match(event) }
+    assert matches == expected
+
+
+def test_backend_sql_dialects():
+    rule = """
+title: Test
+logsource:
+    category: process_creation
+    product: windows
+detection:
+    selection:
+        CommandLine|contains:
+            - 'whoami'
+            - '100%'
+        ParentImage|endswith: '\\explorer.exe'
+        User: 'SYSTEM'
+    filter:
+        Image: null
+    condition: selection and not filter
+"""
+    options = [ "table=events" ]
+    assert generate_sql([ rule ], options + [ "dialect=sqlite" ]) == [ "(EventID = '1' AND (User = 'SYSTEM' COLLATE NOCASE AND (CommandLine LIKE '%whoami%' ESCAPE '\\' OR CommandLine LIKE '%100\\%%' ESCAPE '\\') AND ParentImage LIKE '%\\\\explorer.exe' ESCAPE '\\') AND NOT COALESCE((Image IS NULL), FALSE))" ]
+    assert generate_sql([ rule ], options + [ "dialect=sqlite-fts5" ]) == [ "(EventID = '1' AND (rowid IN (SELECT rowid FROM events_fts WHERE events_fts MATCH 'CommandLine : \"whoami\" OR CommandLine : \"100%\"') AND (rowid IN (SELECT rowid FROM events_fts WHERE events_fts MATCH 'ParentImage : \"\\explorer.exe\"') AND ParentImage LIKE '%\\\\explorer.exe' ESCAPE '\\') AND User = 'SYSTEM' COLLATE NOCASE) AND NOT COALESCE((Image IS NULL), FALSE))" ]
+    assert generate_sql([ rule ], options + [ "dialect=postgresql" ]) == [ "(EventID = '1' AND ((CommandLine ILIKE '%whoami%' OR CommandLine ILIKE '%100\\%%') AND ParentImage ILIKE '%\\\\explorer.exe' AND LOWER(User) = 'system') AND NOT COALESCE((Image IS NULL), FALSE))" ]
+    assert generate_sql([ rule ], options + [ "dialect=postgresql", "negations=grouped" ]) == [ "(EventID = '1' AND (CommandLine ILIKE '%whoami%' OR CommandLine ILIKE '%100\\%%') AND ParentImage ILIKE '%\\\\explorer.exe' AND LOWER(User) = 'system' AND Image IS NOT NULL)" ]
+    with pytest.raises(NotImplementedError):
+        generate_sql([ rule ], [ "dialect=oracle" ])
+
+
+def test_backend_sql_fts5():
+    """FTS5 queries return the same results as LIKE queries on SQLite"""
+    parsers = process_creation_rules()
+    db = sample_database(parsers)
+    supported, expected = rule_matches(db, parsers, [ "dialect=sqlite" ])
+    assert len(supported) > 100
+    fts_supported, matches = rule_matches(db, supported, [ "dialect=sqlite-fts5" ])
+    assert fts_supported == supported
+    assert matches == expected
+
+
+def test_backend_sql_negations():
+    """Conditions with negations pushed down or grouped return the same results as the original conditions on SQLite"""
+    parsers = process_creation_rules()
+    db = sample_database(parsers)
+    supported, expected = rule_matches(db, parsers, [ "dialect=sqlite" ])
+    assert len(supported) > 100
+    for form in ("atoms", "grouped"):
+        form_supported, matches = rule_matches(db, supported, [ "dialect=sqlite", "negations=" + form ])
+        assert form_supported == supported
+        assert matches == expected
+    with pytest.raises(NotImplementedError, match="Negation form"):
+        generate_sql([ "title: Test\ndetection:\n    selection:\n        Image: x\n    condition: not selection" ], [ "negations=cnf" ])
@@ -0,0 +1,246 @@
+import functools
+import io
+import pytest
+import random
+from sigma.parser.collection import SigmaCollectionParser
+from sigma.engine.evaluator import SigmaRuleEvaluator, SigmaRulesetEvaluator, SigmaValueMatcher
+from sigma.engine.events import JSONEventReader, CSVEventReader
+from sigma.engine.bundle import SigmaBundle, SigmaBundleError
+from sigma.engine.adaptive import SigmaAdaptiveConditionCompiler, loadOrderings, saveOrderings
+from sigma.engine.aggregation import ExactAggregation, ApproximateAggregation
+from sigma.engine.sketches import HyperLogLog, CountMinSketch
+
+def parse_rule(rule):
+    return SigmaCollectionParser(rule).parsers[0]
+
+def test_value_matcher():
+    assert SigmaValueMatcher("cmd.exe")("cmd.exe")
+    assert not SigmaValueMatcher("cmd.exe")("xcmd.exe")
+    assert SigmaValueMatcher("*\\cmd.exe")("c:\\windows\\cmd.exe")
+    assert SigmaValueMatcher("*mimikatz*")("run mimikatz now")
+    assert SigmaValueMatcher("C:\\Windows\\\\*")("c:\\windows\\system32")
+    assert not SigmaValueMatcher("C:\\Windows\\*")("c:\\windows\\system32")
+    assert SigmaValueMatcher("a?c*d")("abcxxd")
+    assert not SigmaValueMatcher("a\\*c")("abc")
+    assert SigmaValueMatcher("a\\*c")("a*c")
+    assert SigmaValueMatcher("a\\\\*")("a\\bc")
+
+def test_rule_evaluation():
+    parser = parse_rule("""
+title: Test
+detection:
+    selection:
+        EventID: 1
+        Image|endswith:
+            - '\\cmd.exe'
+            - '\\powershell.exe'
+    filter:
+        CommandLine|contains: 'legit'
+    keywords:
+        - 'evil'
+    condition: selection and not filter or keywords
+""")
+    evaluator = SigmaRuleEvaluator(parser)
+    assert evaluator.match({ "EventID": 1, "Image": "C:\\Windows\\System32\\CMD.EXE", "CommandLine": "cmd /c foo" })
+    assert not evaluator.match({ "EventID": 1, "Image": "C:\\Windows\\System32\\cmd.exe", "CommandLine": "legit" })
+    assert not evaluator.match({ "EventID": 2, "Image": "C:\\Windows\\System32\\cmd.exe" })
+    assert evaluator.match({ "EventID": 2, "event_data": { "Message": "something EVIL" } })
+
+def test_ruleset_fields():
+    ruleset = SigmaRulesetEvaluator()
+    ruleset.load("""
+title: Test 1
+detection:
+    selection:
+        winlog.event_data.Image|endswith: '\\cmd.exe'
+    condition: selection | count(User) by Computer > 1
+---
+title: Test 2
+detection:
+    selection:
+        EventID: 1
+    condition: selection
+""")
+    assert ruleset.fields == { "winlog.event_data.Image", "User", "Computer", "EventID" }
+    ruleset.load("""
+title: Test 3
+detection:
+    keywords:
+        - 'evil'
+    condition: keywords
+""")
+    assert ruleset.fields is None
+
+def test_event_reader_projection():
+    fields = { "winlog.event_data.Image", "EventID" }
+    events = list(JSONEventReader(io.StringIO('{"EventID": 1, "message": "x", "winlog": {"event_data": {"Image": "a"}}}\n\n{"winlog.event_data.Image": "b", "host": {}}\n'), fields))
+    assert events == [ { "EventID": 1, "winlog": { "event_data": { "Image": "a" } } }, { "winlog.event_data.Image": "b" } ]
+    events = list(CSVEventReader(io.StringIO("EventID,Image,User\n1,a,\n2,b,c\n"), fields | { "Image", "User" }))
+    assert events == [ { "EventID": "1", "Image": "a" }, { "EventID": "2", "Image": "b", "User": "c" } ]
+
+def test_event_reader_projection_skipping(monkeypatch):
+    import sigma.engine.events
+    pytest.importorskip("simdjson")
+    fields = { "winlog.event_data.Image", "EventID", "list" }
+    data = '{"EventID": 1, "list": [1, {"a": null}], "message": "x", "winlog": {"event_data": {"Image": "a"}}}\n[1, 2]\n"s"\n{"EventID": 18446744073709551616}\n'
+    events = list(JSONEventReader(io.StringIO(data), fields))
+    monkeypatch.setattr(sigma.engine.events, "simdjson", None)
+    assert events == list(JSONEventReader(io.StringIO(data), fields))
+    assert events[0] == { "EventID": 1, "list": [1, { "a": None }], "winlog": { "event_data": { "Image": "a" } } }
+
+def test_adaptive_ordering():
+    rule = """
+title: Test
+detection:
+    selection:
+        CommandLine|re: '.*mimikatz.*'
+        EventID: 1
+    filter:
+        - User: 'admin'
+        - Image|endswith: '\\cmd.exe'
+    condition: selection and not filter
+"""
+    rnd = random.Random(1)
+    events = [ { "EventID": rnd.choice((1, 2, 3, 4)), "CommandLine": rnd.choice(("run mimikatz", "whoami")), "User": rnd.choice(("admin", "user")), "Image": rnd.choice(("C:\\cmd.exe", "C:\\app.exe")) } for i in range(2000) ]
+    static = SigmaRuleEvaluator(parse_rule(rule))
+    orderings = dict()
+    adaptive = SigmaRuleEvaluator(parse_rule(rule), compiler=functools.partial(SigmaAdaptiveConditionCompiler, orderings, sample_rate=2, reorder_interval=10))
+    assert [ static.match(event) for event in events ] == [ adaptive.match(event) for event in events ]
+
+    statistics = adaptive.compiler.statistics()
+    selection = [ node for node in statistics if node["node"].startswith("and(CommandLine") ][0]
+    assert selection["samples"] > 0
+    assert [ child["node"] for child in selection["children"] ][0] == "EventID=1"
+    assert all([ child["calls"] == selection["samples"] for child in selection["children"] ])
+
+    f = io.StringIO()
+    saveOrderings(orderings, f)
+    f.seek(0)
+    restored = SigmaRuleEvaluator(parse_rule(rule), compiler=functools.partial(SigmaAdaptiveConditionCompiler, loadOrderings(f)))
+    assert [ node.order for node in restored.compiler.nodes ] == [ node.order for node in adaptive.compiler.nodes ]
+    assert [ static.match(event) for event in events ] == [ restored.match(event) for event in events ]
+
+def test_bundle():
+    ruleset = SigmaRulesetEvaluator()
+    ruleset.load("""
+id: 1
+title: Test 1
+level: high
+tags:
+    - attack.t1086
+detection:
+    selection:
+        EventID: 1
+        CommandLine|re: 'mimi.*katz'
+    filter:
+        - Image: '*\\cmd.exe'
+        - Image: null
+    condition: selection and not filter
+---
+title: Test 2
+detection:
+    selection:
+        EventID: 4625
+    keywords:
+        - 'evil'
+        - 'bad'
+    condition:
+        - selection | count(User) by IpAddress > 1
+        - keywords
+""")
+    data = SigmaBundle.fromRuleset(ruleset).serialize()
+    assert data == SigmaBundle.fromRuleset(ruleset).serialize()
+    bundle = SigmaBundle.fromBytes(data)
+    assert bundle.fields is None        # keywords of Test 2
+    assert bundle.payload["rules"][0]["fields"] == [ "CommandLine", "EventID", "Image" ]
+    loaded = bundle.ruleset()
+    assert loaded.rules[0].sigmaparser.parsedyaml == { "id": 1, "title": "Test 1", "level": "high", "tags": [ "attack.t1086" ] }
+    assert SigmaBundle.fromRuleset(loaded).serialize() == data
+
+    events = [
+            { "EventID": 1, "CommandLine": "run mimikatz", "Image": "c:\\app.exe" },
+            { "EventID": 1, "CommandLine": "run mimikatz", "Image": "c:\\cmd.exe" },
+            { "EventID": 1, "CommandLine": "run mimikatz" },
+            { "EventID": 4625, "User": "a", "IpAddress": "1.1.1.1" },
+            { "EventID": 4625, "User": "b", "IpAddress": "1.1.1.1" },
+            { "EventID": 2, "Message": "something bad" },
+            ]
+    for event in events:
+        assert [ rule.sigmaparser.parsedyaml["title"] for rule in ruleset.match(event) ] == [ rule.sigmaparser.parsedyaml["title"] for rule in loaded.match(event) ]
+    assert [ (group, value) for rule, group, value in ruleset.aggregate() ] == [ (group, value) for rule, group, value in loaded.aggregate() ] == [ ("1.1.1.1", 2) ]
+
+    with pytest.raises(SigmaBundleError, match="content hash"):
+        SigmaBundle.fromBytes(data[:-1] + b"x")
+    with pytest.raises(SigmaBundleError, match="not a Sigma bundle"):
+        SigmaBundle.fromBytes(b"x" * len(data))
+    outdated = SigmaBundle.fromRuleset(ruleset)
+    outdated.payload["sigma_version"] = "0.1"
+    with pytest.raises(SigmaBundleError, match="version"):
+        SigmaBundle.fromBytes(outdated.serialize())
+    assert len(SigmaBundle.fromBytes(outdated.serialize(), ignore_version=True).rules()) == 2
+
+def test_aggregation_exact():
+    parser = parse_rule("""
+title: Test
+detection:
+    selection:
+        EventID: 4625
+    condition: selection | count(TargetUserName) by IpAddress > 2
+""")
+    evaluator = SigmaRuleEvaluator(parser)
+    for ip, user in (("1.1.1.1", "a"), ("1.1.1.1", "b"), ("1.1.1.1", "c"), ("2.2.2.2", "a"), ("2.2.2.2", "a")):
+        assert not evaluator.match({ "EventID": 4625, "IpAddress": ip, "TargetUserName": user })
+    assert evaluator.aggregate() == [ ("1.1.1.1", 3) ]
+    evaluator.reset()
+    assert evaluator.aggregate() == []
+
+def test_aggregation_approximate():
+    rule = """
+title: Test
+detection:
+    selection:
+        EventID: 4625
+    condition: selection | %s
+"""
+    rnd = random.Random(1)
+    events = [ { "EventID": 4625, "IpAddress": "10.0.0.%d" % rnd.randrange(200), "TargetUserName": "user%d" % rnd.randrange(100) } for i in range(20000) ]
+    events += [ { "EventID": 4625, "IpAddress": "10.0.1.1", "TargetUserName": "spray%d" % i } for i in range(2000) ]
+    for condition in ("count(TargetUserName) by IpAddress > 99", "count() by IpAddress > 500"):
+        exact = SigmaRuleEvaluator(parse_rule(rule % condition))
+        approximate = SigmaRuleEvaluator(parse_rule(rule % condition), ApproximateAggregation)
+        for event in events:
+            exact.match(event)
+            approximate.match(event)
+        exact_results = dict(exact.aggregate())
+        approximate_results = dict(approximate.aggregate())
+        assert set(exact_results) == set(approximate_results) == { "10.0.1.1" }
+        assert abs(approximate_results["10.0.1.1"] - exact_results["10.0.1.1"]) / exact_results["10.0.1.1"] < 0.05
+
+def test_aggregation_memory_limit():
+    parser = parse_rule("""
+title: Test
+detection:
+    selection:
+        EventID: 4625
+    condition: selection | count(TargetUserName) by IpAddress > 50
+""")
+    evaluator = SigmaRuleEvaluator(parser, functools.partial(ApproximateAggregation, memory_limit=100000))
+    for i in range(5000):
+        evaluator.match({ "EventID": 4625, "IpAddress": "10.0.%d.%d" % (i // 256, i % 256), "TargetUserName": "user" })
+    for i in range(100):
+        evaluator.match({ "EventID": 4625, "IpAddress": "10.1.1.1", "TargetUserName": "user%d" % i })
+    aggregation = evaluator.conditions[0].aggregation
+    assert aggregation.memory <= 100000
+    assert aggregation.evicted > 0
+    assert [ group for group, value in evaluator.aggregate() ] == [ "10.1.1.1" ]
+
+def test_sketches():
+    hll = HyperLogLog.from_error(0.02)
+    for i in range(100000):
+        hll.add(i)
+    assert abs(hll.count() - 100000) / 100000 < 0.06
+    cms = CountMinSketch.from_error(0.001)
+    for i in range(10000):
+        cms.add(i % 100)
+    assert cms.estimate(5) >= 100
+    assert cms.estimate(5) <= 100 + cms.error
@@ -0,0 +1,91 @@
+import logging
+import pytest
+from sigma.backends.base import BackendOptions
+from sigma.backends.elasticsearch import ElasticsearchQuerystringBackend
+from sigma.backends.splunk import SplunkBackend
+from sigma.backends.tools import FieldnameListBackend
+from sigma.config.exceptions import SigmaConfigParseError
+from sigma.configuration import SigmaConfiguration, SigmaConfigurationChain
+from sigma.parser.collection import SigmaCollectionParser
+
+config = """
+keywordfields: Message
+fieldmappings:
+    CommandLine: process.command_line
+logsources:
+    process_creation:
+        category: process_creation
+        product: windows
+        keywordfields:
+            - CommandLine
+            - Image
+    windows:
+        product: windows
+        keywordfields: ParentImage
+"""
+
+rule = """
+title: Keyword Test
+logsource:
+    %s
+detection:
+    keywords:
+        - 'mimikatz'
+        - 'cmd*'
+        - '*b\\\\*'
+        - 4688
+    condition: keywords
+"""
+process_creation = "category: process_creation\n    product: windows"
+
+
+def convert(backend_class, logsource, configyaml=config, options=None):
+    sigma_config = SigmaConfiguration(configyaml)
+    backend = backend_class(sigma_config, BackendOptions(options, None))
+    parser = SigmaCollectionParser(rule % logsource, sigma_config)
+    return backend, list(parser.generate(backend))
+
+
+def test_keywordfields_configuration():
+    chain = SigmaConfigurationChain([ SigmaConfiguration(config), SigmaConfiguration("title: empty") ])
+    assert chain.keywordfields == [ "Message" ]
+    sigma_config = SigmaConfiguration(config)
+    sigma_config.set_backend(None)
+    assert sigma_config.keywordfields == [ "Message" ]
+    assert sigma_config.get_logsource("process_creation", "windows", None).keywordfields == [ "CommandLine", "Image", "ParentImage" ]
+    assert sigma_config.get_logsource(None, "linux", None).keywordfields == []
+    with pytest.raises(SigmaConfigParseError):
+        SigmaConfiguration("keywordfields:\n    field: value")
+    with pytest.raises(SigmaConfigParseError):
+        SigmaConfiguration("logsources:\n    test:\n        product: test\n        keywordfields: 1").set_backend(None)
+
+
+def test_keywordfields_scoping():
+    _, (query,) = convert(SplunkBackend, "product: linux")
+    assert query == '(Message="*mimikatz*" OR Message="*cmd*" OR Message="*b\\\\*" OR Message="*4688*")'
+    _, (query,) = convert(ElasticsearchQuerystringBackend, process_creation)
+    assert query.startswith("(process.command_line.keyword:(*mimikatz* OR *cmd* OR *b\\\\* OR *4688*) OR Image.keyword:")
+    assert "ParentImage.keyword:" in query
+
+
+def test_keywordfields_fallback(caplog):
+    _, (query,) = convert(SplunkBackend, "product: linux", "title: empty")
+    assert query == '("mimikatz" OR "cmd*" OR "*b\\\\*" OR "4688")'
+    with caplog.at_level(logging.WARNING):
+        backend, _ = convert(FieldnameListBackend, "product: linux", "title: empty", [ "unbound_report" ])
+    assert backend.unboundRules == [ "Keyword Test" ]
+    assert "Keyword Test" in caplog.text
+    backend, _ = convert(FieldnameListBackend, process_creation)
+    assert backend.unboundRules == []
+    assert backend.finalize() == "Image\nParentImage\nprocess.command_line"
+
+
+def test_keywordfields_cost():
+    sigma_config = SigmaConfiguration(config)
+    backend = ElasticsearchQuerystringBackend(sigma_config, BackendOptions(None, None))
+    _, factors = backend.costReport(SigmaCollectionParser(rule % "product: linux", sigma_config).parsers[0])
+    assert factors["unbound_keywords"] == factors["all_field_searches"] == 0
+    sigma_config = SigmaConfiguration("title: empty")
+    backend = ElasticsearchQuerystringBackend(sigma_config, BackendOptions(None, None))
+    _, factors = backend.costReport(SigmaCollectionParser(rule % "product: linux", sigma_config).parsers[0])
+    assert factors["unbound_keywords"] == factors["all_field_searches"] == 4
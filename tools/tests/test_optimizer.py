@@ -0,0 +1,208 @@
+import itertools
+import random
+from sigma.engine.evaluator import SigmaConditionCompiler, SigmaValueMatcher
+from sigma.parser.collection import SigmaCollectionParser
+from sigma.parser.condition import SigmaConditionOptimizer, ConditionAND, ConditionOR, ConditionNOT, ConditionNotNULLValue, NodeSubexpression
+from sigma.parser.modifiers.type import SigmaRegularExpressionModifier
+
+
+def parse_search(detection):
+    rule = "title: Test\ndetection:\n" + "\n".join([ "    " + line for line in detection.strip().split("\n") ])
+    return SigmaCollectionParser(rule).parsers[0].condparsed[0].parsedSearch
+
+
+def strip(node):
+    """Search tree without subexpressions"""
+    return SigmaConditionOptimizer()._stripSubexpressionNode(node)
+
+
+def test_value_kinds():
+    optimizer = SigmaConditionOptimizer()
+    assert [ optimizer._valueKind(value) for value in ("cmd.exe", 4688, "*\\cmd.exe", "C:\\Windows*", "*mimikatz*", "C:*\\cmd.exe", "a?c", "*", "100\\*", "C:\\\\*") ] == \
+            [ "exact", "exact", "suffix", "prefix", "contains", "wildcard", "wildcard", "wildcard", "exact", "prefix" ]
+
+
+def test_value_set_collapse():
+    search = strip(parse_search("""
+selection1:
+    Image|endswith: '\\a.exe'
+selection2:
+    Image|endswith:
+        - '\\b.exe'
+        - '\\a.exe'
+selection3:
+    Image: 'C:\\c.exe'
+selection4:
+    Image: 'C:\\d.exe'
+selection5:
+    CommandLine|contains: 'x'
+condition: 1 of selection*
+"""))
+    assert type(search) == ConditionOR
+    assert search.items == [ ("Image", [ "*\\a.exe", "*\\b.exe" ]), ("Image", [ "C:\\c.exe", "C:\\d.exe" ]), ("CommandLine", "*x*") ]
+
+
+def test_value_set_collapse_mixed_lists():
+    """Lists with values of different match kinds and typed values are kept"""
+    search = strip(parse_search("""
+selection1:
+    Image:
+        - '*\\a.exe'
+        - 'C:\\b.exe'
+selection2:
+    Image: 'C:\\c.exe'
+selection3:
+    Image|re: '.*\\.exe'
+selection4:
+    Image|re: '.*\\.dll'
+condition: 1 of selection*
+"""))
+    assert len(search.items) == 4
+    assert search.items[:2] == [ ("Image", [ "*\\a.exe", "C:\\b.exe" ]), ("Image", "C:\\c.exe") ]
+
+
+def test_subsumption_or():
+    optimizer = SigmaConditionOptimizer()
+    items = optimizer._eliminateSubsumedOR([ ("CommandLine", "*mimikatz*"), ("CommandLine", [ "*MIMIKATZ.exe*", "*sekurlsa*" ]), ("Image", "*\\cmd.exe"), ("Image", "C:\\Windows\\System32\\CMD.EXE"), ("Image", "C:\\a\\*.exe") ])
+    assert items == [ ("CommandLine", "*mimikatz*"), ("CommandLine", "*sekurlsa*"), ("Image", "*\\cmd.exe"), ("Image", "C:\\a\\*.exe") ]
+    assert optimizer.eliminated == [ ("OR", "CommandLine", "*MIMIKATZ.exe*", "*mimikatz*"), ("OR", "Image", "C:\\Windows\\System32\\CMD.EXE", "*\\cmd.exe") ]
+    assert optimizer._eliminateSubsumedOR([ ("Image", "*\\cmd.exe"), ("Image", "*\\powershell.exe") ]) is None
+
+
+def test_subsumption_and():
+    optimizer = SigmaConditionOptimizer()
+    assert optimizer._eliminateSubsumedAND([ ("EventID", "1"), ("CommandLine", "*AAAA*"), ("EventID", 1), ("CommandLine", [ "*xAAAAy*", "*zAAAA*" ]) ]) == \
+            [ ("EventID", "1"), ("CommandLine", [ "*xAAAAy*", "*zAAAA*" ]) ]
+    assert optimizer._eliminateSubsumedAND([ ("CommandLine", "*a*"), ("CommandLine", [ "*ab*", "*c*" ]) ]) is None
+
+
+def test_subsumption_escaping():
+    """Escaped wildcards are literals, regular expressions are not compared"""
+    optimizer = SigmaConditionOptimizer()
+    assert optimizer._covers("a*", "a\\*")
+    assert not optimizer._covers("a\\*", "ab")
+    assert optimizer._covers("C:\\\\*", "C:\\x")
+    assert not optimizer._covers("a?c", "a*c")
+    assert optimizer._covers("a*c", "a?c")
+    assert optimizer._eliminateSubsumedOR([ ("Image", "*"), ("Image", SigmaRegularExpressionModifier(".*")) ]) is None
+
+
+def test_subsumption_sound():
+    """Values of patterns are matched by all patterns that subsume them"""
+    rnd = random.Random(1)
+    optimizer = SigmaConditionOptimizer()
+    alphabet = [ "a", "B", "*", "?", "\\*", "\\" ]
+    patterns = { "".join([ rnd.choice(alphabet) for i in range(rnd.randrange(1, 6)) ]) for j in range(300) }
+    patterns = { pattern for pattern in patterns if "**" not in pattern }     # not supported by SigmaValueMatcher
+    pairs = 0
+    for general in patterns:
+        for specific in patterns:
+            if general != specific and optimizer._covers(general, specific):
+                pairs += 1
+                for i in range(5):
+                    value = "".join([ rnd.choice("ab*?") * rnd.randrange(3) if part is None else rnd.choice("abAB") if part is False else part for part in SigmaValueMatcher(specific).parts ])
+                    assert SigmaValueMatcher(specific)(value.lower())
+                    assert SigmaValueMatcher(general)(value.lower())
+    assert pairs > 100
+
+
+def test_subsumption_report():
+    parser = SigmaCollectionParser("""
+title: Test
+detection:
+    selection:
+        CommandLine|contains:
+            - 'mimikatz'
+            - 'mimikatz.exe'
+    condition: selection
+""").parsers[0]
+    assert parser.condparsed[0].eliminated == [ ("OR", "CommandLine", "*mimikatz.exe*", "*mimikatz*") ]
+
+
+def random_tree(rnd, depth):
+    """Random search tree with map items, value lists and null values of fields A, B and C"""
+    if depth == 0 or rnd.random() < 0.3:
+        field = rnd.choice("ABC")
+        return rnd.choice([ (field, "1"), (field, "2"), (field, [ "1", "2" ]), (field, None) ])
+    kind = rnd.choice([ ConditionAND, ConditionOR, ConditionNOT, NodeSubexpression ])
+    if kind == ConditionNOT:
+        return ConditionNOT(None, None, random_tree(rnd, depth - 1))
+    elif kind == NodeSubexpression:
+        return NodeSubexpression(random_tree(rnd, depth - 1))
+    node = kind()
+    node.items = [ random_tree(rnd, depth - 1) for i in range(rnd.randrange(1, 4)) ]
+    return node
+
+
+def negations_at_atoms(node, grouped):
+    """Negations are only in front of atoms or in front of an OR of atoms if grouped"""
+    if type(node) == ConditionNOT:
+        item = node.item.items if type(node.item) == NodeSubexpression else node.item
+        if grouped and type(item) == ConditionOR:
+            return all([ type(child) in (tuple, list, str, int) for child in item.items ])
+        return type(item) in (tuple, list, str, int)
+    elif type(node) in (ConditionAND, ConditionOR):
+        return all([ negations_at_atoms(child, grouped) for child in node.items ])
+    elif type(node) == NodeSubexpression:
+        return negations_at_atoms(node.items, grouped)
+    return True
+
+
+def test_negation_pushdown():
+    """Truth table check of trees with pushed down negations for all combinations of field values"""
+    rnd = random.Random(1)
+    events = [ { field: value for field, value in zip("ABC", values) if value is not None } for values in itertools.product([ None, "1", "2" ], repeat=3) ]
+    for i in range(500):
+        tree = random_tree(rnd, 4)
+        original = SigmaConditionCompiler().compileNode(tree)
+        expected = [ original(event) for event in events ]
+        for grouped, notnull in itertools.product([ False, True ], repeat=2):
+            rewritten = SigmaConditionOptimizer().pushDownNegations(tree, grouped, notnull)
+            assert negations_at_atoms(rewritten, grouped)
+            assert [ SigmaConditionCompiler().compileNode(rewritten)(event) for event in events ] == expected
+        assert [ original(event) for event in events ] == expected     # original tree is unchanged
+
+
+def test_negation_pushdown_shape():
+    search = parse_search("""
+selection:
+    Image|endswith: '\\cmd.exe'
+filter1:
+    User: 'SYSTEM'
+filter2:
+    ParentImage: 'C:\\explorer.exe'
+filter3:
+    Description: null
+condition: not filter1 and selection and not (filter2 or filter3)
+""")
+    optimizer = SigmaConditionOptimizer()
+    atoms = strip(optimizer.pushDownNegations(search))
+    assert [ type(item) for item in atoms.items ] == [ tuple, ConditionNotNULLValue, ConditionNOT, ConditionNOT ]
+    grouped = strip(optimizer.pushDownNegations(search, grouped=True))
+    assert [ type(item) for item in grouped.items ] == [ tuple, ConditionNotNULLValue, ConditionNOT ]
+    assert strip(grouped.items[2].item).items == [ ("User", "SYSTEM"), ("ParentImage", "C:\\explorer.exe") ]
+
+
+def test_absorption():
+    """A branch that only contains the common factor absorbs the other branches instead of being dropped"""
+    search = strip(parse_search("""
+selection1:
+    CommandLine: 'a'
+    User: 'SYSTEM'
+selection2:
+    User: 'SYSTEM'
+condition: 1 of selection*
+"""))
+    assert search == ("User", "SYSTEM")
+    search = strip(parse_search("""
+selection1:
+    CommandLine: 'a'
+    User: 'SYSTEM'
+selection2:
+    User: 'SYSTEM'
+selection3:
+    User: 'SYSTEM'
+    Image: 'b'
+condition: 1 of selection*
+"""))
+    assert search == ("User", "SYSTEM")
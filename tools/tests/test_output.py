@@ -0,0 +1,177 @@
+import io
+import json
+import pathlib
+import subprocess
+import sys
+import pytest
+import yaml
+from sigma.backends.base import BackendOptions
+from sigma.backends.elasticsearch import ElasticsearchDSLBackend, KibanaBackend, XPackWatcherBackend
+from sigma.backends.limacharlie import LimaCharlieBackend
+from sigma.configuration import SigmaConfiguration
+from sigma.output import SigmaOutputSink, SigmaShardedOutput, StructuredResult, jsonEncoder, serializeDocuments
+from sigma.parser.collection import SigmaCollectionParser
+
+toolsdir = pathlib.Path(__file__).resolve().parents[1]
+
+rule = """
+id: output-test
+title: Output Test
+level: high
+logsource:
+    product: windows
+    service: sysmon
+detection:
+    selection:
+        EventID: 1
+        CommandLine|contains: 'mimikatz'
+    condition: selection
+"""
+
+documents = [ { "a": 1, "b": [ 1, 2 ] }, [ { "c": "x" }, { "d": None } ], "# text" ]
+
+
+def sink_output(outputFormat, pretty=True, encoder="json", results=(documents,), array=False):
+    out = io.StringIO()
+    sink = SigmaOutputSink(out, outputFormat, pretty, encoder, array)
+    for result in results:
+        sink.write(result)
+    sink.close()
+    return out.getvalue()
+
+
+def convert(backend_class, options=(), stream=False):
+    sigma_config = SigmaConfiguration("title: Output Test")
+    backend = backend_class(sigma_config, BackendOptions(list(options), None))
+    backend.structuredResults = True
+    backend.streamResults = stream
+    rules = rule + "---\n" + rule.replace("mimikatz", "sekurlsa") if stream else rule
+    return backend, list(SigmaCollectionParser(rules, sigma_config).generate(backend))
+
+
+def test_output_json():
+    assert sink_output("json") == '{\n  "a": 1,\n  "b": [\n    1,\n    2\n  ]\n}\n[\n  {\n    "c": "x"\n  },\n  {\n    "d": null\n  }\n]\n# text\n'
+    assert sink_output("json", False) == '{"a":1,"b":[1,2]}\n[{"c":"x"},{"d":null}]\n# text\n'
+
+
+def test_output_ndjson():
+    assert sink_output("ndjson") == '{"a":1,"b":[1,2]}\n{"c":"x"}\n{"d":null}\n# text\n'
+
+
+def test_output_yaml():
+    output = sink_output("yaml", results=(documents[:1], documents[1:2], [ StructuredResult({ "e": 1 }, rule="test") ]))
+    assert list(yaml.safe_load_all(output)) == [ documents[0], documents[1], { "e": 1 } ]
+    assert output.count("---\n") == 2
+    assert sink_output("yaml", False, results=([ documents[0] ],)) == "{a: 1, b: [1, 2]}\n"
+
+
+def test_output_string_results():
+    assert sink_output("yaml", results=("query 1", "query 2")) == "query 1\nquery 2\n"
+    assert sink_output("json", False, results=({ "a": [ 1 ] },)) == '{"a":[1]}\n'
+
+
+def test_output_encoders():
+    orjson = pytest.importorskip("orjson")
+    for pretty in (True, False):
+        assert json.loads(jsonEncoder("orjson", pretty)(documents)) == json.loads(jsonEncoder("json", pretty)(documents))
+    assert sink_output("ndjson", encoder="orjson") == sink_output("ndjson")
+    assert jsonEncoder("auto", False)({ 1: "x" }) == '{"1":"x"}'
+
+
+def test_output_errors():
+    with pytest.raises(ValueError):
+        SigmaOutputSink(io.StringIO(), "xml")
+    with pytest.raises(ValueError):
+        jsonEncoder("simplejson")
+
+
+def test_output_structured_backends():
+    backend, results = convert(ElasticsearchDSLBackend)
+    assert results == []
+    query, = backend.finalize()
+    assert query.meta == { "name": "output-test" }
+    assert query.value["query"]["constant_score"]["filter"]["bool"]
+    backend, _ = convert(ElasticsearchDSLBackend)
+    backend.structuredResults = False
+    assert json.loads(backend.finalize()) == query.value
+    backend, _ = convert(ElasticsearchDSLBackend, [ "output=percolator" ])
+    action, document = backend.finalize()
+    assert action.value == { "index": { "_index": "sigma-rules", "_id": "output-test" } }
+    assert backend.getOutputFormat() == "ndjson"
+    backend, _ = convert(ElasticsearchDSLBackend, [ "output=percolator" ])
+    backend.structuredResults = False
+    assert [ json.loads(line) for line in backend.finalize().split("\n") ] == [ action.value, document ]
+    backend, _ = convert(XPackWatcherBackend, [ "output=json" ])
+    assert backend.getOutputFormat() == "ndjson"
+    watcher, = backend.finalize()
+    assert watcher.value["metadata"]["title"] == "Output Test"
+
+
+def test_output_streaming():
+    backend, results = convert(ElasticsearchDSLBackend, [ "output=curl" ], True)
+    assert [ len(result) for result in results ] == [ 1, 1 ]
+    assert results[1][0].meta == { "name": "output-test-2", "extension": "sh" }
+    assert len(backend.queries) == 1 and backend.finalize() == []       # queries of the last rule only
+    backend, results = convert(KibanaBackend, [ "output=curl" ], True)
+    assert all([ result[0].value.startswith("export index_X=") for result in results ])
+    backend, results = convert(ElasticsearchDSLBackend, [ "output=percolator-mapping" ], True)
+    assert results == []
+    mapping, = backend.finalize()
+    assert set(mapping.value["mappings"]["properties"]) == { "sigma", "EventID", "CommandLine" }
+
+
+def test_output_array():
+    elements = [ [ { "a": 1 } ], [ { "b": 2 } ] ]
+    assert sink_output("json", results=elements, array=True) == json.dumps([ { "a": 1 }, { "b": 2 } ], indent=2) + "\n"
+    assert sink_output("json", results=elements[:1], array="multiple") == json.dumps({ "a": 1 }, indent=2) + "\n"
+    assert serializeDocuments([ { "a": 1 }, { "b": 2 } ], "json", False, array="multiple") == '[{"a":1},{"b":2}]'
+    assert serializeDocuments([ { "a": 1 } ], "json", False, array="multiple") == '{"a":1}'
+    assert serializeDocuments([ { "a": 1 } ], "json", False, array=True) == '[{"a":1}]'
+    assert serializeDocuments([], "json", array=True) == "[]"
+    assert serializeDocuments([ { "a": 1 }, { "b": 2 } ], "ndjson", array=True) == '{"a":1}\n{"b":2}'
+    backend, results = convert(KibanaBackend, (), True)
+    output = sink_output("json", results=results, array=backend.outputArray)
+    assert [ search["_id"] for search in json.loads(output) ] == [ "output-test", "output-test-2" ]
+
+
+def test_output_sharded(tmp_path):
+    backend, results = convert(XPackWatcherBackend, [ "output=json" ], True)
+    sink = SigmaShardedOutput(str(tmp_path / "watchers"), "json", False)
+    for result in results:
+        sink.write(result)
+    sink.write([ StructuredResult({ "c": 1 }, name="output-test") ])
+    assert sink.written == [ "output-test.json", "output-test-2.json", "output-test-3.json" ]
+    assert json.loads((tmp_path / "watchers" / "output-test-2.json").read_text())["metadata"]["title"] == "Output Test"
+    sink = SigmaShardedOutput(str(tmp_path / "watchers"), "json", False)
+    for result in results:
+        sink.write(result)
+    sink.write([ StructuredResult({ "c": 2 }, name="output-test") ])
+    assert sink.unchanged == [ "output-test.json", "output-test-2.json" ]
+    assert sink.written == [ "output-test-3.json" ]
+    assert { path.name for path in (tmp_path / "watchers").iterdir() } == set(sink.unchanged + sink.written)
+    sink = SigmaShardedOutput(str(tmp_path / "scripts"), "json")
+    sink.write([ StructuredResult("curl ...", name="../rule 1", extension="sh") ])
+    assert (tmp_path / "scripts" / "_rule_1.sh").read_text() == "curl ...\n"
+
+
+def test_output_limacharlie():
+    sigma_config = SigmaConfiguration()
+    backend, (result,) = convert(LimaCharlieBackend)
+    document, = result
+    assert document.meta == { "name": "output-test" }
+    document = document.value
+    assert document["detect"]["op"] == "and"
+    assert document["detect"]["log type"] == "wel"
+    assert document["respond"] == [ { "action": "report", "name": "Output Test", "metadata": { "level": "high" } } ]
+    backend.structuredResults = False
+    assert yaml.safe_load(list(SigmaCollectionParser(rule, sigma_config).generate(backend))[0]) == document
+
+
+def test_output_sigmac_single_document(tmp_path):
+    """Results of backends without structured output are written as one document, e.g. the rule dict of ala-rule"""
+    path = tmp_path / "rule.yml"
+    path.write_text(rule.replace("level: high", "level: high\ntags:\n    - attack.execution"), encoding="utf-8")
+    output = subprocess.run([ sys.executable, str(toolsdir / "sigmac"), "-t", "ala-rule", str(path) ], stdout=subprocess.PIPE, check=True).stdout
+    analytics, = json.loads(output)["analytics"]
+    assert analytics["displayName"].startswith("Output Test")
+    assert analytics["query"].startswith("Event | where ")
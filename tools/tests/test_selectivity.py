@@ -0,0 +1,119 @@
+import json
+import pathlib
+import pytest
+import re
+from sigma.backends.base import BackendOptions
+from sigma.backends.qradar import QRadarBackend
+from sigma.configuration import SigmaConfiguration
+from sigma.engine.evaluator import SigmaConditionCompiler
+from sigma.parser.collection import SigmaCollectionParser
+from sigma.parser.condition import SigmaConditionOptimizer, ConditionAND, ConditionOR, NodeSubexpression
+from sigma.selectivity import SigmaFieldStatistics, sampleStatistics
+
+rule = """
+title: Test
+logsource:
+    category: process_creation
+    product: windows
+detection:
+    selection:
+        CommandLine|contains: 'whoami'
+        Image|re: '.*\\\\cmd\\.exe'
+        ParentImage|endswith: '\\\\explorer.exe'
+        User: 'SYSTEM'
+        Computer: 'dc1'
+    condition: selection
+"""
+
+
+def parse(rule):
+    return SigmaCollectionParser(rule).parsers[0].condparsed[0].parsedSearch
+
+
+def fields(node):
+    """Field names of the map items of a search tree in order"""
+    node = SigmaConditionOptimizer()._stripSubexpressionNode(node)
+    if type(node) in (ConditionAND, ConditionOR):
+        return [ field for item in node.items for field in fields(item) ]
+    return [ node[0] ]
+
+
+def test_selectivity_heuristic():
+    """Indexed fields first, then exact values, wildcards and regular expressions"""
+    search = parse(rule)
+    assert fields(search) == [ "CommandLine", "Image", "ParentImage", "User", "Computer" ]
+    assert fields(SigmaFieldStatistics().order(search)) == [ "User", "Computer", "ParentImage", "CommandLine", "Image" ]
+    assert fields(SigmaFieldStatistics(indexed=[ "CommandLine" ]).order(search)) == [ "CommandLine", "User", "Computer", "ParentImage", "Image" ]
+    assert fields(search) == [ "CommandLine", "Image", "ParentImage", "User", "Computer" ]    # original tree is unchanged
+
+
+def test_selectivity_statistics():
+    """Frequent values are checked late in AND and early in OR conditions"""
+    statistics = SigmaFieldStatistics({
+        "fields": {
+            "User": { "presence": 1.0, "cardinality": 3, "values": { "system": 0.9, "alice": 0.05 } },
+            "Computer": { "presence": 1.0, "cardinality": 1000 },
+            "CommandLine": { "presence": 1.0, "values": { "cmd /c whoami": 0.001 } },
+            },
+        })
+    assert statistics.estimate(("User", "SYSTEM"))[0] == 0.9
+    assert statistics.estimate(("User", "bob"))[0] == pytest.approx(0.05)
+    assert statistics.estimate(("Computer", "dc1"))[0] == 0.001
+    assert fields(statistics.order(parse(rule))) == [ "Computer", "ParentImage", "User", "CommandLine", "Image" ]
+    search = parse("title: Test\ndetection:\n    selection1:\n        Computer: 'dc1'\n    selection2:\n        User: 'SYSTEM'\n    condition: 1 of selection*")
+    assert fields(statistics.order(search)) == [ "User", "Computer" ]
+
+
+def test_selectivity_order_equivalence():
+    """Ordered rules match the same events and are estimated cheaper than the original order"""
+    statistics = SigmaFieldStatistics()
+    events = [ { "CommandLine": "cmd /c whoami", "Image": "C:\\Windows\\cmd.exe", "User": "SYSTEM", "Computer": "dc1" }, { "User": "SYSTEM" }, {} ]
+    rules = sorted((pathlib.Path(__file__).resolve().parents[2] / "rules" / "windows" / "process_creation").glob("*.yml"))
+    reordered = 0
+    for path in rules:
+        for parser in SigmaCollectionParser(path.read_text(encoding="utf-8")).parsers:
+            for parsed in parser.condparsed:
+                ordered = statistics.order(parsed.parsedSearch)
+                assert statistics.estimate(ordered)[1] <= statistics.estimate(parsed.parsedSearch)[1] + 1e-9
+                reordered += statistics.estimate(ordered)[1] < statistics.estimate(parsed.parsedSearch)[1] - 1e-9
+                original = SigmaConditionCompiler().compileNode(parsed.parsedSearch)
+                compiled = SigmaConditionCompiler().compileNode(ordered)
+                assert [ compiled(event) for event in events ] == [ original(event) for event in events ]
+    assert reordered > 10
+
+
+def test_selectivity_sampling():
+    events = [
+            { "EventID": 1, "Image": "C:\\cmd.exe", "event_data": { "User": "SYSTEM" }, "tags": [ "a", "b" ] },
+            { "EventID": 1, "Image": "C:\\CMD.EXE", "event_data": { "User": "alice" } },
+            { "EventID": 3, "Image": "C:\\explorer.exe" },
+            "no event",
+            ]
+    statistics = sampleStatistics(events, top_values=2, indexed=[ "EventID" ])
+    assert statistics["events"] == 3
+    assert statistics["fields"]["EventID"] == { "presence": 1.0, "cardinality": 2, "values": { "1": 2 / 3, "3": 1 / 3 }, "indexed": True }
+    assert statistics["fields"]["event_data.User"]["presence"] == 2 / 3
+    assert statistics["fields"]["tags"]["values"] == { "a": 1 / 3, "b": 1 / 3 }
+    assert statistics["fields"]["Image"]["cardinality"] == 2
+    assert sampleStatistics(events, limit=1)["events"] == 1
+    assert sampleStatistics(events, sample_rate=3)["events"] == 1     # events 0 and 3, the second one is no dict
+
+    loaded = SigmaFieldStatistics(statistics)
+    assert loaded.estimate(("Image", "c:\\cmd.exe"))[0] == 2 / 3
+    assert loaded.estimate(("Image", "*cmd.exe"))[0] == pytest.approx(2 / 3 + 1 / 3 * 0.1)     # listed values and default probability of unlisted values
+    assert "EventID" in loaded.indexed
+
+
+def test_selectivity_backend(tmp_path):
+    sigma_config = SigmaConfiguration()
+    def order(options):
+        """Fields of the query in the order of the output"""
+        query = list(SigmaCollectionParser(rule, sigma_config).generate(QRadarBackend(sigma_config, BackendOptions(options, None))))[0]
+        return sorted([ "CommandLine", "Image", "ParentImage", "User", "Computer" ], key=lambda field: re.search("[ (]%s[ =]" % field, query).start())
+    assert order([]) == [ "CommandLine", "Image", "ParentImage", "User", "Computer" ]
+    assert order([ "order_conditions=no" ]) == order([])
+    assert order([ "order_conditions" ]) == [ "User", "Computer", "ParentImage", "CommandLine", "Image" ]
+    stats = tmp_path / "stats.json"
+    stats.write_text(json.dumps({ "fields": { "User": { "cardinality": 2, "values": { "SYSTEM": 0.5 } } } }))
+    assert order([ "field_stats=%s" % stats ]) == [ "Computer", "User", "ParentImage", "CommandLine", "Image" ]
+    assert order([ "field_stats=%s" % stats, "indexed_fields=CommandLine" ]) == [ "CommandLine", "Computer", "User", "ParentImage", "Image" ]
@@ -0,0 +1,124 @@
+import json
+import logging
+import pytest
+import sqlite3
+import yaml
+from sigma.backends.base import BackendOptions
+from sigma.backends.elasticsearch import ElasticsearchDSLBackend, ElasticsearchQuerystringBackend, ElastalertBackendDsl
+from sigma.backends.powershell import PowerShellBackend
+from sigma.backends.qradar import QRadarBackend
+from sigma.backends.splunk import SplunkBackend
+from sigma.backends.sql import SQLBackend
+from sigma.configuration import SigmaConfiguration
+from sigma.engine.bundle import SigmaBundle
+from sigma.engine.evaluator import SigmaRuleEvaluator, SigmaRulesetEvaluator
+from sigma.parser.collection import SigmaCollectionParser
+from sigma.parser.exceptions import SigmaParseError
+from sigma.valuelist import SigmaValueList
+
+rule = """
+title: Test
+logsource:
+    product: windows
+detection:
+    selection:
+        Hashes|list: iocs
+    condition: selection
+"""
+
+
+@pytest.fixture
+def valuelist_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(SigmaValueList, "cachedir", str(tmp_path / "cache"))
+    path = tmp_path / "iocs.txt"
+    path.write_text("# hashes\nBBB\naaa\n\nbbb\nc*\\?\naaa\n", encoding="utf-8")
+    return "lists:\n  iocs: %s\n" % path
+
+
+def generate(backend_class, config, options=None):
+    sigma_config = SigmaConfiguration(config)
+    backend = backend_class(sigma_config, BackendOptions(options, None))
+    results = list(SigmaCollectionParser(rule, sigma_config).generate(backend))
+    final = backend.finalize()
+    if final:
+        results.append(final)
+    return results
+
+
+def test_valuelist(tmp_path, monkeypatch):
+    monkeypatch.setattr(SigmaValueList, "cachedir", str(tmp_path / "cache"))
+    path = tmp_path / "list.txt"
+    path.write_text("b\nA\na\nb\n# comment\n\nc d\n", encoding="utf-8")
+    valuelist = SigmaValueList.load(str(path))
+    assert SigmaValueList.load(str(path)) is valuelist
+    assert valuelist.name == "list"
+    assert list(valuelist) == [ "A", "a", "b", "c d" ]
+    assert "B" in valuelist and "c D" in valuelist and "c" not in valuelist and "" not in valuelist
+    compiled = list((tmp_path / "cache").iterdir())
+    assert len(compiled) == 1
+    assert list(SigmaValueList(str(compiled[0]), "other")) == list(valuelist)
+
+
+def test_valuelist_backends(valuelist_config):
+    options = [ "list_threshold=3" ]
+    assert generate(SplunkBackend, valuelist_config, options) == [ "[| inputlookup iocs.csv | rename value as Hashes | fields Hashes]" ]
+    assert generate(QRadarBackend, valuelist_config, options)[0].endswith("where REFERENCESETCONTAINS('iocs', Hashes)")
+    assert generate(SQLBackend, valuelist_config, options) == [ "LOWER(Hashes) IN (SELECT LOWER(value) FROM sigma_list_iocs)" ]
+    assert json.loads(generate(ElasticsearchDSLBackend, valuelist_config, options)[-1])["query"]["constant_score"]["filter"] == { "terms": { "Hashes.keyword": { "index": "sigma-lists", "id": "iocs", "path": "values" } } }
+    elastalert = yaml.safe_load(generate(ElastalertBackendDsl, valuelist_config, options + [ "list_index=lists" ])[0])
+    assert elastalert["filter"][0]["query"]["constant_score"]["filter"] == { "terms": { "Hashes.keyword": { "index": "lists", "id": "iocs", "path": "values" } } }
+
+    # inlined below threshold and by backends without lookups, wildcards in list values are literal
+    assert generate(SplunkBackend, valuelist_config) == [ '(Hashes="aaa" OR Hashes="BBB" OR Hashes="bbb" OR Hashes="c\\*\\\\\\?")' ]
+    assert generate(SQLBackend, valuelist_config, [ "dialect=sqlite" ]) == [ "Hashes COLLATE NOCASE IN ('aaa', 'BBB', 'bbb', 'c*\\?')" ]
+    assert generate(ElasticsearchQuerystringBackend, valuelist_config, options) == [ 'Hashes.keyword:(aaa OR BBB OR bbb OR c\\*\\\\\\?)' ]
+    assert generate(PowerShellBackend, valuelist_config)[0].startswith('Get-WinEvent | where {($_.message -match "aaa" -or ')
+
+
+def test_valuelist_sql_lookup(valuelist_config):
+    """Inlined lists and list lookups of the SQLite dialects match the same rows"""
+    db = sqlite3.connect(":memory:")
+    db.execute("CREATE TABLE eventlog (Hashes)")
+    db.executemany("INSERT INTO eventlog VALUES (?)", [ (value,) for value in ("AAA", "aaa", "Bbb", "c*\\?", "C*\\?", "cx\\?", "aa", "") ])
+    db.execute("CREATE TABLE sigma_list_iocs (value)")
+    db.executemany("INSERT INTO sigma_list_iocs VALUES (?)", [ (value,) for value in ("BBB", "aaa", "bbb", "c*\\?") ])
+    for dialect in ("sqlite", "sqlite-fts5"):
+        inlined, = generate(SQLBackend, valuelist_config, [ "dialect=" + dialect ])
+        lookup, = generate(SQLBackend, valuelist_config, [ "dialect=" + dialect, "list_threshold=3" ])
+        assert lookup == "Hashes COLLATE NOCASE IN (SELECT value FROM sigma_list_iocs)"
+        rows = [ row for row, in db.execute("SELECT Hashes FROM eventlog WHERE " + inlined).fetchall() ]
+        assert rows == [ row for row, in db.execute("SELECT Hashes FROM eventlog WHERE " + lookup).fetchall() ]
+        assert rows == [ "AAA", "aaa", "Bbb", "c*\\?", "C*\\?" ]
+    assert generate(SQLBackend, valuelist_config, [ "dialect=postgresql", "list_threshold=3" ]) == [ "LOWER(Hashes) IN (SELECT LOWER(value) FROM sigma_list_iocs)" ]
+    assert generate(SQLBackend, valuelist_config, [ "dialect=postgresql" ]) == [ "LOWER(Hashes) IN ('aaa', 'bbb', 'bbb', 'c*\\?')" ]
+
+
+def test_valuelist_splunk_subsearch_limit(valuelist_config, caplog):
+    with caplog.at_level(logging.WARNING):
+        generate(SplunkBackend, valuelist_config, [ "list_threshold=3", "subsearch_limit=4" ])
+    assert caplog.text == ""
+    with caplog.at_level(logging.WARNING):
+        generate(SplunkBackend, valuelist_config, [ "list_threshold=3", "subsearch_limit=3" ])
+    assert "Value list iocs has 4 values, the subsearch returns only the first 3 of them" in caplog.text
+
+
+def test_valuelist_evaluation(valuelist_config):
+    evaluator = SigmaRuleEvaluator(SigmaCollectionParser(rule, SigmaConfiguration(valuelist_config)).parsers[0])
+    assert evaluator.match({ "Hashes": "AAA" })
+    assert evaluator.match({ "Hashes": "c*\\?" })
+    assert not evaluator.match({ "Hashes": "cx\\?" })
+    with pytest.raises(SigmaParseError, match="can't be loaded"):
+        SigmaCollectionParser(rule, SigmaConfiguration()).parsers[0].condparsed
+
+
+def test_valuelist_bundle(valuelist_config, tmp_path):
+    ruleset = SigmaRulesetEvaluator(SigmaConfiguration(valuelist_config))
+    ruleset.load(rule)
+    path = tmp_path / "rules.bundle"
+    with path.open("wb") as f:
+        SigmaBundle.fromRuleset(ruleset).write(f)
+    (tmp_path / "iocs.txt").unlink()        # values are embedded in the bundle
+    loaded = SigmaBundle.load(str(path)).ruleset()
+    assert loaded.match({ "Hashes": "AAA" }) and loaded.match({ "Hashes": "c*\\?" })
+    assert not loaded.match({ "Hashes": "cx\\?" })
+    assert SigmaBundle.fromRuleset(loaded).serialize() == path.read_bytes()